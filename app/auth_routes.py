@@ -3,11 +3,10 @@ from fastapi.responses import RedirectResponse, HTMLResponse
 from fastapi.templating import Jinja2Templates
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy import select
-from pyrogram.errors import SessionPasswordNeeded, PhoneCodeInvalid
-from .db import get_db
+from .db import get_db, AsyncSessionLocal
 from .models import User
 from .telegram_client import tg_clients
-import os
+from .login_pool import login_pool, OK, INVALID_CODE, INVALID_PASSWORD, PASSWORD_NEEDED
 
 router = APIRouter()
 templates = Jinja2Templates(directory="app/templates")
@@ -16,86 +15,97 @@ templates = Jinja2Templates(directory="app/templates")
 async def index(request: Request):
     return templates.TemplateResponse("index.html", {"request": request})
 
+async def _user_for_phone(phone: str) -> User:
+    """Find or create the user, in a transaction of its own: the writer connection is
+    shared with ingestion and must not wait on Telegram."""
+    async with AsyncSessionLocal() as db:
+        res = await db.execute(select(User).where(User.phone == phone))
+        user = res.scalars().first()
+        if not user:
+            user = User(phone=phone)
+            db.add(user)
+            await db.commit()
+            await db.refresh(user)
+        return user
+
 @router.post("/start_login")
-async def start_login(request: Request, phone: str = Form(...), db: AsyncSession = Depends(get_db)):
-    # Create or find user
-    res = await db.execute(select(User).where(User.phone == phone))
-    user = res.scalars().first()
-    if not user:
-        user = User(phone=phone)
-        db.add(user)
-        await db.commit()
-        await db.refresh(user)
+async def start_login(request: Request, phone: str = Form(...)):
+    user = await _user_for_phone(phone)
 
-    # Prepare a client (not started)
-    from pyrogram import Client
-    api_id = int(os.getenv("TELEGRAM_API_ID", "0"))
-    api_hash = os.getenv("TELEGRAM_API_HASH", "")
-    session_dir = os.getenv("SESSION_DIR", "./data/sessions")
-    os.makedirs(session_dir, exist_ok=True)
-    session_name = os.path.join(session_dir, f"user_{user.id}_login")
-    app = Client(name=session_name, api_id=api_id, api_hash=api_hash, workdir=os.path.dirname(session_name))
-    await app.connect()
-    sent = await app.send_code(phone)
+    # Connect once and keep the client in the pool for the following steps
+    entry = await login_pool.start_login(user.id, phone)
     request.session["pending_user_id"] = user.id
-    request.session["login_session_name"] = session_name
-    await app.disconnect()
+    request.session["login_key"] = entry.key
+    # Enough to pick the login up again in another worker process
+    request.session["login_session_name"] = entry.session_path
+    request.session["login_phone"] = phone
+    request.session["login_code_hash"] = entry.phone_code_hash
     return RedirectResponse(url="/verify_code", status_code=303)
 
 @router.get("/verify_code", response_class=HTMLResponse)
 async def verify_code_page(request: Request):
     if not request.session.get("pending_user_id"):
         return RedirectResponse(url="/")
-    return templates.TemplateResponse("verify_code.html", {"request": request})
+    return templates.TemplateResponse("verify_code.html", {"request": request, "error": request.session.pop("login_error", None)})
+
+LOGIN_ERRORS = {
+    INVALID_CODE: "Неверный или просроченный код",
+    PASSWORD_NEEDED: "Включена двухфакторная аутентификация — введите пароль",
+    INVALID_PASSWORD: "Неверный пароль",
+}
+
+def _clear_login(request: Request):
+    for k in ("pending_user_id", "login_key", "login_session_name", "login_phone", "login_code_hash", "login_needs_password"):
+        request.session.pop(k, None)
 
 @router.post("/finish_login")
-async def finish_login(request: Request, code: str = Form(...), password: str = Form(default=""), db: AsyncSession = Depends(get_db)):
+async def finish_login(request: Request, code: str = Form(default=""), password: str = Form(default=""), db: AsyncSession = Depends(get_db)):
     user_id = request.session.get("pending_user_id")
-    session_name = request.session.get("login_session_name")
-    if not user_id or not session_name:
+    key = request.session.get("login_key")
+    if not user_id or not key:
         return RedirectResponse(url="/")
-    from pyrogram import Client
-    api_id = int(os.getenv("TELEGRAM_API_ID", "0"))
-    api_hash = os.getenv("TELEGRAM_API_HASH", "")
-    app = Client(name=session_name, api_id=api_id, api_hash=api_hash, workdir=os.path.dirname(session_name))
-    await app.connect()
-    # sign in
-    try:
-        await app.sign_in(phone_number=None, code=code)
-    except SessionPasswordNeeded:
-        if not password:
-            await app.disconnect()
-            return RedirectResponse(url="/verify_code", status_code=303)
-        await app.check_password(password=password)
-    except PhoneCodeInvalid:
-        await app.disconnect()
-        return RedirectResponse(url="/verify_code", status_code=303)
+    entry = login_pool.get(key)
+    if entry is None:
+        try:
+            entry = await login_pool.resume(
+                key, user_id, request.session.get("login_phone", ""), request.session.get("login_session_name", ""),
+                request.session.get("login_code_hash", ""), bool(request.session.get("login_needs_password")),
+            )
+        except Exception as e:
+            print("login resume error:", e)
+            _clear_login(request)
+            return RedirectResponse(url="/", status_code=303)
 
-    me = await app.get_me()
-    # Move/rename session to permanent name
-    from pathlib import Path
-    session_dir = os.getenv("SESSION_DIR", "./data/sessions")
-    perm = os.path.join(session_dir, f"user_{user_id}")
-    # Pyrogram stores .session (and maybe .session-journal) — keep basename stable
-    # We'll just keep folder path (workdir) and basename same
-    # For simplicity, keep session_name as permanent
-    await app.disconnect()
+    result = await login_pool.sign_in(entry, code, password)
+    if result in LOGIN_ERRORS:
+        request.session["login_needs_password"] = entry.needs_password
+        request.session["login_error"] = LOGIN_ERRORS[result]
+        return RedirectResponse(url="/verify_code", status_code=303)
+    if result != OK:
+        await login_pool.discard(key)
+        _clear_login(request)
+        return RedirectResponse(url="/", status_code=303)
 
     # Persist user
+    me = entry.me
     res = await db.execute(select(User).where(User.id == user_id))
     user = res.scalars().first()
+    previous_session = user.session_path
     user.tg_user_id = me.id
     user.first_name = me.first_name or ""
     user.last_name = me.last_name or ""
-    user.session_path = session_name
+    user.session_path = entry.session_path
     await db.commit()
 
-    # Open long-running client with handlers
-    await tg_clients.get_or_create(db, user)
+    # The signed-in connection becomes the user's long-running client
+    login_pool.take(key)
+    await tg_clients.adopt(user.id, entry.client, entry.session_path)
+    # The client on the old session is stopped now; don't leave its authorization behind
+    if previous_session and previous_session != entry.session_path:
+        login_pool.retire(previous_session)
 
     # Set logged-in session cookie
-    request.session.pop("pending_user_id", None)
-    request.session.pop("login_session_name", None)
+    _clear_login(request)
     request.session["user_id"] = user.id
     return RedirectResponse(url="/dashboard", status_code=303)
 
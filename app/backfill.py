@@ -0,0 +1,228 @@
+import asyncio
+import os
+import time
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional
+from sqlalchemy import func, select, update
+from .db import AsyncReadSessionLocal, AsyncSessionLocal, DB_COMMIT_SECONDS
+from .filters import CompiledFilter
+from .ingest import PendingMessage, write_messages
+from .models import Chat, Message
+from .outbound import flood_wait_seconds
+from .recent import recent
+from .refilter import store_all
+from .snapshots import snapshots
+from .telegram_client import tg_clients
+from .warmstart import warm_start
+from . import metrics
+
+BACKFILL_ENV = "BACKFILL"
+BACKFILL_CONCURRENCY_ENV = "BACKFILL_CONCURRENCY"
+BACKFILL_PAGE_ENV = "BACKFILL_PAGE"
+BACKFILL_DAYS_ENV = "BACKFILL_DAYS"
+BACKFILL_PAUSE_MS_ENV = "BACKFILL_PAUSE_MS"
+
+_COMMIT = DB_COMMIT_SECONDS.labels("backfill")
+
+class Backfill:
+    """Fills in history that live ingestion missed for the selected chats.
+
+    Each chat is walked oldest-to-newest from its checkpoint (`Chat.backfill_max_id`)
+    in pages; every page is filtered, de-duplicated against stored rows and
+    bulk-inserted in the same transaction that advances the checkpoint, so an
+    interrupted run resumes where it stopped. A chat that was never backfilled
+    starts from its newest message stored before startup (`seed_checkpoints`),
+    or `days` back if it has none.
+
+    At most `concurrency` pages are in flight across all chats. A FloodWait parks
+    that user's chats (outside the concurrency slot) for the requested time;
+    live messages never go through here, so they are unaffected.
+    """
+
+    def __init__(self, enabled: bool = True, concurrency: int = 3, page_size: int = 100, days: int = 7, pause: float = 0.2):
+        self.enabled = enabled
+        self.concurrency = concurrency
+        self.page_size = page_size
+        self.days = days
+        self.pause = pause
+        self._sem: Optional[asyncio.Semaphore] = None
+        self._task: Optional[asyncio.Task] = None
+        self._running: Dict[int, asyncio.Task] = {}
+        self._blocked_until: Dict[int, float] = {}
+        self.pages = 0
+        self.fetched = 0
+        self.stored = 0
+        self.flood_waits = 0
+        self.chats_done = 0
+        self.errors = 0
+
+    @classmethod
+    def from_env(cls) -> "Backfill":
+        return cls(
+            enabled=os.getenv(BACKFILL_ENV, "1") not in ("0", "false", "no"),
+            concurrency=int(os.getenv(BACKFILL_CONCURRENCY_ENV, "3")),
+            page_size=int(os.getenv(BACKFILL_PAGE_ENV, "100")),
+            days=int(os.getenv(BACKFILL_DAYS_ENV, "7")),
+            pause=int(os.getenv(BACKFILL_PAUSE_MS_ENV, "200")) / 1000,
+        )
+
+    @property
+    def sem(self) -> asyncio.Semaphore:
+        if self._sem is None:
+            self._sem = asyncio.Semaphore(max(1, self.concurrency))
+        return self._sem
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "running_chats": len(self._running),
+            "chats_done": self.chats_done,
+            "pages": self.pages,
+            "fetched": self.fetched,
+            "stored": self.stored,
+            "flood_waits": self.flood_waits,
+            "errors": self.errors,
+        }
+
+    def start(self):
+        """Catch up every selected chat once the startup warm start has brought the clients up."""
+        if self.enabled and self._task is None:
+            self._task = asyncio.create_task(self._run_startup())
+
+    async def stop(self):
+        tasks = [t for t in [self._task, *self._running.values()] if t is not None and not t.done()]
+        for t in tasks:
+            t.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def _run_startup(self):
+        await warm_start.wait()
+        async with AsyncReadSessionLocal() as db:
+            res = await db.execute(select(Chat.user_id).where(Chat.selected == True).distinct())  # noqa: E712
+            user_ids = res.scalars().all()
+        for user_id in user_ids:
+            await self.run_user(user_id)
+
+    def schedule(self, user_id: int):
+        """Backfill a user's selected chats in the background (e.g. after the selection changed)."""
+        if self.enabled:
+            asyncio.create_task(self.run_user(user_id))
+
+    async def run_user(self, user_id: int):
+        snap = await snapshots.get(user_id)
+        for ref in snap.chats.values():
+            if ref.id not in self._running:
+                task = asyncio.create_task(self._run_chat(user_id, ref.id, ref.chat_id, ref.title))
+                self._running[ref.id] = task
+                task.add_done_callback(lambda _, cid=ref.id: self._running.pop(cid, None))
+
+    async def _run_chat(self, user_id: int, chat_row_id: int, tg_chat_id: int, title: str):
+        try:
+            await self.run_chat(user_id, chat_row_id, tg_chat_id, title)
+            self.chats_done += 1
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self.errors += 1
+            print(f"backfill error (user {user_id}, chat {tg_chat_id}):", e)
+
+    async def run_chat(self, user_id: int, chat_row_id: int, tg_chat_id: int, title: str):
+        checkpoint = await self._checkpoint(chat_row_id)
+        since = datetime.now() - timedelta(days=self.days) if not checkpoint else None
+        while True:
+            wait = self._blocked_until.get(user_id, 0) - time.monotonic()
+            if wait > 0:
+                await asyncio.sleep(wait)
+            async with self.sem:
+                try:
+                    page = await tg_clients.history_page(user_id, tg_chat_id, min_id=checkpoint, since=since, limit=self.page_size)
+                except Exception as e:
+                    seconds = flood_wait_seconds(e)
+                    if seconds is None:
+                        raise
+                    self.flood_waits += 1
+                    self._blocked_until[user_id] = time.monotonic() + seconds
+                    continue
+                # Service and empty messages are filtered out of `messages` but still count here
+                if not page.fetched or page.top_id <= checkpoint:
+                    return
+                snap = await snapshots.get(user_id)
+                if tg_chat_id not in snap.chats:
+                    # Deselected meanwhile
+                    return
+                checkpoint = await self._store(user_id, chat_row_id, tg_chat_id, title, page.messages, page.top_id, snap.filter)
+                since = None
+            if page.fetched < self.page_size:
+                return
+            await asyncio.sleep(self.pause)
+
+    async def seed_checkpoints(self):
+        """Give selected chats that were never backfilled their newest stored message as the
+        checkpoint, before any client is up: once live messages arrive, the newest stored
+        one would lie past the gap and the gap would never be fetched."""
+        if not self.enabled:
+            return
+        newest = (
+            select(func.max(Message.tg_message_id)).where(Message.chat_id == Chat.id).scalar_subquery()
+        )
+        async with AsyncSessionLocal() as db:
+            await db.execute(
+                update(Chat)
+                .where(Chat.selected == True, Chat.backfill_max_id.is_(None))  # noqa: E712
+                .values(backfill_max_id=newest)
+                .execution_options(synchronize_session=False)
+            )
+            with _COMMIT.time():
+                await db.commit()
+
+    @staticmethod
+    async def _checkpoint(chat_row_id: int) -> int:
+        """0 for a chat with nothing to resume from: it starts `days` back instead."""
+        async with AsyncReadSessionLocal() as db:
+            res = await db.execute(select(Chat.backfill_max_id).where(Chat.id == chat_row_id))
+            return res.scalar() or 0
+
+    async def _store(self, user_id: int, chat_row_id: int, tg_chat_id: int, title: str, page: List[dict], top: int, filt: CompiledFilter) -> int:
+        """Write the page's new, accepted messages and advance the checkpoint to `top` in one transaction."""
+        if not page:
+            async with AsyncSessionLocal() as db:
+                await db.execute(update(Chat).where(Chat.id == chat_row_id).values(backfill_max_id=top))
+                with _COMMIT.time():
+                    await db.commit()
+            self.pages += 1
+            return top
+        ids = [m["tg_message_id"] for m in page]
+        async with AsyncSessionLocal() as db:
+            res = await db.execute(
+                select(Message.tg_message_id)
+                .where(Message.chat_id == chat_row_id, Message.tg_message_id.between(min(ids), max(ids)))
+            )
+            stored = set(res.scalars().all())
+            batch = [
+                PendingMessage({
+                    "user_id": user_id,
+                    "chat_id": chat_row_id,
+                    "tg_chat_id": tg_chat_id,
+                    "tg_message_id": m["tg_message_id"],
+                    "date": m["date"],
+                    "sender_name": m["sender_name"],
+                    "text": m["text"],
+                    "passed": ok,
+                }, title, m["raw"])
+                for m, ok in zip(page, filt.passes_many(m["text"] for m in page))
+                if (ok or store_all) and m["tg_message_id"] not in stored
+            ]
+            # Live ingestion may store the same message meanwhile; the unique index drops the second copy
+            written = sum(1 for mid in await write_messages(db, batch) if mid is not None) if batch else 0
+            await db.execute(update(Chat).where(Chat.id == chat_row_id).values(backfill_max_id=top))
+            with _COMMIT.time():
+                await db.commit()
+        if written:
+            # Older messages under new, higher ids: the buffered feed no longer lines up
+            recent.invalidate(user_id)
+        self.pages += 1
+        self.fetched += len(page)
+        self.stored += written
+        return top
+
+backfill = Backfill.from_env()
+metrics.stats_callbacks("backfill", backfill.stats, counters=("chats_done", "pages", "fetched", "stored", "flood_waits", "errors"))
@@ -1,18 +1,31 @@
+import logging
+from functools import partial
 from typing import List, Optional
 from fastapi import APIRouter, Depends, Request, Form, WebSocket, WebSocketDisconnect
-from fastapi.responses import HTMLResponse, RedirectResponse, JSONResponse
+from fastapi.responses import FileResponse, HTMLResponse, RedirectResponse, JSONResponse
 from fastapi.templating import Jinja2Templates
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy import select, update
-from .db import get_db
-from .models import User, Chat, Message, FilterSetting
+from .db import get_db, get_read_db, AsyncReadSessionLocal
+from .models import User, Chat, Message, MessageRaw, FilterSetting
 from .schemas import ChatOut, MessageOut, FilterIn, SendMessageIn
 from .telegram_client import tg_clients
 from .ws_manager import ws_manager
-from .filters import passes as filter_passes
+from .snapshots import snapshots
+from .search import search_messages
+from .dialogs import dialog_sync
+from .warmstart import warm_start
+from .outbound import outbound, flood_wait_seconds
+from .backfill import backfill
+from .refilter import refilter
+from .recent import recent, message_frame
+from .ws_protocol import BatchCodec
+from .media import media_cache, cache_key, content_type, downloadable
+from . import raw_extract
 
 router = APIRouter()
 templates = Jinja2Templates(directory="app/templates")
+log = logging.getLogger(__name__)
 
 def require_login(request: Request) -> int:
     uid = request.session.get("user_id")
@@ -21,7 +34,7 @@ def require_login(request: Request) -> int:
     return uid
 
 @router.get("/dashboard", response_class=HTMLResponse)
-async def dashboard(request: Request, db: AsyncSession = Depends(get_db)):
+async def dashboard(request: Request, db: AsyncSession = Depends(get_read_db)):
     uid = request.session.get("user_id")
     if not uid:
         return RedirectResponse("/", status_code=303)
@@ -30,33 +43,21 @@ async def dashboard(request: Request, db: AsyncSession = Depends(get_db)):
     return templates.TemplateResponse("dashboard.html", {"request": request, "user": user})
 
 @router.get("/select_chats", response_class=HTMLResponse)
-async def select_chats_page(request: Request, db: AsyncSession = Depends(get_db)):
+async def select_chats_page(request: Request, db: AsyncSession = Depends(get_read_db)):
     uid = request.session.get("user_id")
     if not uid:
         return RedirectResponse("/", status_code=303)
-    # Ensure client
-    res = await db.execute(select(User).where(User.id == uid))
-    user = res.scalars().first()
-    client = await tg_clients.get_or_create(db, user)
-    # Fetch dialogs
-    dialogs = await tg_clients.fetch_dialogs(client)
-    # Upsert chats into DB
-    from sqlalchemy import select as _select
-    res2 = await db.execute(_select(Chat).where(Chat.user_id == uid))
-    existing = {c.chat_id: c for c in res2.scalars().all()}
-    for d in dialogs:
-        cid = d.chat.id
-        title = d.chat.title or (d.chat.first_name or "")
-        ctype = str(d.chat.type)
-        if cid in existing:
-            row = existing[cid]
-            row.title = title
-            row.chat_type = ctype
-        else:
-            db.add(Chat(user_id=uid, chat_id=cid, title=title, chat_type=ctype, selected=False))
-    await db.commit()
-    res3 = await db.execute(_select(Chat).where(Chat.user_id == uid))
-    chats = res3.scalars().all()
+    # Served from the chats table; Telegram is only asked for what changed, in the background
+    res = await db.execute(select(Chat).where(Chat.user_id == uid).order_by(Chat.id))
+    chats = res.scalars().all()
+    if not chats:
+        # First visit: nothing cached yet, so fetch inline once
+        await db.rollback()
+        await dialog_sync.refresh(uid)
+        res = await db.execute(select(Chat).where(Chat.user_id == uid).order_by(Chat.id))
+        chats = res.scalars().all()
+    else:
+        dialog_sync.schedule(uid)
     return templates.TemplateResponse("select_chats.html", {"request": request, "chats": chats})
 
 @router.post("/select_chats")
@@ -71,34 +72,132 @@ async def save_selected_chats(request: Request, db: AsyncSession = Depends(get_d
     if selected_ids:
         await db.execute(update(Chat).where(Chat.user_id == uid, Chat.id.in_(selected_ids)).values(selected=True))
     await db.commit()
+    snapshots.invalidate(uid)
+    # Pull history for newly selected chats
+    backfill.schedule(uid)
     return RedirectResponse(url="/dashboard", status_code=303)
 
+FEED_PAGE_SIZE = 100
+API_MAX_LIMIT = 200
+# Longest /api/send_message?mode=wait may hold the request
+SEND_MAX_WAIT = 60.0
+# Most messages /ws?last_id= replays; a longer gap asks the page to reload instead
+WS_REPLAY_MAX = 500
+
+async def fetch_messages(db: AsyncSession, uid: int, before_id: Optional[int] = None, chat_id: Optional[int] = None, limit: int = FEED_PAGE_SIZE, after_id: Optional[int] = None) -> List[dict]:
+    """Newest-first keyset page of MessageOut-shaped dicts (no ORM objects, no raw_json).
+
+    With `after_id` the page runs oldest-first from just after that id instead.
+    """
+    q = (
+        select(
+            Message.id, Message.tg_message_id, Message.tg_chat_id, Message.chat_id,
+            Chat.title.label("chat_title"), Message.date, Message.sender_name, Message.text, Message.media,
+        )
+        .outerjoin(Chat, Chat.id == Message.chat_id)
+        .where(Message.user_id == uid, Message.passed == True)  # noqa: E712
+    )
+    if chat_id is not None:
+        q = q.where(Message.chat_id == chat_id)
+    if before_id is not None:
+        q = q.where(Message.id < before_id)
+    if after_id is not None:
+        q = q.where(Message.id > after_id).order_by(Message.id)
+    else:
+        q = q.order_by(Message.id.desc())
+    res = await db.execute(q.limit(limit))
+    return [
+        {
+            "id": r.id,
+            "tg_message_id": r.tg_message_id,
+            "tg_chat_id": r.tg_chat_id,
+            "chat_id": r.chat_id,
+            "chat_title": r.chat_title or "",
+            "date": r.date.isoformat() if r.date else "",
+            "sender_name": r.sender_name or "",
+            "text": r.text or "",
+            "media": r.media,
+        }
+        for r in res
+    ]
+
 @router.get("/feed", response_class=HTMLResponse)
-async def feed(request: Request, db: AsyncSession = Depends(get_db)):
+async def feed(request: Request, db: AsyncSession = Depends(get_read_db)):
     uid = request.session.get("user_id")
     if not uid:
         return RedirectResponse("/", status_code=303)
-    # Grab recent messages
-    from sqlalchemy import select as _select
-    res = await db.execute(_select(Message).where(Message.user_id == uid).order_by(Message.id.desc()).limit(100))
-    msgs = list(reversed(res.scalars().all()))
-    return templates.TemplateResponse("feed.html", {"request": request, "messages": msgs})
+    # Grab recent messages; older pages come from /api/messages on scroll
+    msgs = recent.latest(uid, FEED_PAGE_SIZE)
+    if msgs is None:
+        generation = recent.generation(uid)
+        page = await fetch_messages(db, uid)
+        recent.seed(uid, page, generation, complete=len(page) < FEED_PAGE_SIZE)
+        msgs = list(reversed(page))
+    return templates.TemplateResponse("feed.html", {"request": request, "messages": msgs, "page_size": FEED_PAGE_SIZE})
+
+@router.get("/api/messages")
+async def api_messages(request: Request, before_id: Optional[int] = None, chat_id: Optional[int] = None, limit: int = 50, db: AsyncSession = Depends(get_read_db)):
+    uid = request.session.get("user_id")
+    if not uid:
+        return JSONResponse({"ok": False, "error": "not logged in"}, status_code=401)
+    limit = max(1, min(limit, API_MAX_LIMIT))
+    items = await fetch_messages(db, uid, before_id=before_id, chat_id=chat_id, limit=limit)
+    next_before_id = items[-1]["id"] if len(items) == limit else None
+    return JSONResponse({"ok": True, "messages": items, "next_before_id": next_before_id})
+
+@router.get("/api/search")
+async def api_search(request: Request, q: str = "", chat_id: Optional[int] = None, limit: int = 20, offset: int = 0, db: AsyncSession = Depends(get_read_db)):
+    uid = request.session.get("user_id")
+    if not uid:
+        return JSONResponse({"ok": False, "error": "not logged in"}, status_code=401)
+    limit = max(1, min(limit, API_MAX_LIMIT))
+    offset = max(0, offset)
+    items = await search_messages(db, uid, q, chat_id=chat_id, limit=limit, offset=offset)
+    next_offset = offset + limit if len(items) == limit else None
+    return JSONResponse({"ok": True, "results": items, "next_offset": next_offset})
+
+@router.get("/api/clients/status")
+async def api_clients_status(request: Request):
+    uid = request.session.get("user_id")
+    if not uid:
+        return JSONResponse({"ok": False, "error": "not logged in"}, status_code=401)
+    out = {"ok": True, "warm_start": warm_start.status(), "outbound": outbound.stats(), "backfill": backfill.stats()}
+    if hasattr(tg_clients, "stats"):
+        out["workers"] = tg_clients.stats()
+    return JSONResponse(out)
+
+async def _replay(uid: int, last_id: int) -> List[dict]:
+    items = recent.since(uid, last_id)
+    if items is None:
+        async with AsyncReadSessionLocal() as db:
+            items = await fetch_messages(db, uid, after_id=last_id, limit=WS_REPLAY_MAX + 1)
+    if len(items) > WS_REPLAY_MAX:
+        return [{"type": "gap"}]
+    return [message_frame(m) for m in items]
 
 @router.websocket("/ws")
 async def ws_endpoint(websocket: WebSocket):
-    await websocket.accept()
     # Expect cookie-based session user_id in query ?user_id=
     params = dict(websocket.query_params)
     uid = int(params.get("user_id", "0"))
-    await ws_manager.connect(uid, websocket)
+    last_id = params.get("last_id", "")
+    backlog = None
+    if last_id.isdigit():
+        # Reconnect: replay what was published while the page was away
+        backlog = partial(_replay, uid, int(last_id))
+    await ws_manager.connect(uid, websocket, backlog=backlog, codec=BatchCodec.from_params(params))
     try:
         while True:
             await websocket.receive_text()  # Keep alive / ignore
     except WebSocketDisconnect:
+        pass
+    finally:
         ws_manager.disconnect(uid, websocket)
 
 @router.post("/api/send_message")
-async def api_send_message(request: Request, chat_id: int = Form(...), text: str = Form(...), db: AsyncSession = Depends(get_db)):
+async def api_send_message(request: Request, chat_id: int = Form(...), text: str = Form(...), mode: Optional[str] = Form(default=None), timeout: float = Form(default=10.0), db: AsyncSession = Depends(get_read_db)):
+    """Queue a message. `mode=async` answers at once with a job id, `mode=wait` waits up
+    to `timeout` seconds for the outcome; without `mode` (the plain HTML form) redirect to /feed."""
     uid = request.session.get("user_id")
     if not uid:
         return RedirectResponse("/", status_code=303)
@@ -108,11 +207,74 @@ async def api_send_message(request: Request, chat_id: int = Form(...), text: str
     chat = res.scalars().first()
     if not chat:
         return JSONResponse({"ok": False, "error": "chat not found"}, status_code=400)
-    await tg_clients.send_message(uid, chat.chat_id, text)
-    return RedirectResponse(url="/feed", status_code=303)
+    job = outbound.submit(uid, chat.chat_id, text)
+    if job is None:
+        return JSONResponse({"ok": False, "error": "too many queued messages"}, status_code=429)
+    if mode is None:
+        return RedirectResponse(url="/feed", status_code=303)
+    if mode == "wait":
+        await outbound.wait(job, max(0.0, min(timeout, SEND_MAX_WAIT)))
+    out = job.to_dict()
+    if job.status == "failed":
+        return JSONResponse({"ok": False, **out}, status_code=502)
+    return JSONResponse({"ok": True, **out}, status_code=200 if job.status == "sent" else 202)
+
+@router.get("/media/{message_id}")
+async def media(request: Request, message_id: int, thumb: bool = False, db: AsyncSession = Depends(get_read_db)):
+    """A message's photo/document/voice (or, with ?thumb=1, its thumbnail), downloaded on first request.
+    FileResponse answers Range requests, so audio/video can seek and large files resume."""
+    uid = request.session.get("user_id")
+    if not uid:
+        return JSONResponse({"ok": False, "error": "not logged in"}, status_code=401)
+    res = await db.execute(
+        select(Message.tg_chat_id, Message.tg_message_id, MessageRaw.data, User.session_path)
+        .join(MessageRaw, MessageRaw.message_id == Message.id)
+        .join(User, User.id == Message.user_id)
+        .where(Message.id == message_id, Message.user_id == uid)
+    )
+    row = res.first()
+    descriptor = (raw_extract.decode(row.data) or {}).get("media") if row else None
+    file_id = descriptor.get("thumb_file_id" if thumb else "file_id") if downloadable(descriptor) else None
+    key = cache_key(descriptor, thumb) if file_id else None
+    if not key:
+        return JSONResponse({"ok": False, "error": "no media"}, status_code=404)
+    if not thumb and media_cache.too_large(descriptor):
+        return JSONResponse({"ok": False, "error": "file too large"}, status_code=413)
+
+    async def fetch(path: str) -> Optional[str]:
+        await tg_clients.start_user(uid, row.session_path)
+        return await tg_clients.download_media(uid, file_id, path, row.tg_chat_id, row.tg_message_id, thumb)
+
+    try:
+        path = await media_cache.get(key, fetch, thumb)
+    except Exception as e:
+        wait = flood_wait_seconds(e)
+        if wait is not None:
+            return JSONResponse({"ok": False, "error": "rate limited"}, status_code=429, headers={"Retry-After": str(wait)})
+        log.exception("media download for message %s failed", message_id)
+        return JSONResponse({"ok": False, "error": "download failed"}, status_code=502)
+    if path is None:
+        return JSONResponse({"ok": False, "error": "download failed"}, status_code=502)
+    return FileResponse(
+        path,
+        media_type=content_type(descriptor, thumb),
+        filename=None if thumb else descriptor.get("file_name"),
+        content_disposition_type="inline",
+        headers={"Cache-Control": "private, max-age=86400"},
+    )
+
+@router.get("/api/send_status/{job_id}")
+async def api_send_status(request: Request, job_id: str):
+    uid = request.session.get("user_id")
+    if not uid:
+        return JSONResponse({"ok": False, "error": "not logged in"}, status_code=401)
+    job = outbound.get(job_id)
+    if job is None or job.user_id != uid:
+        return JSONResponse({"ok": False, "error": "job not found"}, status_code=404)
+    return JSONResponse({"ok": True, **job.to_dict()})
 
 @router.get("/settings", response_class=HTMLResponse)
-async def settings_page(request: Request, db: AsyncSession = Depends(get_db)):
+async def settings_page(request: Request, db: AsyncSession = Depends(get_read_db)):
     uid = request.session.get("user_id")
     if not uid:
         return RedirectResponse("/", status_code=303)
@@ -120,10 +282,8 @@ async def settings_page(request: Request, db: AsyncSession = Depends(get_db)):
     res = await db.execute(_select(FilterSetting).where(FilterSetting.user_id == uid))
     f = res.scalars().first()
     if not f:
+        # Not persisted here; save_settings creates the row
         f = FilterSetting(user_id=uid, include_keywords="", exclude_keywords="")
-        db.add(f)
-        await db.commit()
-        await db.refresh(f)
     return templates.TemplateResponse("settings.html", {"request": request, "f": f})
 
 @router.post("/settings")
@@ -142,4 +302,7 @@ async def save_settings(request: Request, include_keywords: str = Form(default="
         f.include_keywords = include_keywords
         f.exclude_keywords = exclude_keywords
     await db.commit()
+    snapshots.invalidate(uid)
+    # With STORE_ALL, re-judge stored history against the new keywords
+    refilter.schedule(uid)
     return RedirectResponse(url="/dashboard", status_code=303)
@@ -1,17 +1,173 @@
 import os
+from typing import Callable, List
+from sqlalchemy import event, inspect
+from sqlalchemy.schema import CreateColumn
+from sqlalchemy.pool import AsyncAdaptedQueuePool
 from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncSession
 from sqlalchemy.orm import declarative_base
 from pydantic_settings import BaseSettings
+from . import metrics, pg
+from .media import DOWNLOADABLE_KINDS
 
 class Settings(BaseSettings):
     DATABASE_URL: str = "sqlite+aiosqlite:///./data/app.db"
+    SQLITE_SYNCHRONOUS: str = "NORMAL"
+    SQLITE_BUSY_TIMEOUT_MS: int = 5000
+    SQLITE_MMAP_SIZE: int = 256 * 1024 * 1024
+    SQLITE_CACHE_SIZE_KB: int = 64 * 1024
+    DB_WRITE_POOL_SIZE: int = 1
+    DB_READ_POOL_SIZE: int = 5
+    # PostgreSQL (postgresql+asyncpg://...)
+    DATABASE_READ_URL: str = ""
+    DB_POOL_SIZE: int = 10
+    DB_MAX_OVERFLOW: int = 10
+    DB_POOL_TIMEOUT_SEC: float = 30
+    DB_POOL_RECYCLE_SEC: int = 1800
+    # 0 behind PgBouncer in transaction mode, which can't keep prepared statements per client
+    DB_STATEMENT_CACHE_SIZE: int = 100
+    # Apply pending schema migrations on startup; with several hosts, run `python -m app.migrations schema` once instead
+    DB_AUTO_MIGRATE: bool = True
 
 settings = Settings()
 
-engine = create_async_engine(settings.DATABASE_URL, future=True, echo=False)
+is_sqlite = settings.DATABASE_URL.startswith("sqlite")
+is_postgres = settings.DATABASE_URL.startswith("postgresql")
+
+def _sqlite_pragmas(readonly: bool):
+    def on_connect(dbapi_conn, _record):
+        cur = dbapi_conn.cursor()
+        if not readonly:
+            # Only takes effect on a fresh file; lets retention give pages back without a full VACUUM
+            cur.execute("PRAGMA auto_vacuum=INCREMENTAL")
+            # WAL lets readers run alongside the single writer instead of queueing behind its
+            # commits; the mode is persistent, so readers inherit it from the file
+            cur.execute("PRAGMA journal_mode=WAL")
+        cur.execute(f"PRAGMA synchronous={settings.SQLITE_SYNCHRONOUS}")
+        cur.execute(f"PRAGMA busy_timeout={int(settings.SQLITE_BUSY_TIMEOUT_MS)}")
+        cur.execute(f"PRAGMA mmap_size={int(settings.SQLITE_MMAP_SIZE)}")
+        cur.execute(f"PRAGMA cache_size=-{int(settings.SQLITE_CACHE_SIZE_KB)}")
+        cur.execute("PRAGMA temp_store=MEMORY")
+        if readonly:
+            cur.execute("PRAGMA query_only=ON")
+        cur.close()
+    return on_connect
+
+if is_sqlite:
+    # SQLite allows one writer at a time: keep exactly one writer connection and
+    # a separate pool of query_only connections for pages that only read.
+    engine = create_async_engine(settings.DATABASE_URL, future=True, echo=False, poolclass=AsyncAdaptedQueuePool, pool_size=settings.DB_WRITE_POOL_SIZE, max_overflow=0)
+    read_engine = create_async_engine(settings.DATABASE_URL, future=True, echo=False, poolclass=AsyncAdaptedQueuePool, pool_size=settings.DB_READ_POOL_SIZE, max_overflow=0)
+    event.listen(engine.sync_engine, "connect", _sqlite_pragmas(readonly=False))
+    event.listen(read_engine.sync_engine, "connect", _sqlite_pragmas(readonly=True))
+elif is_postgres:
+    def _pg_engine(url: str):
+        return create_async_engine(
+            url, future=True, echo=False,
+            pool_size=settings.DB_POOL_SIZE,
+            max_overflow=settings.DB_MAX_OVERFLOW,
+            pool_timeout=settings.DB_POOL_TIMEOUT_SEC,
+            # Recycle before server/proxy idle timeouts and check out only live connections
+            pool_recycle=settings.DB_POOL_RECYCLE_SEC,
+            pool_pre_ping=True,
+            connect_args={
+                "statement_cache_size": settings.DB_STATEMENT_CACHE_SIZE,
+                "server_settings": {"application_name": "tg-filter-web"},
+            },
+        )
+    engine = _pg_engine(settings.DATABASE_URL)
+    # A replica for pages that only read, if there is one
+    read_engine = _pg_engine(settings.DATABASE_READ_URL) if settings.DATABASE_READ_URL else engine
+else:
+    engine = create_async_engine(settings.DATABASE_URL, future=True, echo=False)
+    read_engine = engine
+
 AsyncSessionLocal = async_sessionmaker(engine, expire_on_commit=False, class_=AsyncSession)
+AsyncReadSessionLocal = async_sessionmaker(read_engine, expire_on_commit=False, class_=AsyncSession)
 Base = declarative_base()
 
+DB_COMMIT_SECONDS = metrics.histogram("db_commit_seconds", "Commit time of write transactions", ("source",))
+
+# Data fixups that must run on an existing database before new indexes are created
+# (e.g. removing duplicates ahead of a unique index); called with the sync connection.
+pre_index_hooks = []
+
+def add_missing_columns(sync_conn):
+    """ALTER TABLE ... ADD COLUMN for model columns the existing tables lack."""
+    insp = inspect(sync_conn)
+    for table in Base.metadata.sorted_tables:
+        have = {c["name"] for c in insp.get_columns(table.name)}
+        for col in table.columns:
+            if col.name not in have:
+                ddl = CreateColumn(col).compile(dialect=sync_conn.dialect)
+                sync_conn.exec_driver_sql(f"ALTER TABLE {table.name} ADD COLUMN {ddl}")
+
+def create_indexes(sync_conn):
+    for hook in pre_index_hooks:
+        hook(sync_conn)
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(sync_conn, checkfirst=True)
+
+def _baseline(sync_conn):
+    """Every table as of schema versioning. Also brings databases created before it up to
+    date, so it only adds what is missing."""
+    if is_postgres:
+        pg.create_partitioned_messages(sync_conn, Base.metadata)
+        pg.create_fts_index(sync_conn)
+    Base.metadata.create_all(sync_conn)
+    add_missing_columns(sync_conn)
+    create_indexes(sync_conn)
+
+def _unique_tg_message(sync_conn):
+    """Messages are unique per (chat, Telegram message id): replaces the plain backfill index
+    (dropped only afterwards, as the duplicate search in the pre-index hooks uses it)."""
+    create_indexes(sync_conn)
+    sync_conn.exec_driver_sql("DROP INDEX IF EXISTS ix_messages_chat_id_tg_message_id")
+
+def _fts_fold_yo(sync_conn):
+    """Postgres search index folds "ё" into "е", as the SQLite one does."""
+    if is_postgres:
+        pg.create_fts_index(sync_conn, replace=True)
+
+def _media_files_only(sync_conn):
+    """`messages.media` only names kinds /media can serve; web pages, polls etc. recorded
+    before are cleared so the feed stops offering a download for them."""
+    kinds = ", ".join(f"'{k}'" for k in sorted(DOWNLOADABLE_KINDS))
+    sync_conn.exec_driver_sql(f"UPDATE messages SET media = NULL WHERE media IS NOT NULL AND media NOT IN ({kinds})")
+
+# Schema changes, applied in order and recorded in `schema_version`. Append new
+# steps and never edit a shipped one; a fresh database gets the current models
+# from the baseline first, so steps must tolerate what they add already existing.
+SCHEMA_MIGRATIONS: List[Callable] = [_baseline, _unique_tg_message, _fts_fold_yo, _media_files_only]
+SCHEMA_HEAD = len(SCHEMA_MIGRATIONS)
+
+def schema_version(sync_conn) -> int:
+    if not inspect(sync_conn).has_table("schema_version"):
+        return 0
+    return sync_conn.exec_driver_sql("SELECT MAX(version) FROM schema_version").scalar() or 0
+
+def create_schema(sync_conn):
+    """Apply pending SCHEMA_MIGRATIONS (run inside engine.begin(), so each run is one transaction)."""
+    if is_postgres:
+        # Hosts starting together migrate one at a time; the others then find nothing to do
+        sync_conn.exec_driver_sql("SELECT pg_advisory_xact_lock(7212001)")
+    sync_conn.exec_driver_sql("CREATE TABLE IF NOT EXISTS schema_version (version INTEGER NOT NULL)")
+    current = schema_version(sync_conn)
+    for version, step in enumerate(SCHEMA_MIGRATIONS, 1):
+        if version > current:
+            step(sync_conn)
+            sync_conn.exec_driver_sql(f"INSERT INTO schema_version (version) VALUES ({version})")
+
+def check_schema(sync_conn):
+    """For DB_AUTO_MIGRATE=0: refuse to start on a database behind the code."""
+    current = schema_version(sync_conn)
+    if current < SCHEMA_HEAD:
+        raise RuntimeError(f"database schema is at version {current}, code expects {SCHEMA_HEAD}: run `python -m app.migrations schema`")
+
 async def get_db():
     async with AsyncSessionLocal() as session:
         yield session
+
+async def get_read_db():
+    async with AsyncReadSessionLocal() as session:
+        yield session
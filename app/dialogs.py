@@ -0,0 +1,120 @@
+import asyncio
+import os
+import time
+from datetime import datetime, timezone
+from typing import Dict, List, Optional
+from sqlalchemy import select, update
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from .db import AsyncReadSessionLocal, AsyncSessionLocal, is_sqlite
+from .models import Chat, User
+from .snapshots import snapshots
+from .telegram_client import tg_clients
+
+DIALOG_REFRESH_MIN_SEC_ENV = "DIALOG_REFRESH_MIN_SEC"
+DIALOG_FULL_REFRESH_SEC_ENV = "DIALOG_FULL_REFRESH_SEC"
+
+# Rows per INSERT statement; keeps bound parameters well under SQLite's limit
+UPSERT_CHUNK = 500
+
+def dialog_row(user_id: int, d) -> dict:
+    return {
+        "user_id": user_id,
+        "chat_id": d.chat.id,
+        "title": d.chat.title or (d.chat.first_name or ""),
+        "chat_type": str(d.chat.type),
+        "selected": False,
+    }
+
+class DialogSync:
+    """Keeps the `chats` table in step with each user's Telegram dialog list.
+
+    /select_chats renders straight from `chats`; `schedule` refreshes it in the
+    background. A refresh walks `get_dialogs()` (newest activity first) only
+    down to the last sync point and writes with one bulk INSERT ... ON CONFLICT
+    per chunk. Every `full_interval` seconds a refresh walks the whole list so
+    renamed quiet chats get picked up too.
+    """
+
+    def __init__(self, min_interval: float = 60, full_interval: float = 86400):
+        self.min_interval = min_interval
+        self.full_interval = full_interval
+        self._running: Dict[int, asyncio.Task] = {}
+        self._last: Dict[int, float] = {}
+        self._last_full: Dict[int, float] = {}
+
+    @classmethod
+    def from_env(cls) -> "DialogSync":
+        return cls(
+            min_interval=float(os.getenv(DIALOG_REFRESH_MIN_SEC_ENV, "60")),
+            full_interval=float(os.getenv(DIALOG_FULL_REFRESH_SEC_ENV, "86400")),
+        )
+
+    def schedule(self, user_id: int):
+        """Start a background refresh unless one is running or the last one is recent."""
+        if user_id in self._running:
+            return
+        if time.monotonic() - self._last.get(user_id, 0) < self.min_interval:
+            return
+        task = asyncio.create_task(self._run(user_id))
+        self._running[user_id] = task
+        task.add_done_callback(lambda _: self._running.pop(user_id, None))
+
+    async def _run(self, user_id: int):
+        try:
+            await self.refresh(user_id)
+        except Exception as e:
+            print("dialog refresh error:", e)
+
+    async def refresh(self, user_id: int) -> int:
+        """Fetch changed dialogs and upsert them; returns the number of rows written."""
+        running = self._running.get(user_id)
+        if running is not None and running is not asyncio.current_task():
+            await running
+            return 0
+        self._last[user_id] = time.monotonic()
+        async with AsyncReadSessionLocal() as db:
+            res = await db.execute(select(User.session_path, User.dialogs_synced_at).where(User.id == user_id))
+            user = res.first()
+        if user is None:
+            return 0
+        # Starting the client talks to Telegram, so no transaction is open meanwhile
+        client, session_path = await tg_clients.start_user(user_id, user.session_path)
+        # Stored as aware UTC; SQLite hands it back without the offset, Postgres converted
+        since: Optional[datetime] = user.dialogs_synced_at
+        if since is not None and since.tzinfo is None:
+            since = since.replace(tzinfo=timezone.utc)
+        full = since is None or time.monotonic() - self._last_full.get(user_id, 0) > self.full_interval
+        started = datetime.now(timezone.utc)
+        dialogs = await tg_clients.fetch_dialogs(client, since=None if full else since)
+        rows = [dialog_row(user_id, d) for d in dialogs]
+        await self._upsert(rows)
+        values = {"dialogs_synced_at": started}
+        if not user.session_path:
+            values["session_path"] = session_path
+        async with AsyncSessionLocal() as db:
+            await db.execute(update(User).where(User.id == user_id).values(**values))
+            await db.commit()
+        if full:
+            self._last_full[user_id] = time.monotonic()
+        if rows:
+            snapshots.invalidate(user_id)
+        return len(rows)
+
+    @staticmethod
+    async def _upsert(rows: List[dict]):
+        if not rows:
+            return
+        insert = sqlite_insert if is_sqlite else pg_insert
+        async with AsyncSessionLocal() as db:
+            for i in range(0, len(rows), UPSERT_CHUNK):
+                stmt = insert(Chat).values(rows[i:i + UPSERT_CHUNK])
+                # Keep `selected` as the user left it
+                stmt = stmt.on_conflict_do_update(
+                    index_elements=[Chat.user_id, Chat.chat_id],
+                    set_={"title": stmt.excluded.title, "chat_type": stmt.excluded.chat_type},
+                )
+                await db.execute(stmt)
+            await db.commit()
+
+dialog_sync = DialogSync.from_env()
@@ -0,0 +1,249 @@
+import asyncio
+import logging
+import os
+from collections import deque
+from typing import Any, Dict, List, Optional
+from sqlalchemy import insert
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.ext.asyncio import AsyncSession
+from .db import AsyncSessionLocal, DB_COMMIT_SECONDS, is_postgres, is_sqlite
+from .models import Message, MessageRaw
+from . import pg, raw_extract
+from .ws_manager import ws_manager
+from .recent import recent, message_frame
+from .media import downloadable
+from . import metrics
+
+INGEST_MAX_QUEUE_ENV = "INGEST_MAX_QUEUE"
+INGEST_BATCH_SIZE_ENV = "INGEST_BATCH_SIZE"
+INGEST_FLUSH_MS_ENV = "INGEST_FLUSH_MS"
+INGEST_PUT_TIMEOUT_ENV = "INGEST_PUT_TIMEOUT"
+INGEST_RETRIES_ENV = "INGEST_RETRIES"
+INGEST_RETRY_BACKOFF_MS_ENV = "INGEST_RETRY_BACKOFF_MS"
+
+log = logging.getLogger(__name__)
+
+# Incoming message path: lookup/filter/enqueue run per message in the client handler,
+# insert/broadcast per batch in the writer
+STAGE_SECONDS = metrics.histogram("message_stage_seconds", "Time per stage of the incoming message path", ("stage",))
+_INSERT = STAGE_SECONDS.labels("insert")
+_BROADCAST = STAGE_SECONDS.labels("broadcast")
+_COMMIT = DB_COMMIT_SECONDS.labels("ingest")
+
+class PendingMessage:
+    """A message accepted by the handler and waiting to be written.
+
+    `row` holds the `Message` column values; `raw` is the raw_extract dict stored in
+    MessageRaw; `chat_title` only travels along for the WS push.
+    """
+    __slots__ = ("row", "chat_title", "raw")
+
+    def __init__(self, row: Dict[str, Any], chat_title: str, raw: Optional[Dict[str, Any]] = None):
+        media = raw.get("media") if raw else None
+        if downloadable(media):
+            # Kept on the row so the feed knows to offer /media/{id} without reading MessageRaw
+            row.setdefault("media", media["kind"])
+        self.row = row
+        self.chat_title = chat_title
+        self.raw = raw
+
+async def write_messages(db: AsyncSession, batch: List[PendingMessage]) -> List[Optional[int]]:
+    """Bulk-insert messages and their raw extracts in `db` (not committed); returns the new ids
+    in order, None for a message already stored (live ingestion and backfill can both see it).
+
+    One multi-row INSERT ... ON CONFLICT DO NOTHING RETURNING per table; on PostgreSQL,
+    large batches use COPY unless one of their messages is already there.
+    """
+    if is_postgres and len(batch) >= pg.COPY_MIN_ROWS:
+        ids = await pg.copy_messages(db, [p.row for p in batch], [raw_extract.encode(p.raw) if p.raw else None for p in batch])
+        if ids is not None:
+            return ids
+    stmt = (sqlite_insert if is_sqlite else pg_insert)(Message).on_conflict_do_nothing()
+    res = await db.execute(
+        stmt.returning(Message.id, Message.chat_id, Message.tg_message_id),
+        [p.row for p in batch],
+    )
+    # Skipped rows are simply missing from RETURNING, so match the rest up by message
+    inserted: Dict[tuple, deque] = {}
+    for mid, chat_id, tg_message_id in sorted(res):
+        inserted.setdefault((chat_id, tg_message_id), deque()).append(mid)
+    ids: List[Optional[int]] = []
+    for p in batch:
+        left = inserted.get((p.row["chat_id"], p.row["tg_message_id"]))
+        ids.append(left.popleft() if left else None)
+    raws = [{"message_id": mid, "data": raw_extract.encode(p.raw)} for p, mid in zip(batch, ids) if p.raw and mid is not None]
+    if raws:
+        await db.execute(insert(MessageRaw), raws)
+    return ids
+
+class IngestPipeline:
+    """Write-behind queue for incoming messages.
+
+    Handlers `submit` messages; a single writer task group-commits them with one
+    bulk INSERT per batch (flushed by size or time), in its own short-lived session,
+    and only then broadcasts them with their assigned ids (keeping a copy in the
+    recent-message buffer, app/recent.py).
+    """
+
+    def __init__(self, max_queue: int = 10000, batch_size: int = 500, flush_interval: float = 0.05, put_timeout: float = 1.0,
+                 retries: int = 5, retry_backoff: float = 0.1):
+        self.max_queue = max_queue
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.put_timeout = put_timeout
+        self.retries = retries
+        self.retry_backoff = retry_backoff
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+        self.enqueued = 0
+        self.written = 0
+        self.dropped = 0
+        self.failed = 0
+        self.retried = 0
+        self.flushes = 0
+        self.max_depth = 0
+
+    @classmethod
+    def from_env(cls) -> "IngestPipeline":
+        return cls(
+            max_queue=int(os.getenv(INGEST_MAX_QUEUE_ENV, "10000")),
+            batch_size=int(os.getenv(INGEST_BATCH_SIZE_ENV, "500")),
+            flush_interval=int(os.getenv(INGEST_FLUSH_MS_ENV, "50")) / 1000,
+            put_timeout=float(os.getenv(INGEST_PUT_TIMEOUT_ENV, "1.0")),
+            retries=int(os.getenv(INGEST_RETRIES_ENV, "5")),
+            retry_backoff=int(os.getenv(INGEST_RETRY_BACKOFF_MS_ENV, "100")) / 1000,
+        )
+
+    @property
+    def queue(self) -> asyncio.Queue:
+        if self._queue is None:
+            self._queue = asyncio.Queue(maxsize=self.max_queue)
+        return self._queue
+
+    @property
+    def depth(self) -> int:
+        return self._queue.qsize() if self._queue is not None else 0
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "enqueued": self.enqueued,
+            "written": self.written,
+            "dropped": self.dropped,
+            "failed": self.failed,
+            "retried": self.retried,
+            "flushes": self.flushes,
+            "queue_depth": self.depth,
+            "max_queue_depth": self.max_depth,
+        }
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._writer())
+
+    async def stop(self):
+        """Flush whatever is queued and stop the writer."""
+        if self._task is None:
+            return
+        await self.queue.put(None)
+        await self._task
+        self._task = None
+
+    async def submit(self, item: PendingMessage) -> bool:
+        """Queue a message; waits up to `put_timeout` when the queue is full, then drops it."""
+        q = self.queue
+        try:
+            q.put_nowait(item)
+        except asyncio.QueueFull:
+            try:
+                await asyncio.wait_for(q.put(item), self.put_timeout)
+            except asyncio.TimeoutError:
+                self.dropped += 1
+                return False
+        self.enqueued += 1
+        depth = q.qsize()
+        if depth > self.max_depth:
+            self.max_depth = depth
+        return True
+
+    async def _writer(self):
+        q = self.queue
+        loop = asyncio.get_running_loop()
+        stopping = False
+        while not stopping:
+            item = await q.get()
+            if item is None:
+                break
+            batch: List[PendingMessage] = [item]
+            deadline = loop.time() + self.flush_interval
+            while len(batch) < self.batch_size:
+                try:
+                    item = q.get_nowait()
+                except asyncio.QueueEmpty:
+                    timeout = deadline - loop.time()
+                    if timeout <= 0:
+                        break
+                    try:
+                        item = await asyncio.wait_for(q.get(), timeout)
+                    except asyncio.TimeoutError:
+                        break
+                if item is None:
+                    stopping = True
+                    break
+                batch.append(item)
+            await self._flush(batch)
+
+    async def _flush(self, batch: List[PendingMessage]):
+        """Write the batch, retrying a failed transaction (busy database, dropped connection)
+        `retries` times with doubling backoff; the batch is only lost after that."""
+        attempt = 0
+        while True:
+            try:
+                async with AsyncSessionLocal() as db:
+                    with _INSERT.time():
+                        ids = await write_messages(db, batch)
+                    with _COMMIT.time():
+                        await db.commit()
+                break
+            except Exception:
+                if attempt >= self.retries:
+                    self.failed += len(batch)
+                    log.exception("ingest: dropping %d messages after %d attempts", len(batch), attempt + 1)
+                    return
+                delay = min(self.retry_backoff * 2 ** attempt, 5.0)
+                attempt += 1
+                self.retried += 1
+                log.warning("ingest: flush of %d messages failed, retry %d/%d in %.2fs",
+                            len(batch), attempt, self.retries, delay, exc_info=True)
+                await asyncio.sleep(delay)
+        self.flushes += 1
+        self.written += sum(1 for mid in ids if mid is not None)
+        with _BROADCAST.time():
+            await self._broadcast(batch, ids)
+
+    @staticmethod
+    async def _broadcast(batch: List[PendingMessage], ids: List[int]):
+        for p, mid in zip(batch, ids):
+            row = p.row
+            if mid is None or not row.get("passed", True):
+                # Already stored (and pushed) by backfill, or rejected by the filter
+                continue
+            item = {
+                "id": mid,
+                "tg_message_id": row["tg_message_id"],
+                "tg_chat_id": row["tg_chat_id"],
+                "chat_id": row["chat_id"],
+                "chat_title": p.chat_title or "",
+                "date": row["date"].isoformat() if row["date"] else "",
+                "sender_name": row["sender_name"] or "",
+                "text": row["text"] or "",
+                "media": row.get("media"),
+            }
+            recent.append(row["user_id"], item)
+            try:
+                await ws_manager.broadcast(row["user_id"], message_frame(item))
+            except Exception:
+                log.exception("broadcast to user %s failed", row["user_id"])
+
+ingest = IngestPipeline.from_env()
+metrics.stats_callbacks("ingest", ingest.stats, counters=("enqueued", "written", "dropped", "failed", "retried", "flushes"))
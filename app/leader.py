@@ -0,0 +1,73 @@
+import fcntl
+import os
+from typing import Optional
+from .pubsub import WS_BUS_DIR_ENV
+
+BACKGROUND_JOBS_ENV = "BACKGROUND_JOBS"
+
+class JobLeader:
+    """Picks the one process that owns the Telegram clients and runs the
+    startup/background jobs (warm start, backfill, retention) when uvicorn runs
+    several workers. The other workers forward client calls to it
+    (`ClientProxy` in app/tg_workers.py), so a session file is only ever opened
+    by one process.
+
+    `mode` is `auto` (default), `1` (always this process) or `0` (never). In
+    `auto` a single process (the local bus) always leads; with a shared bus the
+    first worker to take an exclusive lock on `<directory>/jobs.lock` does. `1`
+    takes the same lock and refuses to start when another process holds it. The
+    lock is held until the process exits, and a replacement worker started by
+    uvicorn after a crash takes it over. The decision is made once per process.
+    """
+
+    def __init__(self, directory: str = "./data/bus", mode: str = "auto"):
+        self.directory = directory
+        self.mode = mode
+        self._fd: Optional[int] = None
+        self._decided = False
+        self.leader = False
+
+    @classmethod
+    def from_env(cls) -> "JobLeader":
+        return cls(
+            directory=os.getenv(WS_BUS_DIR_ENV, "./data/bus"),
+            mode=os.getenv(BACKGROUND_JOBS_ENV, "auto"),
+        )
+
+    def acquire(self, local_only: bool) -> bool:
+        """Whether this process owns the clients and runs the background jobs."""
+        if self._decided:
+            return self.leader
+        if self.mode == "0":
+            self.leader = False
+        elif local_only:
+            self.leader = True
+        else:
+            self.leader = self._lock()
+            if not self.leader and self.mode == "1":
+                raise RuntimeError(
+                    f"{BACKGROUND_JOBS_ENV}=1 but another process already holds {self.directory}/jobs.lock; "
+                    "only one process may own the Telegram clients"
+                )
+        self._decided = True
+        return self.leader
+
+    def _lock(self) -> bool:
+        os.makedirs(self.directory, exist_ok=True)
+        fd = os.open(os.path.join(self.directory, "jobs.lock"), os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            os.close(fd)
+            return False
+        self._fd = fd
+        return True
+
+    def release(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+        self._decided = False
+        self.leader = False
+
+job_leader = JobLeader.from_env()
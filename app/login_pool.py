@@ -0,0 +1,237 @@
+import asyncio
+import logging
+import os
+import secrets
+import time
+from typing import Dict, Optional, Set
+from pyrogram import Client, raw
+from pyrogram.errors import PasswordHashInvalid, PhoneCodeExpired, PhoneCodeInvalid, SessionPasswordNeeded
+from .telegram_client import API_HASH_ENV, API_ID_ENV, SESSION_DIR_ENV
+from . import metrics
+
+log = logging.getLogger(__name__)
+
+LOGIN_TTL_SEC_ENV = "LOGIN_TTL_SEC"
+LOGIN_POOL_MAX_ENV = "LOGIN_POOL_MAX"
+
+# sign_in outcomes
+OK = "ok"
+PASSWORD_NEEDED = "password_needed"
+INVALID_CODE = "invalid_code"
+INVALID_PASSWORD = "invalid_password"
+NOT_REGISTERED = "not_registered"
+
+class LoginEntry:
+    """A login in progress: the connected client that sent the code and what sign-in needs."""
+
+    def __init__(self, key: str, user_id: int, phone: str, client: Client, session_path: str):
+        self.key = key
+        self.user_id = user_id
+        self.phone = phone
+        self.client = client
+        self.session_path = session_path
+        self.phone_code_hash = ""
+        self.needs_password = False
+        self.me = None
+        self.touched = time.monotonic()
+        self.lock = asyncio.Lock()
+
+class LoginPool:
+    """Keeps the client of each pending login connected between the login steps.
+
+    `start` connects once and sends the code; the code, 2FA and final steps reuse
+    that connection, and the authorized client is handed over with `take` instead
+    of being disconnected and started again. Entries idle longer than `ttl` are
+    disconnected and their session file removed (logged out first if sign-in
+    completed but the client was never taken). Once a new login is adopted,
+    `retire` logs the user's previous session out and deletes its file, so
+    authorized keys don't pile up in SESSION_DIR.
+
+    Everything `resume` needs lives in the (signed) session cookie as well, so a
+    step that lands in another uvicorn worker reconnects from the session file
+    instead of failing the login.
+    """
+
+    def __init__(self, ttl: float = 300, max_size: int = 100):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._entries: Dict[str, LoginEntry] = {}
+        self._reaper: Optional[asyncio.Task] = None
+        self._retiring: Set[asyncio.Task] = set()
+        self.expired = 0
+        self.resumed = 0
+        self.retired = 0
+
+    @classmethod
+    def from_env(cls) -> "LoginPool":
+        return cls(
+            ttl=float(os.getenv(LOGIN_TTL_SEC_ENV, "300")),
+            max_size=int(os.getenv(LOGIN_POOL_MAX_ENV, "100")),
+        )
+
+    def stats(self):
+        return {"pending": len(self._entries), "expired": self.expired, "resumed": self.resumed, "retired": self.retired}
+
+    def start(self):
+        if self._reaper is None:
+            self._reaper = asyncio.create_task(self._reap_loop())
+
+    async def stop(self):
+        if self._reaper is not None:
+            self._reaper.cancel()
+            self._reaper = None
+        for key in list(self._entries):
+            await self.discard(key)
+        if self._retiring:
+            await asyncio.gather(*self._retiring, return_exceptions=True)
+
+    @staticmethod
+    def _client(session_path: str) -> Client:
+        api_id = int(os.getenv(API_ID_ENV, "0"))
+        api_hash = os.getenv(API_HASH_ENV, "")
+        return Client(name=session_path, api_id=api_id, api_hash=api_hash, workdir=os.path.dirname(session_path))
+
+    async def start_login(self, user_id: int, phone: str) -> LoginEntry:
+        """Connect a fresh client and send the code. A fresh session file per attempt, so a
+        half-finished login never shares (or inherits the authorization of) a live session."""
+        for entry in [e for e in self._entries.values() if e.user_id == user_id]:
+            await self.discard(entry.key)
+        while len(self._entries) >= self.max_size:
+            oldest = min(self._entries.values(), key=lambda e: e.touched)
+            await self.discard(oldest.key)
+        key = secrets.token_urlsafe(16)
+        session_dir = os.getenv(SESSION_DIR_ENV, "./data/sessions")
+        os.makedirs(session_dir, exist_ok=True)
+        session_path = os.path.join(session_dir, f"user_{user_id}_login_{key[:8]}")
+        entry = LoginEntry(key, user_id, phone, self._client(session_path), session_path)
+        try:
+            await entry.client.connect()
+            sent = await entry.client.send_code(phone)
+        except Exception:
+            await self._close(entry, remove_session=True)
+            raise
+        entry.phone_code_hash = sent.phone_code_hash
+        self._entries[key] = entry
+        return entry
+
+    def get(self, key: Optional[str]) -> Optional[LoginEntry]:
+        entry = self._entries.get(key) if key else None
+        if entry is not None:
+            entry.touched = time.monotonic()
+        return entry
+
+    async def resume(self, key: str, user_id: int, phone: str, session_path: str, phone_code_hash: str, needs_password: bool) -> LoginEntry:
+        """Rebuild an entry from the cookie's copy, reconnecting from the session file."""
+        entry = LoginEntry(key, user_id, phone, self._client(session_path), session_path)
+        entry.phone_code_hash = phone_code_hash
+        entry.needs_password = needs_password
+        await entry.client.connect()
+        self._entries[key] = entry
+        self.resumed += 1
+        return entry
+
+    async def sign_in(self, entry: LoginEntry, code: str, password: str = "") -> str:
+        async with entry.lock:
+            entry.touched = time.monotonic()
+            if entry.me is not None:
+                return OK
+            if not entry.needs_password:
+                try:
+                    me = await entry.client.sign_in(entry.phone, entry.phone_code_hash, code)
+                except SessionPasswordNeeded:
+                    entry.needs_password = True
+                except (PhoneCodeInvalid, PhoneCodeExpired):
+                    return INVALID_CODE
+                else:
+                    if not me:
+                        # Sign-up required; this app doesn't register new accounts
+                        return NOT_REGISTERED
+                    entry.me = me
+                    return OK
+            if not password:
+                return PASSWORD_NEEDED
+            try:
+                entry.me = await entry.client.check_password(password)
+            except PasswordHashInvalid:
+                return INVALID_PASSWORD
+            return OK
+
+    def take(self, key: str) -> Optional[LoginEntry]:
+        """Remove an entry without disconnecting it; its client now belongs to the caller."""
+        return self._entries.pop(key, None)
+
+    async def discard(self, key: str):
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+        if entry.me is not None:
+            # Signed in here but never handed over: nobody will use this authorization
+            await self._log_out(entry.client)
+            await self._close(entry, remove_session=True)
+            return
+        # A step that landed in another worker may have finished the login from the
+        # same session file (see resume); then it is that user's live session now
+        try:
+            signed_in_elsewhere = entry.client.is_connected and bool(await entry.client.storage.user_id())
+        except Exception:
+            signed_in_elsewhere = False
+        await self._close(entry, remove_session=not signed_in_elsewhere)
+
+    def retire(self, session_path: str):
+        """Log a session that a new login replaced out of Telegram and delete its file, in the background."""
+        task = asyncio.create_task(self._retire(session_path))
+        self._retiring.add(task)
+        task.add_done_callback(self._retiring.discard)
+
+    async def _retire(self, session_path: str):
+        client = self._client(session_path)
+        if not os.path.exists(client.storage.database):
+            return
+        try:
+            if await client.connect():
+                await self._log_out(client)
+        except Exception:
+            # The file goes anyway; the key is then only listed in Telegram's active sessions
+            log.exception("log-out of replaced session %s failed", session_path)
+        finally:
+            try:
+                if client.is_connected:
+                    await client.disconnect()
+            except Exception:
+                pass
+        try:
+            os.remove(client.storage.database)
+        except OSError:
+            pass
+        self.retired += 1
+
+    @staticmethod
+    async def _log_out(client: Client):
+        try:
+            await client.invoke(raw.functions.auth.LogOut())
+        except Exception:
+            pass
+
+    @staticmethod
+    async def _close(entry: LoginEntry, remove_session: bool):
+        try:
+            if entry.client.is_connected:
+                await entry.client.disconnect()
+        except Exception:
+            pass
+        if remove_session:
+            try:
+                os.remove(entry.client.storage.database)
+            except (AttributeError, OSError):
+                pass
+
+    async def _reap_loop(self):
+        while True:
+            await asyncio.sleep(min(30.0, self.ttl / 2))
+            now = time.monotonic()
+            for entry in [e for e in self._entries.values() if now - e.touched > self.ttl]:
+                self.expired += 1
+                await self.discard(entry.key)
+
+login_pool = LoginPool.from_env()
+metrics.stats_callbacks("login_pool", login_pool.stats, counters=("expired", "resumed", "retired"))
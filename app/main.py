@@ -1,5 +1,6 @@
 import os
 from fastapi import FastAPI
+from fastapi.responses import PlainTextResponse
 from fastapi.middleware.cors import CORSMiddleware
 from starlette.middleware.sessions import SessionMiddleware
 from fastapi.staticfiles import StaticFiles
@@ -8,7 +9,19 @@ from fastapi.staticfiles import StaticFiles
 from dotenv import load_dotenv
 load_dotenv()
 
-from .db import engine, Base
+from .db import engine, settings as db_settings, create_schema, check_schema, is_sqlite
+from . import metrics
+from .search import create_fts
+from .ingest import ingest
+from .leader import job_leader
+from .retention import retention
+from .ws_manager import ws_manager
+from .telegram_client import tg_clients, client_server
+from .warmstart import warm_start
+from .outbound import outbound
+from .backfill import backfill
+from .refilter import refilter
+from .login_pool import login_pool
 from .auth_routes import router as auth_router
 from .chat_routes import router as chat_router
 from dotenv import load_dotenv
@@ -37,8 +50,49 @@ app.add_middleware(SessionMiddleware, secret_key=SESSION_SECRET, same_site="lax"
 app.include_router(auth_router)
 app.include_router(chat_router)
 
+@app.get("/metrics")
+async def metrics_endpoint():
+    # Prometheus text exposition; METRICS=0 turns instrumentation off
+    if not metrics.enabled:
+        return PlainTextResponse("metrics disabled\n", status_code=404)
+    return PlainTextResponse(metrics.registry.render(), media_type="text/plain; version=0.0.4")
+
 @app.on_event("startup")
 async def on_startup():
-    # Init DB
+    # Init DB: apply pending schema migrations, or just verify the version when they run separately
     async with engine.begin() as conn:
-        await conn.run_sync(Base.metadata.create_all)
+        await conn.run_sync(create_schema if db_settings.DB_AUTO_MIGRATE else check_schema)
+        if is_sqlite:
+            await conn.run_sync(create_fts)
+    await ws_manager.start()
+    login_pool.start()
+    ingest.start()
+    await tg_clients.start()
+    # With several uvicorn workers one of them owns the clients (the others forward
+    # to it through client_server) and runs the jobs
+    if job_leader.acquire(ws_manager.broker.local_only):
+        if client_server is not None:
+            await client_server.start()
+        retention.start()
+        # Record where each chat's gap starts before live messages can land past it
+        await backfill.seed_checkpoints()
+        # Reconnect saved sessions in the background; HTTP is served meanwhile
+        warm_start.start()
+        # Then fetch whatever the selected chats received while we were down
+        backfill.start()
+
+@app.on_event("shutdown")
+async def on_shutdown():
+    await backfill.stop()
+    await refilter.stop()
+    await login_pool.stop()
+    await warm_start.stop()
+    await outbound.stop()
+    if client_server is not None:
+        await client_server.stop()
+    await tg_clients.stop()
+    await retention.stop()
+    # Flush messages still waiting in the ingestion queue
+    await ingest.stop()
+    await ws_manager.stop()
+    job_leader.release()
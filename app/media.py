@@ -0,0 +1,183 @@
+import asyncio
+import os
+from collections import OrderedDict
+from typing import Awaitable, Callable, Dict, Optional
+from . import metrics
+
+MEDIA_DIR_ENV = "MEDIA_DIR"
+MEDIA_CACHE_MAX_BYTES_ENV = "MEDIA_CACHE_MAX_BYTES"
+MEDIA_MAX_FILE_BYTES_ENV = "MEDIA_MAX_FILE_BYTES"
+MEDIA_CONCURRENCY_ENV = "MEDIA_CONCURRENCY"
+
+MEDIA_DOWNLOAD_SECONDS = metrics.histogram("media_download_seconds", "Time to fetch one media file from Telegram", ("variant",),
+                                           buckets=(0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120))
+
+# Fetches into the given path; returns where the file ended up, or None if nothing was downloaded
+Fetch = Callable[[str], Awaitable[Optional[str]]]
+
+# Media kinds with a file behind them; web pages, polls, locations, contacts, dice
+# etc. have nothing for /media to serve
+DOWNLOADABLE_KINDS = frozenset(("photo", "video", "audio", "voice", "video_note", "document", "animation", "sticker"))
+
+def downloadable(descriptor: Optional[dict]) -> bool:
+    return bool(descriptor) and descriptor.get("kind") in DOWNLOADABLE_KINDS and bool(descriptor.get("file_id"))
+
+def cache_key(descriptor: dict, thumb: bool) -> Optional[str]:
+    """Disk name for a media descriptor from raw_extract: file_unique_id is the same
+    for every copy of a file, across chats and users, so each is stored once."""
+    unique = descriptor.get("file_unique_id")
+    if not unique or any(c in unique for c in "/\\."):
+        return None
+    return f"{unique}-thumb" if thumb else unique
+
+def content_type(descriptor: dict, thumb: bool) -> str:
+    if thumb or descriptor.get("kind") == "photo":
+        return "image/jpeg"
+    return descriptor.get("mime_type") or "application/octet-stream"
+
+class MediaCache:
+    """Size-capped on-disk LRU of media files, filled lazily through the users' clients.
+
+    `get` returns a cached file straight away (refreshing its recency); otherwise it
+    downloads it with the caller's `fetch`, once per key however many requests ask
+    at the same time. Full files take one of `concurrency` download slots;
+    thumbnails don't, so they show up while large files are still downloading.
+    After each download the least recently used files are removed until the
+    cache is within `max_bytes`. Recency survives restarts through file mtimes.
+
+    `directory` is made absolute: Pyrogram resolves relative download paths
+    against the script's directory, not the working directory.
+    """
+
+    def __init__(self, directory: str = "./data/media", max_bytes: int = 2 * 1024 ** 3,
+                 max_file_bytes: int = 512 * 1024 ** 2, concurrency: int = 4):
+        self.directory = os.path.abspath(directory)
+        self.max_bytes = max_bytes
+        self.max_file_bytes = max_file_bytes
+        self.concurrency = concurrency
+        self._index: Optional["OrderedDict[str, int]"] = None
+        self._inflight: Dict[str, asyncio.Future] = {}
+        self._sem: Optional[asyncio.Semaphore] = None
+        self.bytes = 0
+        self.hits = 0
+        self.downloads = 0
+        self.deduplicated = 0
+        self.evicted = 0
+        self.failed = 0
+
+    @classmethod
+    def from_env(cls) -> "MediaCache":
+        return cls(
+            directory=os.getenv(MEDIA_DIR_ENV, "./data/media"),
+            max_bytes=int(os.getenv(MEDIA_CACHE_MAX_BYTES_ENV, str(2 * 1024 ** 3))),
+            max_file_bytes=int(os.getenv(MEDIA_MAX_FILE_BYTES_ENV, str(512 * 1024 ** 2))),
+            concurrency=int(os.getenv(MEDIA_CONCURRENCY_ENV, "4")),
+        )
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "files": len(self._index or ()),
+            "bytes": self.bytes,
+            "hits": self.hits,
+            "downloads": self.downloads,
+            "deduplicated": self.deduplicated,
+            "evicted": self.evicted,
+            "failed": self.failed,
+            "in_flight": len(self._inflight),
+        }
+
+    def too_large(self, descriptor: dict) -> bool:
+        return (descriptor.get("file_size") or 0) > min(self.max_file_bytes, self.max_bytes)
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key)
+
+    def _load(self) -> "OrderedDict[str, int]":
+        if self._index is None:
+            os.makedirs(self.directory, exist_ok=True)
+            files = []
+            for e in os.scandir(self.directory):
+                if not e.is_file():
+                    continue
+                if e.name.endswith(".part"):
+                    # Left over from a download interrupted by a restart
+                    os.remove(e.path)
+                    continue
+                st = e.stat()
+                files.append((st.st_mtime, e.name, st.st_size))
+            self._index = OrderedDict((name, size) for _, name, size in sorted(files))
+            self.bytes = sum(self._index.values())
+        return self._index
+
+    async def get(self, key: str, fetch: Fetch, thumb: bool = False) -> Optional[str]:
+        """Path of the cached file for `key`, downloading it with `fetch` if needed."""
+        index = self._load()
+        path = self._path(key)
+        if key in index:
+            if os.path.exists(path):
+                index.move_to_end(key)
+                self.hits += 1
+                try:
+                    os.utime(path)
+                except OSError:
+                    pass
+                return path
+            self.bytes -= index.pop(key)
+        fut = self._inflight.get(key)
+        if fut is None:
+            fut = asyncio.ensure_future(self._download(key, fetch, thumb))
+            self._inflight[key] = fut
+            fut.add_done_callback(lambda f: self._inflight.get(key) is f and self._inflight.pop(key))
+        else:
+            self.deduplicated += 1
+        # One request giving up must not cancel the download for the others
+        return await asyncio.shield(fut)
+
+    async def _download(self, key: str, fetch: Fetch, thumb: bool) -> Optional[str]:
+        path = self._path(key)
+        part = path + ".part"
+        try:
+            if thumb:
+                with MEDIA_DOWNLOAD_SECONDS.labels("thumb").time():
+                    got = await fetch(part)
+            else:
+                if self._sem is None:
+                    self._sem = asyncio.Semaphore(self.concurrency)
+                async with self._sem:
+                    with MEDIA_DOWNLOAD_SECONDS.labels("file").time():
+                        got = await fetch(part)
+            if not got:
+                self.failed += 1
+                return None
+            os.replace(got, path)
+        except BaseException:
+            self.failed += 1
+            try:
+                os.remove(part)
+            except OSError:
+                pass
+            raise
+        size = os.path.getsize(path)
+        index = self._load()
+        index[key] = size
+        self.bytes += size
+        self.downloads += 1
+        self._evict(keep=key)
+        return path
+
+    def _evict(self, keep: str):
+        index = self._load()
+        while self.bytes > self.max_bytes and len(index) > 1:
+            key = next(iter(index))
+            if key == keep:
+                break
+            self.bytes -= index.pop(key)
+            self.evicted += 1
+            try:
+                # A response still streaming it keeps its open handle
+                os.remove(self._path(key))
+            except OSError:
+                pass
+
+media_cache = MediaCache.from_env()
+metrics.stats_callbacks("media_cache", media_cache.stats, counters=("hits", "downloads", "deduplicated", "evicted", "failed"))
@@ -0,0 +1,239 @@
+"""Minimal Prometheus-style metrics, rendered by GET /metrics.
+
+`METRICS=0` turns every metric into a shared no-op object (and /metrics into a
+404), so instrumented code pays for an attribute lookup and an empty call at
+most. Labels that carry a user id are only added with `METRICS_PER_USER=1`;
+otherwise cardinality stays fixed no matter how many users there are.
+
+Each process keeps its own numbers: with several uvicorn workers every worker
+serves its own /metrics, and with TG_WORKERS the client processes' counters
+are not exported (the supervisor's restart counts are).
+"""
+import bisect
+import os
+import time
+from typing import Callable, Dict, Iterable, List, Sequence, Tuple, Union
+
+METRICS_ENV = "METRICS"
+METRICS_PER_USER_ENV = "METRICS_PER_USER"
+
+enabled = os.getenv(METRICS_ENV, "1") not in ("0", "false", "no")
+per_user = enabled and os.getenv(METRICS_PER_USER_ENV, "0") in ("1", "true", "yes")
+
+# Seconds; tuned for in-process stages (sub-millisecond) up to network round trips
+DEFAULT_BUCKETS = (0.0001, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+LabelValues = Tuple[str, ...]
+CallbackValue = Union[float, Dict[LabelValues, float]]
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+def _labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    parts = [f'{n}="{_escape(str(v))}"' for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+def _num(v: float) -> str:
+    if v == float("inf"):
+        return "+Inf"
+    return repr(float(v)) if isinstance(v, float) and not v.is_integer() else str(int(v))
+
+class _Timer:
+    __slots__ = ("metric", "start")
+
+    def __init__(self, metric):
+        self.metric = metric
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.metric.observe(time.perf_counter() - self.start)
+
+class _Noop:
+    """Stands in for every metric when metrics are off."""
+
+    def labels(self, *values):
+        return self
+
+    def inc(self, amount: float = 1):
+        pass
+
+    def dec(self, amount: float = 1):
+        pass
+
+    def set(self, value: float):
+        pass
+
+    def observe(self, value: float):
+        pass
+
+    def time(self):
+        return _NOOP_TIMER
+
+class _NoopTimer:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+NOOP = _Noop()
+_NOOP_TIMER = _NoopTimer()
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._children: Dict[LabelValues, "_Metric"] = {}
+
+    def labels(self, *values):
+        key = tuple(str(v) for v in values)
+        child = self._children.get(key)
+        if child is None:
+            child = self._children[key] = self._child()
+        return child
+
+    def _child(self):
+        raise NotImplementedError
+
+    def _series(self) -> Iterable[Tuple[LabelValues, "_Metric"]]:
+        if self.labelnames:
+            return list(self._children.items())
+        return [((), self)]
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        for values, child in self._series():
+            lines.extend(child._lines(self.name, self.labelnames, values))
+        return lines
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, help, labelnames)
+        self.value = 0.0
+
+    def _child(self):
+        return Counter(self.name, self.help)
+
+    def inc(self, amount: float = 1):
+        self.value += amount
+
+    def _lines(self, name, labelnames, values):
+        return [f"{name}{_labels(labelnames, values)} {_num(self.value)}"]
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def _child(self):
+        return Gauge(self.name, self.help)
+
+    def dec(self, amount: float = 1):
+        self.value -= amount
+
+    def set(self, value: float):
+        self.value = value
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = (), buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def _child(self):
+        return Histogram(self.name, self.help, buckets=self.buckets)
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def time(self) -> _Timer:
+        return _Timer(self)
+
+    def _lines(self, name, labelnames, values):
+        lines = []
+        acc = 0
+        for le, n in zip((*self.buckets, float("inf")), self.counts):
+            acc += n
+            le_label = 'le="%s"' % _num(le)
+            lines.append(f"{name}_bucket{_labels(labelnames, values, le_label)} {acc}")
+        lines.append(f"{name}_sum{_labels(labelnames, values)} {_num(self.sum)}")
+        lines.append(f"{name}_count{_labels(labelnames, values)} {self.count}")
+        return lines
+
+class _Callback(_Metric):
+    """Value read at scrape time from `fn` — a number, or {label values: number}."""
+
+    def __init__(self, kind: str, name: str, help: str, fn: Callable[[], CallbackValue], labelnames: Sequence[str] = ()):
+        super().__init__(name, help, labelnames)
+        self.kind = kind
+        self.fn = fn
+
+    def render(self) -> List[str]:
+        try:
+            value = self.fn()
+        except Exception:
+            return []
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        items = value.items() if isinstance(value, dict) else [((), value)]
+        for values, v in items:
+            lines.append(f"{self.name}{_labels(self.labelnames, values)} {_num(v)}")
+        return lines
+
+class Registry:
+    def __init__(self) -> None:
+        self._metrics: Dict[str, _Metric] = {}
+
+    def register(self, metric: _Metric) -> _Metric:
+        self._metrics[metric.name] = metric
+        return metric
+
+    def render(self) -> str:
+        lines: List[str] = []
+        for metric in self._metrics.values():
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+registry = Registry()
+
+def counter(name: str, help: str, labelnames: Sequence[str] = ()):
+    return registry.register(Counter(name, help, labelnames)) if enabled else NOOP
+
+def gauge(name: str, help: str, labelnames: Sequence[str] = ()):
+    return registry.register(Gauge(name, help, labelnames)) if enabled else NOOP
+
+def histogram(name: str, help: str, labelnames: Sequence[str] = (), buckets: Sequence[float] = DEFAULT_BUCKETS):
+    return registry.register(Histogram(name, help, labelnames, buckets)) if enabled else NOOP
+
+def callback(kind: str, name: str, help: str, fn: Callable[[], CallbackValue], labelnames: Sequence[str] = ()):
+    """Register a gauge/counter computed on scrape (queue depths, totals kept elsewhere)."""
+    if enabled:
+        registry.register(_Callback(kind, name, help, fn, labelnames))
+
+def stats_callbacks(prefix: str, stats: Callable[[], Dict[str, float]], counters: Iterable[str] = ()):
+    """Export every key of a component's `stats()` dict as `<prefix>_<key>`; keys in `counters` get a `_total` counter."""
+    if not enabled:
+        return
+    counters = set(counters)
+    for key in stats():
+        if key in counters:
+            callback("counter", f"{prefix}_{key}_total", f"{prefix} {key.replace('_', ' ')}", lambda k=key: stats()[k])
+        else:
+            callback("gauge", f"{prefix}_{key}", f"{prefix} {key.replace('_', ' ')}", lambda k=key: stats()[k])
+
+def user_counter(name: str, help: str):
+    """A counter labelled by user_id; a no-op unless METRICS_PER_USER=1."""
+    return counter(name, help, ("user_id",)) if per_user else NOOP
@@ -0,0 +1,88 @@
+"""One-off data migrations for existing databases.
+
+Usage:
+    python -m app.migrations schema [--status]
+    python -m app.migrations raw-json [--vacuum]
+    python -m app.migrations fts-rebuild
+"""
+import argparse
+import asyncio
+from sqlalchemy import select, update, text
+from .db import engine, AsyncSessionLocal, create_schema, is_sqlite, schema_version, SCHEMA_HEAD
+from .models import Message, MessageRaw
+from . import raw_extract
+from .search import rebuild_fts
+
+async def migrate_schema(status_only: bool = False):
+    """Bring the schema to SCHEMA_HEAD (what startup does unless DB_AUTO_MIGRATE=0)."""
+    async with engine.begin() as conn:
+        before = await conn.run_sync(schema_version)
+        if not status_only:
+            await conn.run_sync(create_schema)
+        after = await conn.run_sync(schema_version)
+    await engine.dispose()
+    print(f"schema: version {after} of {SCHEMA_HEAD}" + (f" (was {before})" if after != before else ""))
+
+async def migrate_raw_json(batch: int = 500, vacuum: bool = False) -> int:
+    """Move legacy `messages.raw_json` (str(msg) dumps) into compressed `message_raw` rows.
+
+    The old repr can't be parsed back into fields, so it is kept verbatim under
+    the "legacy" key. Runs in small batches so ingestion keeps going meanwhile.
+    """
+    async with engine.begin() as conn:
+        await conn.run_sync(create_schema)
+    moved = 0
+    while True:
+        async with AsyncSessionLocal() as db:
+            res = await db.execute(
+                select(Message.id, Message.raw_json).where(Message.raw_json.is_not(None)).order_by(Message.id).limit(batch)
+            )
+            rows = res.all()
+            if not rows:
+                break
+            ids = [r.id for r in rows]
+            have = set((await db.execute(select(MessageRaw.message_id).where(MessageRaw.message_id.in_(ids)))).scalars())
+            new = [{"message_id": r.id, "data": raw_extract.encode({"legacy": r.raw_json})} for r in rows if r.id not in have]
+            if new:
+                await db.execute(MessageRaw.__table__.insert(), new)
+            await db.execute(update(Message).where(Message.id.in_(ids)).values(raw_json=None))
+            await db.commit()
+            moved += len(rows)
+            print(f"raw-json: moved {moved}")
+    if vacuum and is_sqlite:
+        # Give the freed pages back to the filesystem
+        async with engine.connect() as conn:
+            conn = await conn.execution_options(isolation_level="AUTOCOMMIT")
+            await conn.execute(text("VACUUM"))
+    return moved
+
+async def fts_rebuild():
+    """Build the full-text index from scratch for messages stored before it existed."""
+    if not is_sqlite:
+        # The Postgres GIN index is over an expression of the row and always current
+        print("fts-rebuild: nothing to do outside SQLite")
+        return
+    async with engine.begin() as conn:
+        await conn.run_sync(create_schema)
+        await conn.run_sync(rebuild_fts)
+    print("fts-rebuild: done")
+
+def main():
+    parser = argparse.ArgumentParser(prog="python -m app.migrations")
+    sub = parser.add_subparsers(dest="cmd", required=True)
+    p = sub.add_parser("schema", help="apply pending schema migrations")
+    p.add_argument("--status", action="store_true", help="only print the current version")
+    p = sub.add_parser("raw-json", help="move legacy raw_json dumps into message_raw")
+    p.add_argument("--batch", type=int, default=500)
+    p.add_argument("--vacuum", action="store_true")
+    sub.add_parser("fts-rebuild", help="rebuild the messages_fts full-text index")
+    args = parser.parse_args()
+    if args.cmd == "schema":
+        asyncio.run(migrate_schema(args.status))
+    elif args.cmd == "raw-json":
+        asyncio.run(migrate_raw_json(args.batch, args.vacuum))
+    elif args.cmd == "fts-rebuild":
+        asyncio.run(fts_rebuild())
+
+if __name__ == "__main__":
+    main()
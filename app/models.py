@@ -1,7 +1,7 @@
-from sqlalchemy import Column, Integer, String, Boolean, DateTime, BigInteger, ForeignKey, Text
-from sqlalchemy.orm import relationship
+from sqlalchemy import Column, Integer, String, Boolean, DateTime, BigInteger, ForeignKey, Text, Index, LargeBinary, text, true
+from sqlalchemy.orm import relationship, deferred
 from sqlalchemy.sql import func
-from .db import Base
+from .db import Base, pre_index_hooks
 
 class User(Base):
     __tablename__ = "users"
@@ -11,6 +11,8 @@ class User(Base):
     first_name = Column(String(128), nullable=True)
     last_name = Column(String(128), nullable=True)
     session_path = Column(String(512), nullable=True)
+    # Newest dialog activity already synced into `chats` (app/dialogs.py)
+    dialogs_synced_at = Column(DateTime(timezone=True), nullable=True)
     created_at = Column(DateTime(timezone=True), server_default=func.now())
 
     chats = relationship("Chat", back_populates="user", cascade="all, delete-orphan")
@@ -19,31 +21,87 @@ class User(Base):
 
 class Chat(Base):
     __tablename__ = "chats"
+    __table_args__ = (
+        # Target of the bulk dialog upsert (INSERT ... ON CONFLICT)
+        Index("ux_chats_user_id_chat_id", "user_id", "chat_id", unique=True),
+    )
     id = Column(Integer, primary_key=True)
     user_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"), index=True)
     chat_id = Column(BigInteger, index=True)
     title = Column(String(255))
     chat_type = Column(String(50))
     selected = Column(Boolean, default=False)
+    # Highest tg_message_id the history backfill has gone through (app/backfill.py)
+    backfill_max_id = Column(BigInteger, nullable=True)
 
     user = relationship("User", back_populates="chats")
     messages = relationship("Message", back_populates="chat", cascade="all, delete-orphan")
 
+def _dedupe_chats(sync_conn):
+    """Merge duplicate (user_id, chat_id) rows left by the old per-row upsert, before the unique index."""
+    dups = sync_conn.execute(text(
+        "SELECT user_id, chat_id, MIN(id) AS keep, MAX(CASE WHEN selected THEN 1 ELSE 0 END) AS selected FROM chats "
+        "GROUP BY user_id, chat_id HAVING COUNT(*) > 1"
+    )).all()
+    for row in dups:
+        params = {"user_id": row.user_id, "chat_id": row.chat_id, "keep": row.keep, "selected": bool(row.selected)}
+        dup_ids = "SELECT id FROM chats WHERE user_id = :user_id AND chat_id = :chat_id AND id != :keep"
+        sync_conn.execute(text(f"UPDATE messages SET chat_id = :keep WHERE chat_id IN ({dup_ids})"), params)
+        sync_conn.execute(text("DELETE FROM chats WHERE user_id = :user_id AND chat_id = :chat_id AND id != :keep"), params)
+        sync_conn.execute(text("UPDATE chats SET selected = :selected WHERE id = :keep"), params)
+
+pre_index_hooks.append(_dedupe_chats)
+
 class Message(Base):
     __tablename__ = "messages"
+    __table_args__ = (
+        # Keyset pagination: newest-first per user, optionally narrowed to one chat
+        Index("ix_messages_user_id_id", "user_id", "id"),
+        Index("ix_messages_user_id_chat_id_id", "user_id", "chat_id", "id"),
+        # Reads only show rows that pass the filter (all rows, unless STORE_ALL is on)
+        Index("ix_messages_user_id_passed_id", "user_id", "passed", "id"),
+        Index("ix_messages_user_id_chat_id_passed_id", "user_id", "chat_id", "passed", "id"),
+        # Backfill: resume point; unique so live ingestion and backfill can't both store a message.
+        # `date` is there because Postgres wants the partition key in unique indexes (a message's
+        # date never changes, so it doesn't weaken the constraint).
+        Index("ux_messages_chat_id_tg_message_id", "chat_id", "tg_message_id", "date", unique=True),
+    )
     id = Column(Integer, primary_key=True)
     user_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"), index=True)
     chat_id = Column(Integer, ForeignKey("chats.id", ondelete="CASCADE"), index=True)
     tg_chat_id = Column(BigInteger, index=True)
     tg_message_id = Column(BigInteger, index=True)
-    date = Column(DateTime(timezone=True))
+    date = Column(DateTime(timezone=True), index=True)
     sender_name = Column(String(255))
     text = Column(Text)
-    raw_json = Column(Text)
+    # Filter verdict; with STORE_ALL rejected messages are kept too and re-evaluated on /settings save
+    passed = Column(Boolean, nullable=False, default=True, server_default=true())
+    # Media kind ("photo", "document", "voice", ...); the descriptor itself is in MessageRaw
+    media = Column(String(16), nullable=True)
+    # Legacy str(msg) dump; new rows keep raw data in MessageRaw (see app/migrations.py)
+    raw_json = deferred(Column(Text))
 
     user = relationship("User", back_populates="messages")
     chat = relationship("Chat", back_populates="messages")
 
+class MessageRaw(Base):
+    """Compressed structured extract of the Telegram message (app/raw_extract.py), kept off the hot row."""
+    __tablename__ = "message_raw"
+    message_id = Column(Integer, ForeignKey("messages.id", ondelete="CASCADE"), primary_key=True)
+    data = Column(LargeBinary)
+
+def _dedupe_messages(sync_conn):
+    """Drop copies of a message stored by both live ingestion and backfill, before the unique index."""
+    dup_ids = (
+        "SELECT m.id FROM messages m WHERE EXISTS (SELECT 1 FROM messages k WHERE k.chat_id = m.chat_id "
+        "AND k.tg_message_id = m.tg_message_id AND k.date = m.date AND k.id < m.id)"
+    )
+    sync_conn.execute(text(f"DELETE FROM message_raw WHERE message_id IN ({dup_ids})"))
+    sync_conn.execute(text(f"DELETE FROM messages WHERE id IN ({dup_ids})"))
+
+# After _dedupe_chats, which can turn messages of merged chats into duplicates
+pre_index_hooks.append(_dedupe_messages)
+
 class FilterSetting(Base):
     __tablename__ = "filter_settings"
     id = Column(Integer, primary_key=True)
@@ -0,0 +1,239 @@
+import asyncio
+import itertools
+import os
+import time
+from collections import OrderedDict, deque
+from typing import Any, Deque, Dict, Optional
+from .telegram_client import tg_clients
+from .ws_manager import ws_manager
+from . import metrics
+
+OUTBOUND_RATE_ENV = "OUTBOUND_RATE"
+OUTBOUND_BURST_ENV = "OUTBOUND_BURST"
+OUTBOUND_MAX_QUEUE_ENV = "OUTBOUND_MAX_QUEUE"
+OUTBOUND_MAX_FLOOD_WAIT_ENV = "OUTBOUND_MAX_FLOOD_WAIT"
+OUTBOUND_MAX_RETRIES_ENV = "OUTBOUND_MAX_RETRIES"
+
+# Telegram errors that carry a "retry after N seconds" value
+FLOOD_ERRORS = ("FloodWait", "SlowmodeWait")
+
+# Finished jobs kept around for status lookups
+JOB_HISTORY = 1000
+
+SEND_SECONDS = metrics.histogram("outbound_send_seconds", "Telegram send_message round trip")
+QUEUE_SECONDS = metrics.histogram("outbound_queue_seconds", "Time from submit to the first send attempt")
+
+QUEUED, SENDING, RETRYING, SENT, FAILED = "queued", "sending", "retrying", "sent", "failed"
+
+def flood_wait_seconds(e: Exception) -> Optional[int]:
+    """Seconds Telegram asked us to wait, for FloodWait-like errors (in-process or from a client worker)."""
+    name = getattr(e, "error_type", "") or type(e).__name__
+    if name in FLOOD_ERRORS:
+        value = getattr(e, "value", None)
+        return int(value) if isinstance(value, (int, float)) else 1
+    return None
+
+class TokenBucket:
+    """`rate` tokens per second, holding at most `burst`."""
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+
+    def delay(self) -> float:
+        """Seconds until a token is available (0 = now)."""
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + max(0.0, now - self.updated) * self.rate)
+        self.updated = max(now, self.updated)
+        wait = self.blocked_until - now
+        if self.tokens < 1:
+            wait = max(wait, (1 - self.tokens) / self.rate)
+        return max(0.0, wait)
+
+    def take(self):
+        self.tokens -= 1
+
+    def block(self, seconds: float):
+        """Telegram said to back off: no tokens until then, and start empty afterwards."""
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+        self.tokens = 0.0
+        self.updated = self.blocked_until
+
+class SendJob:
+    __slots__ = ("id", "user_id", "chat_id", "text", "status", "attempts", "error", "retry_at", "created", "done")
+
+    def __init__(self, job_id: str, user_id: int, chat_id: int, text: str):
+        self.id = job_id
+        self.user_id = user_id
+        self.chat_id = chat_id
+        self.text = text
+        self.status = QUEUED
+        self.attempts = 0
+        self.error: Optional[str] = None
+        self.retry_at: Optional[float] = None
+        self.created = time.time()
+        self.done = asyncio.get_running_loop().create_future()
+
+    def to_dict(self) -> Dict[str, Any]:
+        out = {"job_id": self.id, "chat_id": self.chat_id, "status": self.status, "attempts": self.attempts}
+        if self.error:
+            out["error"] = self.error
+        if self.status == RETRYING and self.retry_at:
+            out["retry_in"] = max(0, round(self.retry_at - time.time(), 1))
+        return out
+
+class _UserQueue:
+    __slots__ = ("jobs", "bucket", "task")
+
+    def __init__(self, bucket: TokenBucket):
+        self.jobs: Deque[SendJob] = deque()
+        self.bucket = bucket
+        self.task: Optional[asyncio.Task] = None
+
+class OutboundQueue:
+    """Per-user outbound message queue.
+
+    Each user has a FIFO, a token bucket and a sender task that exists only while
+    the FIFO is non-empty, so a FloodWait (the bucket is blocked for the period
+    Telegram asks for and the job retried) only delays that user's messages.
+    Status changes are pushed to the user's sockets as `{"type": "send_status"}`.
+    """
+
+    def __init__(self, rate: float = 1.0, burst: int = 3, max_queue: int = 100, max_flood_wait: float = 300, max_retries: int = 5):
+        self.rate = rate
+        self.burst = burst
+        self.max_queue = max_queue
+        self.max_flood_wait = max_flood_wait
+        self.max_retries = max_retries
+        self._users: Dict[int, _UserQueue] = {}
+        self._jobs: "OrderedDict[str, SendJob]" = OrderedDict()
+        self._ids = itertools.count(1)
+        self._prefix = f"{os.getpid():x}-{int(time.time()):x}"
+        self.sent = 0
+        self.failed = 0
+        self.rejected = 0
+        self.flood_waits = 0
+
+    @classmethod
+    def from_env(cls) -> "OutboundQueue":
+        return cls(
+            rate=float(os.getenv(OUTBOUND_RATE_ENV, "1")),
+            burst=int(os.getenv(OUTBOUND_BURST_ENV, "3")),
+            max_queue=int(os.getenv(OUTBOUND_MAX_QUEUE_ENV, "100")),
+            max_flood_wait=float(os.getenv(OUTBOUND_MAX_FLOOD_WAIT_ENV, "300")),
+            max_retries=int(os.getenv(OUTBOUND_MAX_RETRIES_ENV, "5")),
+        )
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "sent": self.sent,
+            "failed": self.failed,
+            "rejected": self.rejected,
+            "flood_waits": self.flood_waits,
+            "queued": sum(len(u.jobs) for u in self._users.values()),
+            "active_users": sum(1 for u in self._users.values() if u.task is not None),
+        }
+
+    def submit(self, user_id: int, chat_id: int, text: str) -> Optional[SendJob]:
+        """Queue a message for sending; None when the user's queue is full."""
+        uq = self._users.get(user_id)
+        if uq is None:
+            uq = self._users[user_id] = _UserQueue(TokenBucket(self.rate, self.burst))
+        if len(uq.jobs) >= self.max_queue:
+            self.rejected += 1
+            return None
+        job = SendJob(f"{self._prefix}-{next(self._ids)}", user_id, chat_id, text)
+        uq.jobs.append(job)
+        self._jobs[job.id] = job
+        while len(self._jobs) > JOB_HISTORY and not self._oldest_pending():
+            self._jobs.popitem(last=False)
+        if uq.task is None:
+            uq.task = asyncio.create_task(self._sender(user_id, uq))
+        self._notify(job)
+        return job
+
+    def _oldest_pending(self) -> bool:
+        return not next(iter(self._jobs.values())).done.done()
+
+    def get(self, job_id: str) -> Optional[SendJob]:
+        return self._jobs.get(job_id)
+
+    async def wait(self, job: SendJob, timeout: float) -> bool:
+        """Wait up to `timeout` seconds for the job to finish; True if it did."""
+        try:
+            await asyncio.wait_for(asyncio.shield(job.done), timeout)
+        except asyncio.TimeoutError:
+            return False
+        return True
+
+    async def stop(self):
+        for uq in self._users.values():
+            if uq.task is not None:
+                uq.task.cancel()
+        for uq in self._users.values():
+            while uq.jobs:
+                self._finish(uq.jobs.popleft(), FAILED, "server shutting down")
+
+    async def _sender(self, user_id: int, uq: _UserQueue):
+        try:
+            while uq.jobs:
+                job = uq.jobs[0]
+                delay = uq.bucket.delay()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                    continue
+                uq.bucket.take()
+                job.status = SENDING
+                job.attempts += 1
+                if job.attempts == 1:
+                    QUEUE_SECONDS.observe(time.time() - job.created)
+                try:
+                    with SEND_SECONDS.time():
+                        await tg_clients.send_message(user_id, job.chat_id, job.text)
+                except Exception as e:
+                    wait = flood_wait_seconds(e)
+                    if wait is None or wait > self.max_flood_wait or job.attempts > self.max_retries:
+                        uq.jobs.popleft()
+                        self._finish(job, FAILED, str(e) or type(e).__name__)
+                        continue
+                    # Keep the job at the head; the bucket holds everything back until then
+                    self.flood_waits += 1
+                    uq.bucket.block(wait)
+                    job.status = RETRYING
+                    job.retry_at = time.time() + wait
+                    self._notify(job)
+                    continue
+                uq.jobs.popleft()
+                self._finish(job, SENT)
+        finally:
+            uq.task = None
+            if not uq.jobs and uq.bucket.delay() == 0 and uq.bucket.tokens >= uq.bucket.burst:
+                # Idle with a full bucket: nothing worth keeping
+                self._users.pop(user_id, None)
+
+    def _finish(self, job: SendJob, status: str, error: Optional[str] = None):
+        job.status = status
+        job.error = error
+        job.retry_at = None
+        if status == SENT:
+            self.sent += 1
+        else:
+            self.failed += 1
+        if not job.done.done():
+            job.done.set_result(status)
+        self._notify(job)
+
+    def _notify(self, job: SendJob):
+        payload = {"type": "send_status", **job.to_dict()}
+        task = asyncio.create_task(ws_manager.broadcast(job.user_id, payload))
+        task.add_done_callback(_log_broadcast_error)
+
+def _log_broadcast_error(task: asyncio.Task):
+    if not task.cancelled() and task.exception() is not None:
+        print("broadcast error:", task.exception())
+
+outbound = OutboundQueue.from_env()
+metrics.stats_callbacks("outbound", outbound.stats, counters=("sent", "failed", "rejected", "flood_waits"))
@@ -0,0 +1,167 @@
+"""PostgreSQL specifics: the time-partitioned `messages` table and COPY ingestion.
+
+`messages` is range-partitioned by `date`, one partition per calendar month
+(`messages_pYYYYMM`, bounds in UTC) plus `messages_default` for anything outside
+the months created so far. Postgres requires the partition key in every unique
+constraint, so the primary key is (id, date) and `message_raw.message_id` can't
+carry a foreign key; rows there are removed together with their partition.
+"""
+import os
+from datetime import datetime, timedelta, timezone
+from typing import List, Optional, Tuple
+from sqlalchemy import MetaData, Table, text
+from sqlalchemy.schema import CreateColumn
+
+PG_PARTITIONS_BACK_ENV = "PG_PARTITIONS_BACK"
+PG_PARTITIONS_AHEAD_ENV = "PG_PARTITIONS_AHEAD"
+DB_COPY_MIN_ROWS_ENV = "DB_COPY_MIN_ROWS"
+
+# Months of partitions kept ready before and after the current one
+PARTITIONS_BACK = int(os.getenv(PG_PARTITIONS_BACK_ENV, "3"))
+PARTITIONS_AHEAD = int(os.getenv(PG_PARTITIONS_AHEAD_ENV, "3"))
+# Ingest batches at least this large go through COPY instead of a multi-row INSERT
+COPY_MIN_ROWS = int(os.getenv(DB_COPY_MIN_ROWS_ENV, "100"))
+
+DEFAULT_PARTITION = "messages_default"
+# Columns the ingest writer fills; everything else keeps its server default
+COPY_COLUMNS = ("id", "user_id", "chat_id", "tg_chat_id", "tg_message_id", "date", "sender_name", "text", "passed", "media")
+
+# Expression behind the GIN index /api/search uses on Postgres. Like the SQLite index,
+# "ё" is folded to "е" (queries get the same translate), as 'simple' doesn't do it.
+FTS_DOCUMENT = "to_tsvector('simple', translate(coalesce(text, '') || ' ' || coalesce(sender_name, ''), 'ёЁ', 'еЕ'))"
+
+_EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+def _month_start(dt: datetime) -> datetime:
+    return datetime(dt.year, dt.month, 1, tzinfo=timezone.utc)
+
+def _next_month(dt: datetime) -> datetime:
+    return _month_start(dt + timedelta(days=32))
+
+def _prev_month(dt: datetime) -> datetime:
+    return _month_start(dt - timedelta(days=1))
+
+def partition_name(month: datetime) -> str:
+    return f"messages_p{month.year}{month.month:02d}"
+
+def _month_of(name: str) -> Optional[datetime]:
+    suffix = name[len("messages_p"):]
+    if not name.startswith("messages_p") or len(suffix) != 6 or not suffix.isdigit():
+        return None
+    return datetime(int(suffix[:4]), int(suffix[4:]), 1, tzinfo=timezone.utc)
+
+def _create_table_sql(table: Table, dialect, primary_key: List[str], foreign_keys: bool, suffix: str = "") -> str:
+    parts = [str(CreateColumn(col).compile(dialect=dialect)) for col in table.columns]
+    parts.append(f"PRIMARY KEY ({', '.join(primary_key)})")
+    if foreign_keys:
+        for fk in table.foreign_keys:
+            ondelete = f" ON DELETE {fk.ondelete}" if fk.ondelete else ""
+            parts.append(f"FOREIGN KEY ({fk.parent.name}) REFERENCES {fk.column.table.name} ({fk.column.name}){ondelete}")
+    return f"CREATE TABLE IF NOT EXISTS {table.name} ({', '.join(parts)}){suffix}"
+
+def create_partitioned_messages(sync_conn, metadata: MetaData):
+    """`messages` (partitioned) and `message_raw` (without the FK), ahead of create_all for the rest."""
+    messages = metadata.tables["messages"]
+    message_raw = metadata.tables["message_raw"]
+    for name in ("users", "chats"):
+        metadata.tables[name].create(sync_conn, checkfirst=True)
+    sync_conn.exec_driver_sql(_create_table_sql(messages, sync_conn.dialect, ["id", "date"], True, " PARTITION BY RANGE (date)"))
+    sync_conn.exec_driver_sql(f"CREATE TABLE IF NOT EXISTS {DEFAULT_PARTITION} PARTITION OF messages DEFAULT")
+    sync_conn.exec_driver_sql(_create_table_sql(message_raw, sync_conn.dialect, ["message_id"], False))
+    ensure_partitions(sync_conn)
+
+def create_fts_index(sync_conn, replace: bool = False):
+    if replace:
+        sync_conn.exec_driver_sql("DROP INDEX IF EXISTS ix_messages_fts")
+    sync_conn.exec_driver_sql(f"CREATE INDEX IF NOT EXISTS ix_messages_fts ON messages USING gin ({FTS_DOCUMENT})")
+
+def ensure_partitions(sync_conn, now: Optional[datetime] = None):
+    """Create the monthly partitions from PARTITIONS_BACK months ago to PARTITIONS_AHEAD ahead.
+
+    Rows that already landed in the default partition for a new month are moved
+    into it (Postgres refuses the new partition while the default holds them).
+    """
+    month = _month_start(now or datetime.now(timezone.utc))
+    for _ in range(PARTITIONS_BACK):
+        month = _prev_month(month)
+    existing = {name for name, _ in list_partitions(sync_conn)}
+    for _ in range(PARTITIONS_BACK + 1 + PARTITIONS_AHEAD):
+        name = partition_name(month)
+        if name not in existing:
+            _add_partition(sync_conn, name, month, _next_month(month))
+        month = _next_month(month)
+
+def _add_partition(sync_conn, name: str, start: datetime, end: datetime):
+    bounds = {"start": start, "end": end}
+    stray = sync_conn.execute(
+        text(f"SELECT 1 FROM {DEFAULT_PARTITION} WHERE date >= :start AND date < :end LIMIT 1"), bounds
+    ).first()
+    values = f"FOR VALUES FROM ('{start.isoformat()}') TO ('{end.isoformat()}')"
+    if stray is None:
+        sync_conn.exec_driver_sql(f"CREATE TABLE IF NOT EXISTS {name} PARTITION OF messages {values}")
+        return
+    sync_conn.exec_driver_sql(f"ALTER TABLE messages DETACH PARTITION {DEFAULT_PARTITION}")
+    sync_conn.exec_driver_sql(f"CREATE TABLE {name} PARTITION OF messages {values}")
+    sync_conn.execute(text(
+        f"WITH moved AS (DELETE FROM {DEFAULT_PARTITION} WHERE date >= :start AND date < :end RETURNING *) "
+        f"INSERT INTO messages SELECT * FROM moved"
+    ), bounds)
+    sync_conn.exec_driver_sql(f"ALTER TABLE messages ATTACH PARTITION {DEFAULT_PARTITION} DEFAULT")
+
+def list_partitions(sync_conn) -> List[Tuple[str, Optional[datetime]]]:
+    """(name, first month) of each partition of `messages`; the default partition has no month."""
+    res = sync_conn.exec_driver_sql(
+        "SELECT c.relname FROM pg_inherits i "
+        "JOIN pg_class c ON c.oid = i.inhrelid JOIN pg_class p ON p.oid = i.inhparent "
+        "WHERE p.relname = 'messages'"
+    )
+    return sorted(((name, _month_of(name)) for (name,) in res), key=lambda p: (p[1] is None, p[1] or _EPOCH))
+
+def drop_partitions_before(sync_conn, cutoff: datetime) -> int:
+    """Drop every monthly partition that ends at or before `cutoff`; returns the rows dropped."""
+    if cutoff.tzinfo is None:
+        cutoff = cutoff.astimezone(timezone.utc)
+    dropped = 0
+    for name, month in list_partitions(sync_conn):
+        if month is None or _next_month(month) > cutoff:
+            continue
+        dropped += sync_conn.exec_driver_sql(f"SELECT count(*) FROM {name}").scalar() or 0
+        sync_conn.exec_driver_sql(f"DELETE FROM message_raw WHERE message_id IN (SELECT id FROM {name})")
+        sync_conn.exec_driver_sql(f"ALTER TABLE messages DETACH PARTITION {name}")
+        sync_conn.exec_driver_sql(f"DROP TABLE {name}")
+    return dropped
+
+async def copy_messages(db, rows: List[dict], raws: List[Optional[bytes]]) -> Optional[List[int]]:
+    """Bulk-load `rows` (Message column dicts) and their encoded raw extracts with COPY, in
+    `db`'s transaction. COPY can't return ids, so they are taken from the sequence first.
+
+    COPY has no ON CONFLICT: if a message is already stored the load is rolled back (to a
+    savepoint) and None returned, for the caller to fall back to INSERT ... ON CONFLICT.
+    """
+    from asyncpg.exceptions import UniqueViolationError
+    conn = await db.connection()
+    res = await conn.execute(
+        text("SELECT nextval(pg_get_serial_sequence('messages', 'id')) FROM generate_series(1, :n)"),
+        {"n": len(rows)},
+    )
+    ids = sorted(res.scalars().all())
+    raw_conn = (await conn.get_raw_connection()).driver_connection
+    savepoint = await conn.begin_nested()
+    try:
+        await raw_conn.copy_records_to_table(
+            "messages",
+            columns=COPY_COLUMNS,
+            records=[
+                (mid, r["user_id"], r["chat_id"], r["tg_chat_id"], r["tg_message_id"], r["date"],
+                 r["sender_name"], r["text"], r.get("passed", True), r.get("media"))
+                for mid, r in zip(ids, rows)
+            ],
+        )
+    except UniqueViolationError:
+        await savepoint.rollback()
+        return None
+    await savepoint.commit()
+    raw_records = [(mid, data) for mid, data in zip(ids, raws) if data]
+    if raw_records:
+        await raw_conn.copy_records_to_table("message_raw", columns=("message_id", "data"), records=raw_records)
+    return ids
@@ -0,0 +1,154 @@
+import asyncio
+import os
+import socket
+import time
+from typing import Callable, List, Optional, Set
+
+WS_BUS_ENV = "WS_BUS"
+WS_BUS_DIR_ENV = "WS_BUS_DIR"
+
+Deliver = Callable[[int, str], None]
+
+class Broker:
+    """Pub/sub backend behind WSManager.
+
+    `publish` takes an already-serialized frame for a user and must not block;
+    the broker calls `deliver(user_id, text)` in every process (including this
+    one) that may hold sockets for that user. `subscribe`/`unsubscribe` are
+    called when a process gains its first / loses its last socket for a user,
+    so a broker with per-user channels (e.g. Redis) only gets relevant traffic.
+    """
+
+    # True when every frame is delivered in this process only, so the caller may
+    # skip serialization entirely for users without local sockets.
+    local_only = False
+
+    def __init__(self) -> None:
+        self._deliver: Optional[Deliver] = None
+        self.published = 0
+        self.received = 0
+        self.dropped = 0
+
+    async def start(self, deliver: Deliver):
+        self._deliver = deliver
+
+    async def stop(self):
+        pass
+
+    def subscribe(self, user_id: int):
+        pass
+
+    def unsubscribe(self, user_id: int):
+        pass
+
+    def publish(self, user_id: int, text: str):
+        raise NotImplementedError
+
+class LocalBroker(Broker):
+    """Single process: deliver straight to this process's sockets."""
+
+    local_only = True
+
+    def publish(self, user_id: int, text: str):
+        self.published += 1
+        if self._deliver is not None:
+            self._deliver(user_id, text)
+
+class UnixSocketBroker(Broker):
+    """Cross-process bus for several uvicorn workers on one host, no external service.
+
+    Every process binds a Unix datagram socket `<dir>/<pid>.sock`. `publish`
+    delivers locally and sends one datagram to each peer socket found in the
+    directory; peers that refuse are stale (dead workers) and get unlinked.
+    Sends are non-blocking: a peer whose receive buffer is full loses the frame
+    (counted in `dropped`) instead of stalling the publisher.
+    """
+
+    PEER_REFRESH = 2.0
+    BUF_SIZE = 1 << 20
+
+    def __init__(self, directory: str):
+        super().__init__()
+        self.directory = directory
+        self.path = os.path.join(directory, f"{os.getpid()}.sock")
+        self._sock: Optional[socket.socket] = None
+        self._peers: Set[str] = set()
+        self._peers_at = 0.0
+
+    async def start(self, deliver: Deliver):
+        await super().start(deliver)
+        os.makedirs(self.directory, exist_ok=True)
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.BUF_SIZE)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, self.BUF_SIZE)
+        sock.bind(self.path)
+        sock.setblocking(False)
+        self._sock = sock
+        asyncio.get_running_loop().add_reader(sock.fileno(), self._on_readable)
+
+    async def stop(self):
+        if self._sock is None:
+            return
+        asyncio.get_running_loop().remove_reader(self._sock.fileno())
+        self._sock.close()
+        self._sock = None
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+
+    def _peer_paths(self) -> List[str]:
+        now = time.monotonic()
+        if now - self._peers_at > self.PEER_REFRESH:
+            try:
+                names = os.listdir(self.directory)
+            except FileNotFoundError:
+                names = []
+            paths = (os.path.join(self.directory, n) for n in names if n.endswith(".sock"))
+            self._peers = {p for p in paths if p != self.path}
+            self._peers_at = now
+        return list(self._peers)
+
+    def publish(self, user_id: int, text: str):
+        self.published += 1
+        if self._deliver is not None:
+            self._deliver(user_id, text)
+        if self._sock is None:
+            return
+        frame = f"{user_id}\n{text}".encode("utf-8")
+        for peer in self._peer_paths():
+            try:
+                self._sock.sendto(frame, peer)
+            except (BlockingIOError, InterruptedError):
+                self.dropped += 1
+            except ConnectionRefusedError:
+                # Socket file left behind by a dead worker
+                self._peers.discard(peer)
+                try:
+                    os.unlink(peer)
+                except OSError:
+                    pass
+            except FileNotFoundError:
+                self._peers.discard(peer)
+            except OSError:
+                # e.g. EMSGSIZE for an oversized frame
+                self.dropped += 1
+
+    def _on_readable(self):
+        while self._sock is not None:
+            try:
+                data = self._sock.recv(self.BUF_SIZE)
+            except (BlockingIOError, InterruptedError):
+                return
+            head, _, body = data.partition(b"\n")
+            self.received += 1
+            if self._deliver is not None:
+                self._deliver(int(head), body.decode("utf-8"))
+
+def broker_from_env() -> Broker:
+    kind = os.getenv(WS_BUS_ENV, "local")
+    if kind == "unix":
+        return UnixSocketBroker(os.getenv(WS_BUS_DIR_ENV, "./data/bus"))
+    return LocalBroker()
@@ -0,0 +1,77 @@
+import json
+import zlib
+from typing import Any, Dict, List, Optional
+
+# Attributes copied from a media object when present
+MEDIA_FIELDS = ("file_id", "file_unique_id", "file_size", "mime_type", "file_name", "duration", "width", "height")
+
+def _ts(dt) -> Optional[int]:
+    return int(dt.timestamp()) if dt else None
+
+def _enum(v) -> Optional[str]:
+    if v is None:
+        return None
+    return getattr(v, "name", None) or str(v)
+
+def _entities(entities) -> Optional[List[List[Any]]]:
+    if not entities:
+        return None
+    out = []
+    for e in entities:
+        item = [_enum(e.type), e.offset, e.length]
+        url = getattr(e, "url", None)
+        if url:
+            item.append(url)
+        out.append(item)
+    return out
+
+def _media(msg) -> Optional[Dict[str, Any]]:
+    kind = _enum(getattr(msg, "media", None))
+    if not kind:
+        return None
+    d: Dict[str, Any] = {"kind": kind.lower()}
+    obj = getattr(msg, kind.lower(), None)
+    if obj is not None:
+        for f in MEDIA_FIELDS:
+            v = getattr(obj, f, None)
+            if v is not None:
+                d[f] = v
+        thumbs = getattr(obj, "thumbs", None)
+        if thumbs:
+            d["thumb_file_id"] = thumbs[0].file_id
+    return d
+
+def _drop_none(d: Dict[str, Any]) -> Dict[str, Any]:
+    return {k: v for k, v in d.items() if v is not None}
+
+def extract(msg) -> Dict[str, Any]:
+    """The parts of a Pyrogram message we keep: ids, sender, reply/forward info, entities, media descriptor."""
+    fu = msg.from_user
+    sc = msg.sender_chat
+    return _drop_none({
+        "id": msg.id,
+        "chat": _drop_none({"id": msg.chat.id, "type": _enum(msg.chat.type)}) if msg.chat else None,
+        "date": _ts(msg.date),
+        "edit_date": _ts(getattr(msg, "edit_date", None)),
+        "from": _drop_none({"id": fu.id, "username": fu.username, "first_name": fu.first_name, "last_name": fu.last_name}) if fu else None,
+        "sender_chat": _drop_none({"id": sc.id, "title": sc.title}) if sc else None,
+        "reply_to": getattr(msg, "reply_to_message_id", None),
+        "reply_top": getattr(msg, "reply_to_top_message_id", None),
+        "fwd_from": getattr(getattr(msg, "forward_from", None), "id", None),
+        "fwd_sender_name": getattr(msg, "forward_sender_name", None),
+        "fwd_chat": getattr(getattr(msg, "forward_from_chat", None), "id", None),
+        "fwd_msg": getattr(msg, "forward_from_message_id", None),
+        "fwd_date": _ts(getattr(msg, "forward_date", None)),
+        "media_group": getattr(msg, "media_group_id", None),
+        "entities": _entities(msg.entities),
+        "caption_entities": _entities(getattr(msg, "caption_entities", None)),
+        "media": _media(msg),
+    })
+
+def encode(data: Dict[str, Any]) -> bytes:
+    return zlib.compress(json.dumps(data, separators=(",", ":"), ensure_ascii=False).encode("utf-8"))
+
+def decode(blob: Optional[bytes]) -> Optional[Dict[str, Any]]:
+    if not blob:
+        return None
+    return json.loads(zlib.decompress(blob).decode("utf-8"))
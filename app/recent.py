@@ -0,0 +1,186 @@
+import os
+from collections import OrderedDict, deque
+from typing import Deque, Dict, List, Optional
+from .ws_manager import ws_manager
+from . import metrics
+
+RECENT_PER_USER_ENV = "RECENT_PER_USER"
+RECENT_MAX_BYTES_ENV = "RECENT_MAX_BYTES"
+
+# Rough per-entry cost of the dict and its small values, on top of the strings
+_ENTRY_OVERHEAD = 400
+
+def _size(item: dict) -> int:
+    return _ENTRY_OVERHEAD + len(item["text"]) + len(item["sender_name"]) + len(item["chat_title"])
+
+def message_frame(item: dict) -> dict:
+    """WS `message` frame for a fetch_messages-shaped item."""
+    return {
+        "type": "message",
+        "id": item["id"],
+        "chat_id": item["chat_id"],
+        "chat_title": item["chat_title"],
+        "sender": item["sender_name"],
+        "text": item["text"],
+        "date": item["date"],
+        "media": item["media"],
+    }
+
+class _Ring:
+    """A user's newest passed messages, oldest first. Holds every passed message with id >= `floor`."""
+    __slots__ = ("items", "floor", "bytes")
+
+    def __init__(self, floor: int):
+        self.items: Deque[dict] = deque()
+        self.floor = floor
+        self.bytes = 0
+
+class RecentBuffer:
+    """Newest passed messages per user, so /feed and WebSocket resume skip the DB.
+
+    The ingest writer appends every message it broadcasts; a `/feed` that had to
+    go to the DB seeds the ring with its page. A ring only answers when it covers
+    the whole request (everything from `floor` up is known to be in it), otherwise
+    the caller falls back to the DB. Writers that insert or re-judge rows outside
+    the ingest path (backfill, refilter, retention) drop the affected rings.
+
+    At most `per_user` messages per user and `max_bytes` in total (estimated);
+    over the total, the least recently used users are dropped first.
+
+    Only the process that ingests a user's messages sees them, so with several
+    uvicorn workers (a non-local WS bus) the buffer stays off.
+    """
+
+    def __init__(self, per_user: int = 200, max_bytes: int = 64 * 1024 * 1024):
+        self.per_user = per_user
+        self.max_bytes = max_bytes
+        self._rings: "OrderedDict[int, _Ring]" = OrderedDict()
+        self._gen: Dict[int, int] = {}
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evicted = 0
+
+    @classmethod
+    def from_env(cls) -> "RecentBuffer":
+        return cls(
+            per_user=int(os.getenv(RECENT_PER_USER_ENV, "200")),
+            max_bytes=int(os.getenv(RECENT_MAX_BYTES_ENV, str(64 * 1024 * 1024))),
+        )
+
+    @property
+    def active(self) -> bool:
+        return self.per_user > 0 and ws_manager.broker.local_only
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "users": len(self._rings),
+            "messages": sum(len(r.items) for r in self._rings.values()),
+            "bytes": self.bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evicted": self.evicted,
+        }
+
+    def generation(self, user_id: int) -> int:
+        """Token for `seed`: a DB read started at this generation may seed the ring."""
+        return self._gen.get(user_id, 0)
+
+    def latest(self, user_id: int, limit: int) -> Optional[List[dict]]:
+        """The `limit` newest messages, oldest first, or None when the ring can't tell."""
+        ring = self._rings.get(user_id) if self.active else None
+        if ring is None or (len(ring.items) < limit and ring.floor > 0):
+            self.misses += 1
+            return None
+        self._rings.move_to_end(user_id)
+        self.hits += 1
+        items = list(ring.items)
+        return items[-limit:] if limit < len(items) else items
+
+    def since(self, user_id: int, after_id: int) -> Optional[List[dict]]:
+        """Messages with id > `after_id`, oldest first, or None when some may be older than the ring."""
+        ring = self._rings.get(user_id) if self.active else None
+        if ring is None or after_id + 1 < ring.floor:
+            self.misses += 1
+            return None
+        self._rings.move_to_end(user_id)
+        self.hits += 1
+        return [m for m in ring.items if m["id"] > after_id]
+
+    def append(self, user_id: int, item: dict):
+        """A message just committed by the ingest writer (ids arrive in increasing order)."""
+        if not self.active:
+            return
+        ring = self._rings.get(user_id)
+        if ring is None:
+            # Nothing older is known, but everything from here on will be
+            ring = self._rings[user_id] = _Ring(item["id"])
+            self._gen[user_id] = self._gen.get(user_id, 0) + 1
+        elif ring.items and item["id"] <= ring.items[-1]["id"]:
+            # Already there: a /feed read saw the row before the writer got here
+            return
+        self._push(ring, item)
+        self._rings.move_to_end(user_id)
+        self._shrink(ring)
+
+    def seed(self, user_id: int, items: List[dict], generation: int, complete: bool):
+        """Fill in from a newest-first DB page read at `generation`; `complete` if it holds all of the user's messages."""
+        if not self.active or not items or self._gen.get(user_id, 0) != generation:
+            return
+        ring = self._rings.get(user_id)
+        if ring is None:
+            ring = self._rings[user_id] = _Ring(items[-1]["id"])
+            for item in reversed(items):
+                self._push(ring, item)
+        else:
+            # The ring existed before the read started, so the page reaches up to its floor
+            older = [m for m in items if m["id"] < ring.floor]
+            for item in older:
+                ring.items.appendleft(item)
+                ring.bytes += _size(item)
+                self.bytes += _size(item)
+            if older:
+                ring.floor = items[-1]["id"]
+        if complete:
+            ring.floor = 0
+        self._rings.move_to_end(user_id)
+        self._shrink(ring)
+
+    def invalidate(self, user_id: int):
+        self._gen[user_id] = self._gen.get(user_id, 0) + 1
+        ring = self._rings.pop(user_id, None)
+        if ring is not None:
+            self.bytes -= ring.bytes
+
+    def clear(self):
+        for user_id in list(self._rings):
+            self.invalidate(user_id)
+
+    def _push(self, ring: _Ring, item: dict):
+        ring.items.append(item)
+        size = _size(item)
+        ring.bytes += size
+        self.bytes += size
+
+    def _drop_oldest(self, ring: _Ring):
+        item = ring.items.popleft()
+        size = _size(item)
+        ring.bytes -= size
+        self.bytes -= size
+        ring.floor = ring.items[0]["id"] if ring.items else item["id"] + 1
+
+    def _shrink(self, ring: _Ring):
+        while len(ring.items) > self.per_user:
+            self._drop_oldest(ring)
+        while self.bytes > self.max_bytes and len(self._rings) > 1:
+            user_id, lru = next(iter(self._rings.items()))
+            if lru is ring:
+                break
+            self.evicted += 1
+            self.invalidate(user_id)
+        # A single user over the whole budget keeps only what fits
+        while self.bytes > self.max_bytes and ring.items:
+            self._drop_oldest(ring)
+
+recent = RecentBuffer.from_env()
+metrics.stats_callbacks("recent", recent.stats, counters=("hits", "misses", "evicted"))
@@ -0,0 +1,109 @@
+import asyncio
+import os
+from typing import Dict, Optional
+from sqlalchemy import bindparam, select
+from .db import AsyncSessionLocal
+from .models import Message
+from .recent import recent
+from .snapshots import snapshots
+from .ws_manager import ws_manager
+from . import metrics
+
+STORE_ALL_ENV = "STORE_ALL"
+REFILTER_CHUNK_ENV = "REFILTER_CHUNK"
+REFILTER_PAUSE_MS_ENV = "REFILTER_PAUSE_MS"
+
+# Keep every message from selected chats with its verdict in `messages.passed`,
+# instead of dropping what the filter rejects
+store_all = os.getenv(STORE_ALL_ENV, "0") in ("1", "true", "yes")
+
+class Refilter:
+    """Re-applies a user's filter to their stored messages after /settings is saved.
+
+    Walks the user's rows in id order, `chunk` at a time, runs the compiled
+    filter over the texts and rewrites `passed` only where the verdict changed;
+    each chunk is its own short transaction followed by a pause, so the writer
+    is never held for long and the total cost is one pass over the user's rows.
+    Saving again while a pass is running restarts it with the new filter.
+    """
+
+    def __init__(self, chunk: int = 2000, pause: float = 0.02):
+        self.chunk = chunk
+        self.pause = pause
+        self._running: Dict[int, asyncio.Task] = {}
+        self.passes = 0
+        self.scanned = 0
+        self.changed = 0
+
+    @classmethod
+    def from_env(cls) -> "Refilter":
+        return cls(
+            chunk=int(os.getenv(REFILTER_CHUNK_ENV, "2000")),
+            pause=int(os.getenv(REFILTER_PAUSE_MS_ENV, "20")) / 1000,
+        )
+
+    def stats(self) -> Dict[str, int]:
+        return {"running": len(self._running), "passes": self.passes, "scanned": self.scanned, "changed": self.changed}
+
+    def schedule(self, user_id: int):
+        if not store_all:
+            return
+        running = self._running.get(user_id)
+        if running is not None:
+            running.cancel()
+        task = asyncio.create_task(self._run(user_id))
+        self._running[user_id] = task
+        task.add_done_callback(lambda t: self._running.pop(user_id, None) if self._running.get(user_id) is t else None)
+
+    async def stop(self):
+        tasks = list(self._running.values())
+        for t in tasks:
+            t.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def _run(self, user_id: int):
+        try:
+            changed = await self.run(user_id)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print("refilter error:", e)
+            return
+        await ws_manager.broadcast(user_id, {"type": "refiltered", "changed": changed})
+
+    async def run(self, user_id: int) -> int:
+        """One pass over the user's messages; returns how many verdicts flipped."""
+        filt = (await snapshots.get(user_id)).filter
+        table = Message.__table__
+        stmt = table.update().where(table.c.id == bindparam("mid")).values(passed=bindparam("verdict"))
+        last_id: Optional[int] = 0
+        changed = 0
+        while True:
+            async with AsyncSessionLocal() as db:
+                res = await db.execute(
+                    select(Message.id, Message.text, Message.passed)
+                    .where(Message.user_id == user_id, Message.id > last_id)
+                    .order_by(Message.id)
+                    .limit(self.chunk)
+                )
+                rows = res.all()
+                if not rows:
+                    break
+                verdicts = filt.passes_many(r.text for r in rows)
+                flips = [{"mid": r.id, "verdict": v} for r, v in zip(rows, verdicts) if bool(r.passed) != v]
+                if flips:
+                    await db.execute(stmt, flips)
+                    await db.commit()
+                    recent.invalidate(user_id)
+            last_id = rows[-1].id
+            self.scanned += len(rows)
+            self.changed += len(flips)
+            changed += len(flips)
+            if len(rows) < self.chunk:
+                break
+            await asyncio.sleep(self.pause)
+        self.passes += 1
+        return changed
+
+refilter = Refilter.from_env()
+metrics.stats_callbacks("refilter", refilter.stats, counters=("passes", "scanned", "changed"))
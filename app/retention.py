@@ -0,0 +1,155 @@
+import asyncio
+import os
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional
+from sqlalchemy import select, delete, text
+from .db import AsyncSessionLocal, engine, is_postgres, is_sqlite
+from .models import Chat, Message, MessageRaw, User
+from .recent import recent
+from . import pg
+
+RETENTION_MAX_AGE_DAYS_ENV = "RETENTION_MAX_AGE_DAYS"
+RETENTION_MAX_PER_CHAT_ENV = "RETENTION_MAX_PER_CHAT"
+RETENTION_MAX_PER_USER_ENV = "RETENTION_MAX_PER_USER"
+RETENTION_INTERVAL_ENV = "RETENTION_INTERVAL_SEC"
+RETENTION_BATCH_ENV = "RETENTION_BATCH"
+RETENTION_PAUSE_MS_ENV = "RETENTION_PAUSE_MS"
+
+class RetentionJob:
+    """Periodically prunes `messages` by age, rows per chat and rows per user.
+
+    A limit of 0 disables that rule. Rows are deleted in batches of `batch`, each in
+    its own short transaction with a pause in between, so the ingestion writer is
+    never locked out for long. Afterwards SQLite pages are reclaimed (incremental
+    vacuum when the file uses auto_vacuum=INCREMENTAL) and the WAL is checkpointed.
+
+    On PostgreSQL the age limit drops whole monthly partitions of `messages` first,
+    leaving only the month straddling the cutoff to delete row by row; each run
+    also creates the partitions for the months ahead (app/pg.py).
+    """
+
+    def __init__(self, max_age_days: int = 0, max_per_chat: int = 0, max_per_user: int = 0,
+                 interval: float = 3600, batch: int = 1000, pause: float = 0.05):
+        self.max_age_days = max_age_days
+        self.max_per_chat = max_per_chat
+        self.max_per_user = max_per_user
+        self.interval = interval
+        self.batch = batch
+        self.pause = pause
+        self._task: Optional[asyncio.Task] = None
+        self.last_report: Dict[str, int] = {}
+
+    @classmethod
+    def from_env(cls) -> "RetentionJob":
+        return cls(
+            max_age_days=int(os.getenv(RETENTION_MAX_AGE_DAYS_ENV, "0")),
+            max_per_chat=int(os.getenv(RETENTION_MAX_PER_CHAT_ENV, "0")),
+            max_per_user=int(os.getenv(RETENTION_MAX_PER_USER_ENV, "0")),
+            interval=float(os.getenv(RETENTION_INTERVAL_ENV, "3600")),
+            batch=int(os.getenv(RETENTION_BATCH_ENV, "1000")),
+            pause=int(os.getenv(RETENTION_PAUSE_MS_ENV, "50")) / 1000,
+        )
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.max_age_days or self.max_per_chat or self.max_per_user)
+
+    def start(self):
+        # Postgres needs the run for partition upkeep even without limits
+        if (self.enabled or is_postgres) and (self._task is None or self._task.done()):
+            self._task = asyncio.create_task(self._loop())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _loop(self):
+        while True:
+            try:
+                await self.run_once()
+            except Exception as e:
+                print("retention error:", e)
+            await asyncio.sleep(self.interval)
+
+    async def run_once(self) -> Dict[str, int]:
+        before = await self._db_bytes()
+        deleted = 0
+        if is_postgres:
+            async with engine.begin() as conn:
+                await conn.run_sync(pg.ensure_partitions)
+        if self.max_age_days:
+            # Pyrogram hands out naive local datetimes, which is what `date` holds
+            cutoff = datetime.now() - timedelta(days=self.max_age_days)
+            if is_postgres:
+                async with engine.begin() as conn:
+                    deleted += await conn.run_sync(pg.drop_partitions_before, cutoff)
+            deleted += await self._delete_where(Message.date < cutoff)
+        if self.max_per_chat:
+            async with AsyncSessionLocal() as db:
+                chats = (await db.execute(select(Chat.user_id, Chat.id))).all()
+            for user_id, chat_id in chats:
+                floor = await self._nth_newest_id(self.max_per_chat, Message.user_id == user_id, Message.chat_id == chat_id)
+                if floor is not None:
+                    deleted += await self._delete_where(Message.user_id == user_id, Message.chat_id == chat_id, Message.id <= floor)
+        if self.max_per_user:
+            async with AsyncSessionLocal() as db:
+                user_ids = (await db.execute(select(User.id))).scalars().all()
+            for user_id in user_ids:
+                floor = await self._nth_newest_id(self.max_per_user, Message.user_id == user_id)
+                if floor is not None:
+                    deleted += await self._delete_where(Message.user_id == user_id, Message.id <= floor)
+        if deleted:
+            # Buffered feeds may still list pruned rows
+            recent.clear()
+            await self._compact()
+        after = await self._db_bytes()
+        self.last_report = {"deleted_rows": deleted, "reclaimed_bytes": max(0, before - after), "db_bytes": after}
+        if deleted:
+            print(f"retention: deleted {deleted} rows, reclaimed {self.last_report['reclaimed_bytes']} bytes")
+        return self.last_report
+
+    async def _nth_newest_id(self, keep: int, *where) -> Optional[int]:
+        """Id of the newest row that falls outside the `keep` newest ones, if any."""
+        async with AsyncSessionLocal() as db:
+            res = await db.execute(select(Message.id).where(*where).order_by(Message.id.desc()).offset(keep).limit(1))
+            return res.scalar()
+
+    async def _delete_where(self, *where) -> int:
+        total = 0
+        while True:
+            async with AsyncSessionLocal() as db:
+                ids: List[int] = (await db.execute(select(Message.id).where(*where).order_by(Message.id).limit(self.batch))).scalars().all()
+                if not ids:
+                    break
+                await db.execute(delete(MessageRaw).where(MessageRaw.message_id.in_(ids)))
+                await db.execute(delete(Message).where(Message.id.in_(ids)))
+                await db.commit()
+            total += len(ids)
+            if len(ids) < self.batch:
+                break
+            # Let the ingestion writer in between batches
+            await asyncio.sleep(self.pause)
+        return total
+
+    async def _compact(self):
+        if not is_sqlite:
+            return
+        async with engine.connect() as conn:
+            raw = await conn.get_raw_connection()
+            # executescript steps the pragma to completion; a plain execute frees a single page
+            await raw.driver_connection.executescript("PRAGMA incremental_vacuum; PRAGMA wal_checkpoint(TRUNCATE);")
+
+    async def _db_bytes(self) -> int:
+        if not is_sqlite:
+            return 0
+        async with AsyncSessionLocal() as db:
+            page_count = (await db.execute(text("PRAGMA page_count"))).scalar() or 0
+            page_size = (await db.execute(text("PRAGMA page_size"))).scalar() or 0
+            return page_count * page_size
+
+retention = RetentionJob.from_env()
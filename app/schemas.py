@@ -22,9 +22,12 @@ class MessageOut(BaseModel):
     id: int
     tg_message_id: int
     tg_chat_id: int
+    chat_id: Optional[int] = None
+    chat_title: Optional[str] = None
     date: str
     sender_name: str
     text: str
+    media: Optional[str] = None
     class Config:
         from_attributes = True
 
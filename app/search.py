@@ -0,0 +1,128 @@
+import html
+import re
+from typing import List, Optional
+from sqlalchemy import text, DateTime
+from sqlalchemy.ext.asyncio import AsyncSession
+from .db import is_postgres
+from .pg import FTS_DOCUMENT
+
+# External-content FTS5 index over messages.text/sender_name, kept in sync by triggers
+# (so inserts from the ingestion writer and deletes from retention need no extra code).
+# unicode61 case-folds Cyrillic as well as Latin, but its diacritics folding is Latin-only,
+# so "ё" is mapped to "е" on the way in (same length, snippets stay aligned) and in queries.
+_FOLD_TEXT = "replace(replace({0}.text, 'ё', 'е'), 'Ё', 'Е')"
+_FOLD_SENDER = "replace(replace({0}.sender_name, 'ё', 'е'), 'Ё', 'Е')"
+
+def _values(row: str) -> str:
+    return f"{row}.id, {_FOLD_TEXT.format(row)}, {_FOLD_SENDER.format(row)}"
+
+FTS_DDL = [
+    """CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(
+        text, sender_name,
+        content='messages', content_rowid='id',
+        tokenize='unicode61 remove_diacritics 2'
+    )""",
+    f"""CREATE TRIGGER IF NOT EXISTS messages_fts_ai AFTER INSERT ON messages BEGIN
+        INSERT INTO messages_fts(rowid, text, sender_name) VALUES ({_values('new')});
+    END""",
+    f"""CREATE TRIGGER IF NOT EXISTS messages_fts_ad AFTER DELETE ON messages BEGIN
+        INSERT INTO messages_fts(messages_fts, rowid, text, sender_name) VALUES ('delete', {_values('old')});
+    END""",
+    f"""CREATE TRIGGER IF NOT EXISTS messages_fts_au AFTER UPDATE OF text, sender_name ON messages BEGIN
+        INSERT INTO messages_fts(messages_fts, rowid, text, sender_name) VALUES ('delete', {_values('old')});
+        INSERT INTO messages_fts(rowid, text, sender_name) VALUES ({_values('new')});
+    END""",
+]
+
+# Snippet markers that can't occur in message text; swapped for <mark> after escaping
+_HL_START = "\x02"
+_HL_END = "\x03"
+_WORD = re.compile(r"\w+", re.UNICODE)
+
+def create_fts(sync_conn):
+    for ddl in FTS_DDL:
+        sync_conn.exec_driver_sql(ddl)
+
+def rebuild_fts(sync_conn):
+    """Re-index every existing message (one-off for databases created before the index)."""
+    create_fts(sync_conn)
+    # Not the built-in 'rebuild': it would index the raw content without the ё folding
+    sync_conn.exec_driver_sql("INSERT INTO messages_fts(messages_fts) VALUES ('delete-all')")
+    sync_conn.exec_driver_sql(f"INSERT INTO messages_fts(rowid, text, sender_name) SELECT {_values('messages')} FROM messages")
+
+def to_match(q: str) -> str:
+    """User input -> FTS5 query: every word must match, as a prefix, with FTS syntax neutralised."""
+    words = _WORD.findall((q or "").replace("ё", "е").replace("Ё", "Е"))
+    return " ".join('"%s"*' % w.replace('"', '""') for w in words)
+
+def _highlight(snippet: str) -> str:
+    return html.escape(snippet or "").replace(_HL_START, "<mark>").replace(_HL_END, "</mark>")
+
+def to_tsquery(q: str) -> str:
+    """User input -> to_tsquery text for Postgres: every word must match, as a prefix.
+    Only word characters survive, so no tsquery syntax gets through."""
+    return " & ".join(f"{w}:*" for w in _WORD.findall(q or ""))
+
+# Postgres: GIN index on FTS_DOCUMENT (app/pg.py); the WHERE must use the same expression
+_PG_SQL = f"""
+    SELECT m.id, m.tg_message_id, m.tg_chat_id, m.chat_id, c.title AS chat_title, m.date, m.sender_name,
+           ts_headline('simple', coalesce(m.text, ''), query, :hl) AS snippet
+    FROM messages m
+    LEFT JOIN chats c ON c.id = m.chat_id
+    CROSS JOIN to_tsquery('simple', translate(:tsquery, 'ёЁ', 'еЕ')) AS query
+    WHERE {FTS_DOCUMENT} @@ query AND m.user_id = :uid AND m.passed
+"""
+
+async def search_messages(db: AsyncSession, uid: int, q: str, chat_id: Optional[int] = None, limit: int = 20, offset: int = 0) -> List[dict]:
+    if is_postgres:
+        return await _search_pg(db, uid, q, chat_id, limit, offset)
+    match = to_match(q)
+    if not match:
+        return []
+    sql = """
+        SELECT m.id, m.tg_message_id, m.tg_chat_id, m.chat_id, c.title AS chat_title, m.date, m.sender_name,
+               snippet(messages_fts, -1, :hs, :he, '…', 16) AS snippet
+        FROM messages_fts
+        JOIN messages m ON m.id = messages_fts.rowid
+        LEFT JOIN chats c ON c.id = m.chat_id
+        WHERE messages_fts MATCH :match AND m.user_id = :uid AND m.passed
+    """
+    params = {"match": match, "uid": uid, "hs": _HL_START, "he": _HL_END, "limit": limit, "offset": offset}
+    if chat_id is not None:
+        sql += " AND m.chat_id = :chat_id"
+        params["chat_id"] = chat_id
+    sql += " ORDER BY bm25(messages_fts) LIMIT :limit OFFSET :offset"
+    # Typed so `date` comes back as a datetime, like the ORM queries
+    res = await db.execute(text(sql).columns(date=DateTime), params)
+    return _results(res)
+
+async def _search_pg(db: AsyncSession, uid: int, q: str, chat_id: Optional[int], limit: int, offset: int) -> List[dict]:
+    tsquery = to_tsquery(q)
+    if not tsquery:
+        return []
+    sql = _PG_SQL
+    params = {
+        "tsquery": tsquery, "uid": uid, "limit": limit, "offset": offset,
+        "hl": f"StartSel={_HL_START}, StopSel={_HL_END}, MaxFragments=1, MaxWords=16, MinWords=5",
+    }
+    if chat_id is not None:
+        sql += " AND m.chat_id = :chat_id"
+        params["chat_id"] = chat_id
+    sql += f" ORDER BY ts_rank({FTS_DOCUMENT}, query) DESC LIMIT :limit OFFSET :offset"
+    res = await db.execute(text(sql).columns(date=DateTime), params)
+    return _results(res)
+
+def _results(res) -> List[dict]:
+    return [
+        {
+            "id": r.id,
+            "tg_message_id": r.tg_message_id,
+            "tg_chat_id": r.tg_chat_id,
+            "chat_id": r.chat_id,
+            "chat_title": r.chat_title or "",
+            "date": r.date.isoformat() if r.date else "",
+            "sender_name": r.sender_name or "",
+            "snippet": _highlight(r.snippet),
+        }
+        for r in res
+    ]
@@ -0,0 +1,72 @@
+import asyncio
+from typing import Callable, Dict, List, NamedTuple, Optional
+from sqlalchemy import select
+from .db import AsyncReadSessionLocal
+from .models import Chat, FilterSetting
+from .filters import CompiledFilter, compile_filter, filter_cache, settings_key
+
+class ChatRef(NamedTuple):
+    id: int
+    chat_id: int
+    title: str
+
+class UserSnapshot:
+    """What the message handler needs per user: selected chats by tg chat_id and the compiled filter."""
+
+    def __init__(self, chats: Dict[int, ChatRef], filter: CompiledFilter):
+        self.chats = chats
+        self.filter = filter
+
+class SnapshotCache:
+    """Per-user in-memory snapshot, loaded lazily and dropped by `invalidate` whenever
+    chat selection or filter settings change, so the hot path does no DB round-trips.
+    Invalidation also drops the user's compiled filter, in this process and (through
+    `listeners`) in the client worker that owns the user."""
+
+    def __init__(self) -> None:
+        self._snaps: Dict[int, UserSnapshot] = {}
+        self._loading: Dict[int, asyncio.Future] = {}
+        self._gen: Dict[int, int] = {}
+        # Called with the user id on every invalidation (e.g. to forward it to client workers)
+        self.listeners: List[Callable[[int], None]] = []
+
+    def peek(self, user_id: int) -> Optional[UserSnapshot]:
+        return self._snaps.get(user_id)
+
+    async def get(self, user_id: int) -> UserSnapshot:
+        snap = self._snaps.get(user_id)
+        if snap is not None:
+            return snap
+        fut = self._loading.get(user_id)
+        if fut is None:
+            fut = asyncio.ensure_future(self._load(user_id))
+            self._loading[user_id] = fut
+            fut.add_done_callback(lambda f: self._loading.get(user_id) is f and self._loading.pop(user_id))
+        return await asyncio.shield(fut)
+
+    async def _load(self, user_id: int) -> UserSnapshot:
+        gen = self._gen.get(user_id, 0)
+        async with AsyncReadSessionLocal() as db:
+            res = await db.execute(
+                select(Chat.id, Chat.chat_id, Chat.title).where(Chat.user_id == user_id, Chat.selected == True)
+            )
+            chats = {row.chat_id: ChatRef(row.id, row.chat_id, row.title or "") for row in res}
+            fres = await db.execute(select(FilterSetting).where(FilterSetting.user_id == user_id))
+            fset = fres.scalars().first()
+        # Don't publish a snapshot (or its compiled filter) that was invalidated while it was loading.
+        if self._gen.get(user_id, 0) != gen:
+            return UserSnapshot(chats, compile_filter(*settings_key(fset)))
+        snap = UserSnapshot(chats, filter_cache.get(user_id, fset))
+        self._snaps[user_id] = snap
+        return snap
+
+    def invalidate(self, user_id: int):
+        # The compiled filter is cached separately and would outlive the snapshot
+        filter_cache.invalidate(user_id)
+        self._gen[user_id] = self._gen.get(user_id, 0) + 1
+        self._snaps.pop(user_id, None)
+        self._loading.pop(user_id, None)
+        for cb in self.listeners:
+            cb(user_id)
+
+snapshots = SnapshotCache()
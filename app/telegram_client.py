@@ -1,54 +1,172 @@
 import asyncio
 import os
-from typing import Dict, Optional, List
-from pyrogram import Client, enums
+from datetime import datetime, timezone
+from typing import Awaitable, Callable, Dict, NamedTuple, Optional, List, Tuple
+from pyrogram import Client, enums, raw, utils
+from pyrogram.errors import FileReferenceExpired, FileReferenceInvalid
+from pyrogram.handlers import DisconnectHandler
 from pyrogram.types import Message as PyroMessage
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy import select, update
-from .models import User, Chat, Message, FilterSetting
-from .filters import passes as filter_passes
+from .models import User, Chat, Message
+from .snapshots import snapshots
+from .ingest import ingest, PendingMessage, STAGE_SECONDS
+from . import metrics, raw_extract
+from .refilter import store_all
+from .leader import job_leader
 from .ws_manager import ws_manager
 
 API_ID_ENV = "TELEGRAM_API_ID"
 API_HASH_ENV = "TELEGRAM_API_HASH"
 SESSION_DIR_ENV = "SESSION_DIR"
+TG_WORKERS_ENV = "TG_WORKERS"
+TG_WORKER_DIR_ENV = "TG_WORKER_DIR"
+
+_LOOKUP = STAGE_SECONDS.labels("lookup")
+_FILTER = STAGE_SECONDS.labels("filter")
+_ENQUEUE = STAGE_SECONDS.labels("enqueue")
+HANDLER_MESSAGES = metrics.counter("tg_handler_messages_total", "Messages seen by the client handler, by outcome", ("result",))
+_UNSELECTED = HANDLER_MESSAGES.labels("unselected")
+_FILTERED = HANDLER_MESSAGES.labels("filtered")
+_ACCEPTED = HANDLER_MESSAGES.labels("accepted")
+_ERRORS = HANDLER_MESSAGES.labels("error")
+CLIENT_STARTS = metrics.counter("tg_client_starts_total", "Client start attempts", ("result",))
+# Pyrogram reconnects by stopping and restarting its session; each stop fires the disconnect handler
+CLIENT_DISCONNECTS = metrics.counter("tg_client_disconnects_total", "Telegram session disconnects (including those followed by a reconnect)")
+USER_DISCONNECTS = metrics.user_counter("tg_client_user_disconnects_total", "Telegram session disconnects per user")
+
+async def start_client(app: Client, connected: bool = False):
+    """Client.start() minus the interactive fallback: a session that is no longer
+    authorized raises instead of prompting for a phone number on stdin. With
+    `connected`, `app` is already connected and signed in (a promoted login client)."""
+    if not connected and not await app.connect():
+        await app.disconnect()
+        raise RuntimeError("Telegram session is not authorized")
+    try:
+        await app.invoke(raw.functions.updates.GetState())
+    except Exception:
+        await app.disconnect()
+        raise
+    app.me = await app.get_me()
+    await app.initialize()
+
+class HistoryPage(NamedTuple):
+    """One GetHistory page. `messages` keeps only what backfill stores; `fetched` and
+    `top_id` count everything Telegram returned (service and empty messages too), so
+    the caller can tell the end of the history and advance past pages with nothing to store."""
+    messages: List[dict]
+    fetched: int
+    top_id: int
+
+def sender_name(msg: PyroMessage) -> str:
+    if msg.from_user:
+        return msg.from_user.first_name
+    return msg.sender_chat.title if msg.sender_chat else "Unknown"
 
 class ClientEntry:
-    def __init__(self, user_id: int, client: Client):
+    def __init__(self, user_id: int, client: Client, session_path: str = ""):
         self.user_id = user_id
         self.client = client
+        self.session_path = session_path
         self.task: Optional[asyncio.Task] = None
 
 class TelegramClientManager:
+    """Runs Pyrogram clients in this process.
+
+    Accepted messages go to `emit` — the ingestion queue by default; a client
+    worker process (app/tg_workers.py) points it at its IPC channel instead.
+    """
+
     def __init__(self):
         self._clients: Dict[int, ClientEntry] = {}
-        self._lock = asyncio.Lock()
+        # Per user, so one client's connect/GetState/get_me doesn't hold up the others
+        self._locks: Dict[int, asyncio.Lock] = {}
+        self.emit: Callable[[PendingMessage], Awaitable] = ingest.submit
+
+    async def start(self):
+        pass
+
+    async def stop(self):
+        for user_id in list(self._clients):
+            await self.sign_out(user_id)
 
     async def get_or_create(self, db: AsyncSession, user: User) -> Client:
-        async with self._lock:
-            if user.id in self._clients:
-                return self._clients[user.id].client
+        app, session_path = await self.start_user(user.id, user.session_path)
+        # ensure we saved path
+        if not user.session_path:
+            user.session_path = session_path
+            await db.commit()
+        return app
+
+    def _lock(self, user_id: int) -> asyncio.Lock:
+        lock = self._locks.get(user_id)
+        if lock is None:
+            lock = self._locks[user_id] = asyncio.Lock()
+        return lock
+
+    async def start_user(self, user_id: int, session_path: Optional[str] = None) -> Tuple[Client, str]:
+        entry = self._clients.get(user_id)
+        if entry is not None and entry.task is not None:
+            return entry.client, entry.session_path
+        # Still starting (or not at all): wait for the start in progress, if any
+        async with self._lock(user_id):
+            if user_id in self._clients:
+                entry = self._clients[user_id]
+                return entry.client, entry.session_path
             api_id = int(os.getenv(API_ID_ENV, "0"))
             api_hash = os.getenv(API_HASH_ENV, "")
             session_dir = os.getenv(SESSION_DIR_ENV, "./data/sessions")
             os.makedirs(session_dir, exist_ok=True)
-            session_name = os.path.join(session_dir, f"user_{user.id}")
+            session_name = os.path.join(session_dir, f"user_{user_id}")
             # Use existing session_path if present
-            session_path = user.session_path or session_name
+            session_path = session_path or session_name
             app = Client(name=session_path, api_id=api_id, api_hash=api_hash, workdir=os.path.dirname(session_path))
-            entry = ClientEntry(user.id, app)
-            self._clients[user.id] = entry
-            await app.start()
-            # ensure we saved path
-            if not user.session_path:
-                user.session_path = session_path
-                await db.commit()
-            # launch listener
-            entry.task = asyncio.create_task(self._listen_loop(user.id, db))
+            await self._launch(user_id, app, session_path)
+            return app, session_path
+
+    async def adopt(self, user_id: int, app: Client, session_path: str) -> Client:
+        """Take over a connected, freshly signed-in client (from the login pool) without reconnecting."""
+        async with self._lock(user_id):
+            old = self._clients.pop(user_id, None)
+            if old is not None:
+                try:
+                    await old.client.stop()
+                except Exception:
+                    pass
+            await self._launch(user_id, app, session_path, connected=True)
             return app
 
+    async def _launch(self, user_id: int, app: Client, session_path: str, connected: bool = False):
+        entry = ClientEntry(user_id, app, session_path)
+        self._clients[user_id] = entry
+        try:
+            await start_client(app, connected=connected)
+        except Exception:
+            self._clients.pop(user_id, None)
+            CLIENT_STARTS.labels("failed").inc()
+            raise
+        CLIENT_STARTS.labels("ok").inc()
+        app.add_handler(DisconnectHandler(lambda _: self._on_disconnect(user_id)))
+        # launch listener
+        entry.task = asyncio.create_task(self._listen_loop(user_id))
+
+    def get_client(self, user_id: int) -> Client:
+        entry = self._clients.get(user_id)
+        if not entry:
+            raise RuntimeError("Client not started")
+        return entry.client
+
+    def client_states(self) -> Dict[str, int]:
+        running = sum(1 for e in self._clients.values() if e.task is not None)
+        return {"running": running, "starting": len(self._clients) - running}
+
+    @staticmethod
+    async def _on_disconnect(user_id: int):
+        CLIENT_DISCONNECTS.inc()
+        USER_DISCONNECTS.labels(user_id).inc()
+
     async def sign_out(self, user_id: int):
-        async with self._lock:
+        async with self._lock(user_id):
             entry = self._clients.get(user_id)
             if entry:
                 try:
@@ -57,7 +175,7 @@ class TelegramClientManager:
                     pass
                 self._clients.pop(user_id, None)
 
-    async def _listen_loop(self, user_id: int, db: AsyncSession):
+    async def _listen_loop(self, user_id: int):
         client = self._clients[user_id].client
         # A polling-like loop using client.get_updates is not available; we register a handler.
         # Since handlers are sync to client's own loop, we just idle.
@@ -65,44 +183,36 @@ class TelegramClientManager:
         async def _handler(_, msg: PyroMessage):
             # Fetch selected chats for this user
             try:
-                # Refresh filter and chat selection from DB
-                from sqlalchemy import select as _select
-                res = await db.execute(_select(Chat).where(Chat.user_id == user_id, Chat.selected == True, Chat.chat_id == msg.chat.id))
-                chat_row = res.scalars().first()
+                with _LOOKUP.time():
+                    snap = await snapshots.get(user_id)
+                    chat_row = snap.chats.get(msg.chat.id)
                 if not chat_row:
+                    _UNSELECTED.inc()
                     return
-                # Filter
-                fres = await db.execute(_select(FilterSetting).where(FilterSetting.user_id == user_id))
-                fset = fres.scalars().first()
                 text = msg.text or msg.caption or ""
-                if fset and not filter_passes(text, fset.include_keywords or "", fset.exclude_keywords or ""):
-                    return
-                # Store message
-                m = Message(
-                    user_id=user_id,
-                    chat_id=chat_row.id,
-                    tg_chat_id=msg.chat.id,
-                    tg_message_id=msg.id,
-                    date=msg.date,
-                    sender_name=(msg.from_user.first_name if msg.from_user else (msg.sender_chat.title if msg.sender_chat else "Unknown")),
-                    text=text,
-                    raw_json=str(msg)
-                )
-                db.add(m)
-                await db.commit()
-                await db.refresh(m)
-                # Push via WS
-                await ws_manager.broadcast(user_id, {
-                    "type": "message",
-                    "id": m.id,
-                    "chat_id": chat_row.id,
-                    "chat_title": chat_row.title,
-                    "sender": m.sender_name,
-                    "text": m.text,
-                    "date": m.date.isoformat() if m.date else ""
-                })
+                with _FILTER.time():
+                    accepted = snap.filter.passes(text)
+                if accepted:
+                    _ACCEPTED.inc()
+                else:
+                    _FILTERED.inc()
+                    if not store_all:
+                        return
+                # Queue for the batched writer; it assigns ids and pushes via WS
+                with _ENQUEUE.time():
+                    await self.emit(PendingMessage({
+                        "user_id": user_id,
+                        "chat_id": chat_row.id,
+                        "tg_chat_id": msg.chat.id,
+                        "tg_message_id": msg.id,
+                        "date": msg.date,
+                        "sender_name": sender_name(msg),
+                        "text": text,
+                        "passed": accepted,
+                    }, chat_row.title, raw_extract.extract(msg)))
             except Exception as e:
                 # Best-effort; don't crash the handler
+                _ERRORS.inc()
                 print("handler error:", e)
 
         # Keep the client alive
@@ -111,18 +221,94 @@ class TelegramClientManager:
         except Exception as e:
             print("idle error:", e)
 
-    async def fetch_dialogs(self, client: Client):
+    async def fetch_dialogs(self, client: Client, since: Optional[datetime] = None):
+        """Dialogs newest-activity first; with `since`, stop at the first one with no newer message."""
+        if since is not None:
+            since = since.astimezone(timezone.utc)
         dialogs = []
         async for dialog in client.get_dialogs():
+            # Pinned dialogs come first regardless of activity, so they never end the walk.
+            # Pyrogram dates are naive local time; astimezone() reads them as such.
+            top = dialog.top_message
+            if since and not dialog.is_pinned and top and top.date and top.date.astimezone(timezone.utc) <= since:
+                break
             if dialog.chat.type not in (enums.ChatType.BOT,):
                 dialogs.append(dialog)
         return dialogs
 
+    async def history_page(self, user_id: int, chat_id: int, min_id: int = 0, since: Optional[datetime] = None, limit: int = 100) -> HistoryPage:
+        """Up to `limit` messages of a chat newer than `min_id` (or, with min_id=0, sent at/after
+        `since`), oldest first, as plain dicts. FloodWait is raised, not slept through."""
+        client = self.get_client(user_id)
+        # add_offset=-limit turns "older than offset" into "the next `limit` from offset on"
+        r = await client.invoke(
+            raw.functions.messages.GetHistory(
+                peer=await client.resolve_peer(chat_id),
+                offset_id=min_id + 1 if min_id else 0,
+                offset_date=0 if min_id or since is None else utils.datetime_to_timestamp(since),
+                add_offset=-limit,
+                limit=limit,
+                max_id=0,
+                min_id=min_id,
+                hash=0,
+            ),
+            sleep_threshold=0,
+        )
+        page = []
+        for msg in await utils.parse_messages(client, r, replies=0):
+            if msg.empty or msg.id <= min_id or msg.service:
+                continue
+            page.append({
+                "tg_message_id": msg.id,
+                "date": msg.date,
+                "sender_name": sender_name(msg),
+                "text": msg.text or msg.caption or "",
+                "raw": raw_extract.extract(msg),
+            })
+        page.sort(key=lambda m: m["tg_message_id"])
+        ids = [m.id for m in r.messages if m.id > min_id]
+        return HistoryPage(page, len(r.messages), max(ids, default=min_id))
+
     async def send_message(self, user_id: int, chat_id: int, text: str):
-        entry = self._clients.get(user_id)
-        if not entry:
-            raise RuntimeError("Client not started")
         # chat_id here is Telegram chat id
-        await entry.client.send_message(chat_id, text)
+        await self.get_client(user_id).send_message(chat_id, text)
+
+    async def download_media(self, user_id: int, file_id: str, path: str, chat_id: int, message_id: int, thumb: bool = False) -> Optional[str]:
+        """Download a stored media descriptor's file (or its thumbnail) to `path`.
+
+        File ids carry a file reference that Telegram expires; on that error the
+        message is fetched again (`chat_id` is the Telegram chat id) for a fresh one.
+        """
+        client = self.get_client(user_id)
+        # Pyrogram puts relative paths under the script's directory, not the working directory
+        path = os.path.abspath(path)
+        try:
+            return await client.download_media(file_id, file_name=path)
+        except (FileReferenceExpired, FileReferenceInvalid):
+            msg = await client.get_messages(chat_id, message_id)
+            media = raw_extract.extract(msg).get("media") if msg and not msg.empty else None
+            fresh = (media or {}).get("thumb_file_id" if thumb else "file_id")
+            if not fresh:
+                raise
+            return await client.download_media(fresh, file_name=path)
+
+def _make_manager():
+    if not job_leader.acquire(ws_manager.broker.local_only):
+        # Another uvicorn worker owns the clients; calls go to it (see app/tg_workers.py)
+        from .tg_workers import ClientProxy, CLIENTS_SOCKET
+        return ClientProxy(os.path.join(job_leader.directory, CLIENTS_SOCKET))
+    workers = int(os.getenv(TG_WORKERS_ENV, "0"))
+    if workers > 0:
+        # Clients run in worker processes; see app/tg_workers.py
+        from .tg_workers import ClientSupervisor
+        return ClientSupervisor(workers, os.getenv(TG_WORKER_DIR_ENV, "./data/tg_workers"))
+    return TelegramClientManager()
 
-tg_clients = TelegramClientManager()
+tg_clients = _make_manager()
+# Set in the owning worker when other uvicorn workers may forward calls to it
+client_server = None
+if job_leader.leader and not ws_manager.broker.local_only:
+    from .tg_workers import ClientServer, CLIENTS_SOCKET
+    client_server = ClientServer(tg_clients, os.path.join(job_leader.directory, CLIENTS_SOCKET))
+metrics.callback("gauge", "tg_clients", "Telegram clients by state (assigned = owned by a client worker)",
+                 lambda: {(k,): v for k, v in tg_clients.client_states().items()}, ("state",))
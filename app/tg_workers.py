@@ -0,0 +1,605 @@
+"""Pyrogram clients sharded across worker processes.
+
+With TG_WORKERS=N (N > 0) the web process no longer runs Pyrogram itself: a
+`ClientSupervisor` spawns N client-worker processes and assigns users to them
+by consistent hashing on the user id. Each worker runs a regular
+`TelegramClientManager`; the messages it accepts (already filtered against
+the worker's own snapshot) are forwarded to the web tier, which feeds them to
+the ingestion queue. The web tier sends `start`/`stop`/`send_message`/
+`fetch_dialogs`/`invalidate` commands the other way. If a worker dies its
+users move to the remaining workers and the worker is respawned.
+
+With several uvicorn workers only one of them owns the clients (see
+app/leader.py). It serves its manager on `<WS_BUS_DIR>/clients.sock`
+(`ClientServer`), and the other workers use a `ClientProxy` in place of a
+manager, so every session file is opened by one process only. Invalidations
+travel the same way, so the owner's handler sees /settings saved elsewhere.
+
+IPC is a Unix stream socket served by the supervisor (or the owning worker),
+carrying length-prefixed pickles (both ends are our own processes).
+"""
+import asyncio
+import bisect
+import hashlib
+import itertools
+import multiprocessing as mp
+import os
+import pickle
+import signal
+import struct
+from datetime import datetime
+from types import SimpleNamespace
+from typing import TYPE_CHECKING, Any, Dict, List, Optional, Set, Tuple
+from sqlalchemy.ext.asyncio import AsyncSession
+from .ingest import ingest, PendingMessage
+from .models import User
+from .snapshots import snapshots
+from .leader import BACKGROUND_JOBS_ENV
+from . import metrics
+
+if TYPE_CHECKING:
+    # Imported for real only inside the worker: app.telegram_client builds the supervisor from this module
+    from .telegram_client import HistoryPage
+
+_HEADER = struct.Struct("!I")
+
+async def _send(writer: asyncio.StreamWriter, obj: Any):
+    data = pickle.dumps(obj, protocol=pickle.HIGHEST_PROTOCOL)
+    writer.write(_HEADER.pack(len(data)) + data)
+    await writer.drain()
+
+async def _recv(reader: asyncio.StreamReader) -> Any:
+    head = await reader.readexactly(_HEADER.size)
+    return pickle.loads(await reader.readexactly(_HEADER.unpack(head)[0]))
+
+class WorkerError(RuntimeError):
+    """An exception raised inside a client worker; `error_type`/`value` mirror the original."""
+
+    def __init__(self, message: str, error_type: str = "", value: Any = None):
+        super().__init__(message)
+        self.error_type = error_type
+        self.value = value
+
+class HashRing:
+    """Consistent hash ring over worker indexes, with virtual nodes for an even spread."""
+
+    def __init__(self, replicas: int = 64):
+        self.replicas = replicas
+        self._keys: List[int] = []
+        self._nodes: Dict[int, int] = {}
+
+    @staticmethod
+    def _hash(key: str) -> int:
+        return int(hashlib.md5(key.encode()).hexdigest()[:16], 16)
+
+    def add(self, node: int):
+        for i in range(self.replicas):
+            h = self._hash(f"{node}#{i}")
+            if h not in self._nodes:
+                bisect.insort(self._keys, h)
+            self._nodes[h] = node
+
+    def remove(self, node: int):
+        for i in range(self.replicas):
+            h = self._hash(f"{node}#{i}")
+            if self._nodes.get(h) == node:
+                del self._nodes[h]
+                self._keys.remove(h)
+
+    def get(self, key: int) -> Optional[int]:
+        if not self._keys:
+            return None
+        pos = bisect.bisect(self._keys, self._hash(str(key))) % len(self._keys)
+        return self._nodes[self._keys[pos]]
+
+def _dialog_to_dict(d) -> Dict[str, Any]:
+    return {
+        "id": d.chat.id,
+        "title": d.chat.title,
+        "first_name": d.chat.first_name,
+        "type": str(d.chat.type),
+    }
+
+async def _dispatch(manager, cmd: Dict[str, Any]) -> Any:
+    """Run one client command against `manager` (a TelegramClientManager or ClientSupervisor)."""
+    op = cmd["op"]
+    user_id = cmd["user_id"]
+    if op == "start":
+        _, session_path = await manager.start_user(user_id, cmd.get("session_path"))
+        return session_path
+    if op == "stop":
+        await manager.sign_out(user_id)
+        return None
+    if op == "send_message":
+        await manager.send_message(user_id, cmd["chat_id"], cmd["text"])
+        return None
+    if op == "download_media":
+        return await manager.download_media(user_id, cmd["file_id"], cmd["path"], cmd["chat_id"], cmd["message_id"], cmd["thumb"])
+    if op == "history_page":
+        return await manager.history_page(user_id, cmd["chat_id"], cmd["min_id"], cmd.get("since"), cmd["limit"])
+    if op == "fetch_dialogs":
+        dialogs = await manager.fetch_dialogs(manager.get_client(user_id), since=cmd.get("since"))
+        return [_dialog_to_dict(d) for d in dialogs]
+    raise RuntimeError(f"unknown op {op}")
+
+async def _serve(manager, cmd: Dict[str, Any], send):
+    reply: Dict[str, Any] = {"op": "reply", "id": cmd["id"]}
+    try:
+        reply["result"] = await _dispatch(manager, cmd)
+    except Exception as e:
+        reply["error"] = str(e) or type(e).__name__
+        reply["error_type"] = type(e).__name__
+        reply["value"] = getattr(e, "value", None)
+    await send(reply)
+
+def worker_main(index: int, path: str):
+    # Shutdown is driven by the supervisor closing the socket, not by Ctrl+C
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    # The inherited TG_WORKERS would make app.telegram_client build a supervisor of its own
+    # here, and the inherited BACKGROUND_JOBS would make it compete for the owner's lock
+    os.environ["TG_WORKERS"] = "0"
+    os.environ[BACKGROUND_JOBS_ENV] = "0"
+    asyncio.run(_worker(index, path))
+
+async def _worker(index: int, path: str):
+    from .telegram_client import TelegramClientManager
+    reader, writer = await asyncio.open_unix_connection(path)
+    manager = TelegramClientManager()
+    send_lock = asyncio.Lock()
+
+    async def send(obj):
+        async with send_lock:
+            await _send(writer, obj)
+
+    async def emit(p: PendingMessage):
+        await send({"op": "message", "row": p.row, "chat_title": p.chat_title, "raw": p.raw})
+        return True
+
+    manager.emit = emit
+
+    async def handle(cmd: Dict[str, Any]):
+        if cmd["op"] == "invalidate":
+            snapshots.invalidate(cmd["user_id"])
+            return
+        await _serve(manager, cmd, send)
+
+    await send({"op": "hello", "index": index})
+    while True:
+        try:
+            cmd = await _recv(reader)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            break
+        asyncio.create_task(handle(cmd))
+    await manager.stop()
+
+class WorkerClientHandle:
+    """Stands in for a pyrogram Client owned by a worker process."""
+
+    def __init__(self, user_id: int):
+        self.user_id = user_id
+
+class _Worker:
+    def __init__(self, index: int, process):
+        self.index = index
+        self.process = process
+        self.writer: Optional[asyncio.StreamWriter] = None
+        self.ready = asyncio.Event()
+        self.send_lock = asyncio.Lock()
+        self.dead = False
+
+class ClientSupervisor:
+    """Drop-in replacement for TelegramClientManager that delegates to worker processes."""
+
+    def __init__(self, workers: int, directory: str):
+        self.workers = workers
+        self.directory = directory
+        # One per web process: uvicorn workers sharing the directory must not replace each other's socket
+        self.path = os.path.join(directory, f"supervisor-{os.getpid()}.sock")
+        self._workers: Dict[int, _Worker] = {}
+        self._ring = HashRing()
+        self._assign: Dict[int, int] = {}
+        self._sessions: Dict[int, str] = {}
+        self._pending: Dict[int, Tuple[int, asyncio.Future]] = {}
+        self._ids = itertools.count(1)
+        self._server: Optional[asyncio.AbstractServer] = None
+        self._monitor: Optional[asyncio.Task] = None
+        self.emit = ingest.submit
+        self.restarts = 0
+        self._failures: Dict[int, int] = {}
+        metrics.callback("counter", "tg_worker_restarts_total", "Client worker processes respawned after a crash", lambda: self.restarts)
+        metrics.callback("gauge", "tg_workers_alive", "Client worker processes alive", lambda: sum(1 for w in self._workers.values() if w.process.is_alive()))
+
+    async def start(self):
+        os.makedirs(self.directory, exist_ok=True)
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        self._server = await asyncio.start_unix_server(self._on_connection, path=self.path)
+        for i in range(self.workers):
+            self._spawn(i)
+        try:
+            await asyncio.wait_for(asyncio.gather(*(w.ready.wait() for w in self._workers.values())), 30)
+        except asyncio.TimeoutError:
+            print("client workers: not all workers came up in time")
+        snapshots.listeners.append(self._on_invalidate)
+        self._monitor = asyncio.create_task(self._watch())
+
+    async def stop(self):
+        if self._monitor:
+            self._monitor.cancel()
+        for w in self._workers.values():
+            if w.writer:
+                w.writer.close()
+        loop = asyncio.get_running_loop()
+        for w in self._workers.values():
+            await loop.run_in_executor(None, w.process.join, 10)
+            if w.process.is_alive():
+                w.process.terminate()
+        if self._server:
+            self._server.close()
+            try:
+                os.unlink(self.path)
+            except OSError:
+                pass
+
+    def _spawn(self, index: int):
+        ctx = mp.get_context("spawn")
+        proc = ctx.Process(target=worker_main, args=(index, self.path), daemon=True, name=f"tg-worker-{index}")
+        proc.start()
+        self._workers[index] = _Worker(index, proc)
+
+    async def _on_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        hello = await _recv(reader)
+        w = self._workers[hello["index"]]
+        w.writer = writer
+        self._ring.add(w.index)
+        self._failures.pop(w.index, None)
+        w.ready.set()
+        # Users that stayed assigned here (e.g. no other worker was alive) come back up
+        for user_id in [u for u, i in self._assign.items() if i == w.index]:
+            asyncio.create_task(self._restart_user(w.index, user_id))
+        while True:
+            try:
+                msg = await _recv(reader)
+            except (asyncio.IncompleteReadError, ConnectionError):
+                break
+            if msg["op"] == "message":
+                await self.emit(PendingMessage(msg["row"], msg["chat_title"], msg["raw"]))
+            elif msg["op"] == "reply":
+                _, fut = self._pending.pop(msg["id"], (None, None))
+                if fut is None or fut.done():
+                    continue
+                if "error" in msg:
+                    fut.set_exception(WorkerError(msg["error"], msg.get("error_type", ""), msg.get("value")))
+                else:
+                    fut.set_result(msg.get("result"))
+        if w.writer is writer:
+            w.writer = None
+
+    async def _watch(self):
+        while True:
+            await asyncio.sleep(1)
+            for index, w in list(self._workers.items()):
+                if not w.dead and not w.process.is_alive():
+                    self._on_crash(index, w)
+
+    def _on_crash(self, index: int, w: _Worker):
+        self.restarts += 1
+        w.dead = True
+        failures = self._failures.get(index, 0)
+        self._failures[index] = failures + 1
+        # Back off when a worker keeps dying before it even says hello
+        delay = min(30.0, 0.5 * (2 ** failures)) if failures else 0.0
+        print(f"client worker {index} died (exit code {w.process.exitcode}), restarting in {delay:.1f}s")
+        self._ring.remove(index)
+        w.writer = None
+        for req_id, (i, fut) in list(self._pending.items()):
+            if i == index:
+                self._pending.pop(req_id, None)
+                if not fut.done():
+                    fut.set_exception(WorkerError("client worker died"))
+        # Rebalance: its users move to the surviving workers right away
+        for user_id in [u for u, i in self._assign.items() if i == index]:
+            target = self._ring.get(user_id)
+            if target is not None:
+                self._assign[user_id] = target
+                asyncio.create_task(self._restart_user(target, user_id))
+        asyncio.create_task(self._respawn(index, delay))
+
+    async def _respawn(self, index: int, delay: float):
+        if delay:
+            await asyncio.sleep(delay)
+        self._spawn(index)
+
+    async def _restart_user(self, index: int, user_id: int):
+        try:
+            await self._request(index, {"op": "start", "user_id": user_id, "session_path": self._sessions.get(user_id)})
+        except Exception as e:
+            print(f"client worker {index}: restart of user {user_id} failed:", e)
+
+    async def _request(self, index: int, cmd: Dict[str, Any], timeout: float = 120) -> Any:
+        w = self._workers.get(index)
+        if w is None or w.writer is None:
+            raise WorkerError("client worker unavailable")
+        req_id = next(self._ids)
+        cmd["id"] = req_id
+        fut = asyncio.get_running_loop().create_future()
+        self._pending[req_id] = (index, fut)
+        try:
+            async with w.send_lock:
+                await _send(w.writer, cmd)
+            return await asyncio.wait_for(fut, timeout)
+        finally:
+            self._pending.pop(req_id, None)
+
+    def _owner(self, user_id: int) -> int:
+        index = self._assign.get(user_id)
+        if index is None:
+            raise RuntimeError("Client not started")
+        return index
+
+    def get_client(self, user_id: int) -> WorkerClientHandle:
+        self._owner(user_id)
+        return WorkerClientHandle(user_id)
+
+    def _on_invalidate(self, user_id: int):
+        index = self._assign.get(user_id)
+        w = self._workers.get(index) if index is not None else None
+        if w is not None and w.writer is not None:
+            asyncio.ensure_future(self._notify(w, {"op": "invalidate", "user_id": user_id}))
+
+    @staticmethod
+    async def _notify(w: _Worker, cmd: Dict[str, Any]):
+        try:
+            async with w.send_lock:
+                await _send(w.writer, cmd)
+        except Exception:
+            pass
+
+    async def get_or_create(self, db: AsyncSession, user: User) -> WorkerClientHandle:
+        handle, session_path = await self.start_user(user.id, user.session_path)
+        if not user.session_path:
+            user.session_path = session_path
+            await db.commit()
+        return handle
+
+    async def start_user(self, user_id: int, session_path: Optional[str] = None) -> Tuple[WorkerClientHandle, str]:
+        index = self._assign.get(user_id)
+        if index is None:
+            index = self._ring.get(user_id)
+            if index is None:
+                raise RuntimeError("no client workers running")
+        session_path = await self._request(index, {"op": "start", "user_id": user_id, "session_path": session_path})
+        self._assign[user_id] = index
+        self._sessions[user_id] = session_path
+        return WorkerClientHandle(user_id), session_path
+
+    async def adopt(self, user_id: int, client, session_path: str) -> WorkerClientHandle:
+        """A connection can't move between processes: release the login client and let
+        the owning worker start one from the now-authorized session file."""
+        try:
+            await client.disconnect()
+        except Exception:
+            pass
+        await self.sign_out(user_id)
+        handle, _ = await self.start_user(user_id, session_path)
+        return handle
+
+    async def sign_out(self, user_id: int):
+        index = self._assign.pop(user_id, None)
+        self._sessions.pop(user_id, None)
+        if index is not None:
+            try:
+                await self._request(index, {"op": "stop", "user_id": user_id})
+            except Exception:
+                pass
+
+    async def fetch_dialogs(self, client: WorkerClientHandle, since: Optional[datetime] = None):
+        cmd = {"op": "fetch_dialogs", "user_id": client.user_id, "since": since}
+        rows = await self._request(self._owner(client.user_id), cmd)
+        return [
+            SimpleNamespace(chat=SimpleNamespace(id=r["id"], title=r["title"], first_name=r["first_name"], type=r["type"]))
+            for r in rows
+        ]
+
+    async def send_message(self, user_id: int, chat_id: int, text: str):
+        await self._request(self._owner(user_id), {"op": "send_message", "user_id": user_id, "chat_id": chat_id, "text": text})
+
+    async def history_page(self, user_id: int, chat_id: int, min_id: int = 0, since: Optional[datetime] = None, limit: int = 100) -> "HistoryPage":
+        return await self._request(self._owner(user_id), {"op": "history_page", "user_id": user_id, "chat_id": chat_id, "min_id": min_id, "since": since, "limit": limit})
+
+    async def download_media(self, user_id: int, file_id: str, path: str, chat_id: int, message_id: int, thumb: bool = False) -> Optional[str]:
+        # Workers share the host, so the file lands where the web process reads it
+        return await self._request(self._owner(user_id), {
+            "op": "download_media", "user_id": user_id, "file_id": file_id, "path": path,
+            "chat_id": chat_id, "message_id": message_id, "thumb": thumb,
+        }, timeout=600)
+
+    def client_states(self) -> Dict[str, int]:
+        return {"assigned": len(self._assign)}
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "workers": {
+                i: {"alive": w.process.is_alive(), "ready": w.writer is not None, "users": sum(1 for v in self._assign.values() if v == i)}
+                for i, w in self._workers.items()
+            },
+            "restarts": self.restarts,
+        }
+
+CLIENTS_SOCKET = "clients.sock"
+
+class ClientServer:
+    """Serves the owning process's client manager to the other uvicorn workers."""
+
+    def __init__(self, manager, path: str):
+        self.manager = manager
+        self.path = path
+        self._server: Optional[asyncio.AbstractServer] = None
+        self._writers: Set[asyncio.StreamWriter] = set()
+
+    async def start(self):
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        # Left behind by a crashed owner; we hold jobs.lock, so nobody else serves it
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        self._server = await asyncio.start_unix_server(self._on_connection, path=self.path)
+
+    async def stop(self):
+        if self._server:
+            self._server.close()
+            self._server = None
+            try:
+                os.unlink(self.path)
+            except OSError:
+                pass
+        for writer in list(self._writers):
+            writer.close()
+
+    async def _on_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self._writers.add(writer)
+        send_lock = asyncio.Lock()
+
+        async def send(obj):
+            async with send_lock:
+                await _send(writer, obj)
+
+        while True:
+            try:
+                cmd = await _recv(reader)
+            except (asyncio.IncompleteReadError, ConnectionError):
+                break
+            if cmd["op"] == "invalidate":
+                snapshots.invalidate(cmd["user_id"])
+            else:
+                asyncio.create_task(_serve(self.manager, cmd, send))
+        self._writers.discard(writer)
+        writer.close()
+
+class ClientProxy:
+    """Drop-in replacement for TelegramClientManager in a uvicorn worker that doesn't
+    own the clients: every call goes to the owner's `ClientServer`."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._writer: Optional[asyncio.StreamWriter] = None
+        self._pending: Dict[int, asyncio.Future] = {}
+        self._ids = itertools.count(1)
+        self._connect_lock = asyncio.Lock()
+        self._send_lock = asyncio.Lock()
+
+    async def start(self):
+        snapshots.listeners.append(self._on_invalidate)
+
+    async def stop(self):
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+
+    async def _connect(self) -> asyncio.StreamWriter:
+        async with self._connect_lock:
+            if self._writer is None:
+                try:
+                    reader, writer = await asyncio.open_unix_connection(self.path)
+                except OSError as e:
+                    raise WorkerError(f"client owner unavailable ({e})") from e
+                self._writer = writer
+                asyncio.create_task(self._read(reader, writer))
+            return self._writer
+
+    async def _read(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        while True:
+            try:
+                msg = await _recv(reader)
+            except (asyncio.IncompleteReadError, ConnectionError):
+                break
+            fut = self._pending.pop(msg["id"], None)
+            if fut is None or fut.done():
+                continue
+            if "error" in msg:
+                fut.set_exception(WorkerError(msg["error"], msg.get("error_type", ""), msg.get("value")))
+            else:
+                fut.set_result(msg.get("result"))
+        # The owner went away (restarted by uvicorn): fail what was in flight, reconnect on next call
+        if self._writer is writer:
+            self._writer = None
+        for req_id, fut in list(self._pending.items()):
+            self._pending.pop(req_id, None)
+            if not fut.done():
+                fut.set_exception(WorkerError("client owner went away"))
+
+    async def _request(self, cmd: Dict[str, Any], timeout: float = 120) -> Any:
+        writer = await self._connect()
+        req_id = next(self._ids)
+        cmd["id"] = req_id
+        fut = asyncio.get_running_loop().create_future()
+        self._pending[req_id] = fut
+        try:
+            async with self._send_lock:
+                await _send(writer, cmd)
+            return await asyncio.wait_for(fut, timeout)
+        finally:
+            self._pending.pop(req_id, None)
+
+    def _on_invalidate(self, user_id: int):
+        asyncio.ensure_future(self._notify({"op": "invalidate", "user_id": user_id}))
+
+    async def _notify(self, cmd: Dict[str, Any]):
+        try:
+            writer = await self._connect()
+            async with self._send_lock:
+                await _send(writer, cmd)
+        except Exception:
+            pass
+
+    async def get_or_create(self, db: AsyncSession, user: User) -> WorkerClientHandle:
+        handle, session_path = await self.start_user(user.id, user.session_path)
+        if not user.session_path:
+            user.session_path = session_path
+            await db.commit()
+        return handle
+
+    def get_client(self, user_id: int) -> WorkerClientHandle:
+        return WorkerClientHandle(user_id)
+
+    async def start_user(self, user_id: int, session_path: Optional[str] = None) -> Tuple[WorkerClientHandle, str]:
+        session_path = await self._request({"op": "start", "user_id": user_id, "session_path": session_path})
+        return WorkerClientHandle(user_id), session_path
+
+    async def adopt(self, user_id: int, client, session_path: str) -> WorkerClientHandle:
+        """Like ClientSupervisor.adopt: the owner restarts the client from the authorized session file."""
+        try:
+            await client.disconnect()
+        except Exception:
+            pass
+        await self.sign_out(user_id)
+        handle, _ = await self.start_user(user_id, session_path)
+        return handle
+
+    async def sign_out(self, user_id: int):
+        try:
+            await self._request({"op": "stop", "user_id": user_id})
+        except WorkerError:
+            pass
+
+    async def fetch_dialogs(self, client: WorkerClientHandle, since: Optional[datetime] = None):
+        rows = await self._request({"op": "fetch_dialogs", "user_id": client.user_id, "since": since})
+        return [
+            SimpleNamespace(chat=SimpleNamespace(id=r["id"], title=r["title"], first_name=r["first_name"], type=r["type"]))
+            for r in rows
+        ]
+
+    async def send_message(self, user_id: int, chat_id: int, text: str):
+        await self._request({"op": "send_message", "user_id": user_id, "chat_id": chat_id, "text": text})
+
+    async def history_page(self, user_id: int, chat_id: int, min_id: int = 0, since: Optional[datetime] = None, limit: int = 100) -> "HistoryPage":
+        return await self._request({"op": "history_page", "user_id": user_id, "chat_id": chat_id, "min_id": min_id, "since": since, "limit": limit})
+
+    async def download_media(self, user_id: int, file_id: str, path: str, chat_id: int, message_id: int, thumb: bool = False) -> Optional[str]:
+        return await self._request({
+            "op": "download_media", "user_id": user_id, "file_id": file_id, "path": path,
+            "chat_id": chat_id, "message_id": message_id, "thumb": thumb,
+        }, timeout=600)
+
+    def client_states(self) -> Dict[str, int]:
+        # Counted by the owning worker
+        return {}
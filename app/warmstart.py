@@ -0,0 +1,97 @@
+import asyncio
+import os
+import random
+import time
+from typing import Any, Dict, Optional
+from sqlalchemy import select
+from .db import AsyncReadSessionLocal
+from .models import User
+from .telegram_client import tg_clients
+
+WARMSTART_ENV = "WARMSTART"
+WARMSTART_CONCURRENCY_ENV = "WARMSTART_CONCURRENCY"
+WARMSTART_JITTER_MS_ENV = "WARMSTART_JITTER_MS"
+
+class WarmStart:
+    """Restores the clients of every user with a saved session at startup.
+
+    Runs as a background task so HTTP is served meanwhile. At most `concurrency`
+    clients connect at once, and each waits a random 0..`jitter` seconds first so
+    a restart doesn't reconnect hundreds of sessions to the DC in one burst.
+    """
+
+    def __init__(self, enabled: bool = True, concurrency: int = 5, jitter: float = 0.5):
+        self.enabled = enabled
+        self.concurrency = concurrency
+        self.jitter = jitter
+        self._task: Optional[asyncio.Task] = None
+        self.total = 0
+        self.started = 0
+        self.failed = 0
+        self.in_progress = 0
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+
+    @classmethod
+    def from_env(cls) -> "WarmStart":
+        return cls(
+            enabled=os.getenv(WARMSTART_ENV, "1") not in ("0", "false", "no"),
+            concurrency=int(os.getenv(WARMSTART_CONCURRENCY_ENV, "5")),
+            jitter=int(os.getenv(WARMSTART_JITTER_MS_ENV, "500")) / 1000,
+        )
+
+    def start(self):
+        if self.enabled and self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None and not self._task.done():
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+
+    async def wait(self):
+        """Return once the warm start has finished (immediately if it never ran)."""
+        if self._task is not None:
+            await asyncio.wait({self._task})
+
+    def status(self) -> Dict[str, Any]:
+        return {
+            "enabled": self.enabled,
+            "total": self.total,
+            "started": self.started,
+            "failed": self.failed,
+            "in_progress": self.in_progress,
+            "pending": self.total - self.started - self.failed - self.in_progress,
+            "done": self.finished_at is not None,
+            "elapsed_s": round((self.finished_at or time.monotonic()) - self.started_at, 3) if self.started_at else 0,
+        }
+
+    async def _run(self):
+        self.started_at = time.monotonic()
+        async with AsyncReadSessionLocal() as db:
+            res = await db.execute(select(User.id, User.session_path).where(User.session_path.is_not(None)))
+            users = res.all()
+        self.total = len(users)
+        sem = asyncio.Semaphore(max(1, self.concurrency))
+        await asyncio.gather(*(self._restore(sem, u.id, u.session_path) for u in users))
+        self.finished_at = time.monotonic()
+        print(f"warm start: {self.started} clients restored, {self.failed} failed")
+
+    async def _restore(self, sem: asyncio.Semaphore, user_id: int, session_path: str):
+        async with sem:
+            if self.jitter:
+                await asyncio.sleep(random.uniform(0, self.jitter))
+            self.in_progress += 1
+            try:
+                await tg_clients.start_user(user_id, session_path)
+                self.started += 1
+            except Exception as e:
+                self.failed += 1
+                print(f"warm start: user {user_id} failed:", e)
+            finally:
+                self.in_progress -= 1
+
+warm_start = WarmStart.from_env()
@@ -1,28 +1,184 @@
-from typing import Dict, Set
+import asyncio
+import json
+import os
+from typing import Awaitable, Callable, Dict, List, Optional, Union
 from fastapi import WebSocket
+from .pubsub import Broker, broker_from_env
+from .ws_protocol import BatchCodec
+from . import metrics
+
+WS_SEND_QUEUE_ENV = "WS_SEND_QUEUE"
+
+WS_SEND_SECONDS = metrics.histogram("ws_send_seconds", "Time to write one frame to a WebSocket")
+WS_BATCH_PAYLOADS = metrics.histogram("ws_batch_payloads", "Payloads coalesced into one batched WebSocket frame",
+                                      buckets=(1, 2, 5, 10, 20, 50, 100, 200, 500))
+
+class _Conn:
+    """One socket with its own bounded outgoing queue, drained by a writer task.
+
+    Plain sockets queue serialized frames; with a `codec` (`/ws?proto=batch`) the
+    queue holds payload dicts, which the writer coalesces into batch frames.
+    """
+
+    def __init__(self, ws: WebSocket, maxsize: int, codec: Optional[BatchCodec] = None):
+        self.ws = ws
+        self.codec = codec
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=maxsize)
+        self.task: Optional[asyncio.Task] = None
+        # Sent before anything queued, e.g. messages replayed on reconnect
+        self.backlog: list = []
+
+    async def _send(self, data: Union[str, bytes]):
+        with WS_SEND_SECONDS.time():
+            if isinstance(data, bytes):
+                await self.ws.send_bytes(data)
+            else:
+                await self.ws.send_text(data)
+
+    async def run(self):
+        if self.codec is not None:
+            return await self._run_batched(self.codec)
+        for text in self.backlog:
+            await self._send(text)
+        self.backlog = []
+        while True:
+            await self._send(await self.queue.get())
+
+    async def _run_batched(self, codec: BatchCodec):
+        backlog, self.backlog = self.backlog, []
+        for i in range(0, len(backlog), codec.max_frames):
+            await self._send_batch(backlog[i:i + codec.max_frames])
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + codec.flush_interval
+            while len(batch) < codec.max_frames:
+                try:
+                    batch.append(self.queue.get_nowait())
+                    continue
+                except asyncio.QueueEmpty:
+                    pass
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            await self._send_batch(batch)
+
+    async def _send_batch(self, payloads: List[dict]):
+        WS_BATCH_PAYLOADS.observe(len(payloads))
+        await self._send(self.codec.encode(payloads))
 
 class WSManager:
-    def __init__(self) -> None:
-        self._conns: Dict[int, Set[WebSocket]] = {}
+    """Per-user fan-out: `broadcast` serializes the payload once and only enqueues it;
+    each socket's writer does the network I/O, so a slow tab can't stall the others.
+    A socket whose queue overflows is treated as a slow consumer and dropped.
+
+    Frames go through a pub/sub `Broker` (app/pubsub.py), so with several uvicorn
+    workers a message published in one process reaches sockets held by another.
+    """
+
+    def __init__(self, queue_size: int = 256, broker: Optional[Broker] = None) -> None:
+        self.queue_size = queue_size
+        self.broker = broker or broker_from_env()
+        self._conns: Dict[int, Dict[WebSocket, _Conn]] = {}
+        self.evicted = 0
+
+    async def start(self):
+        await self.broker.start(self.publish_text)
+
+    async def stop(self):
+        await self.broker.stop()
 
-    async def connect(self, user_id: int, ws: WebSocket):
+    async def connect(self, user_id: int, ws: WebSocket, backlog: Optional[Callable[[], Awaitable[List[dict]]]] = None,
+                      codec: Optional[BatchCodec] = None):
+        """Register the socket; with `backlog`, its payloads are sent ahead of live frames.
+
+        The socket subscribes before `backlog` runs, so nothing published meanwhile
+        is lost (the client drops what it sees twice). `codec` switches the socket
+        to batched frames (app/ws_protocol.py).
+        """
         await ws.accept()
-        self._conns.setdefault(user_id, set()).add(ws)
+        conn = _Conn(ws, self.queue_size, codec)
+        if user_id not in self._conns:
+            self.broker.subscribe(user_id)
+        self._conns.setdefault(user_id, {})[ws] = conn
+        if backlog is not None:
+            try:
+                payloads = await backlog()
+                conn.backlog = payloads if codec is not None else [self._encode(p) for p in payloads]
+            except Exception as e:
+                print("ws backlog error:", e)
+        if self._conns.get(user_id, {}).get(ws) is conn:
+            conn.task = asyncio.create_task(self._writer(user_id, conn))
 
     def disconnect(self, user_id: int, ws: WebSocket):
+        conns = self._conns.get(user_id)
+        if not conns:
+            return
+        conn = conns.pop(ws, None)
+        if not conns:
+            self._conns.pop(user_id, None)
+            self.broker.unsubscribe(user_id)
+        if conn and conn.task and not conn.task.done() and conn.task is not asyncio.current_task():
+            conn.task.cancel()
+
+    def count(self, user_id: int) -> int:
+        return len(self._conns.get(user_id, ()))
+
+    async def _writer(self, user_id: int, conn: _Conn):
         try:
-            self._conns.get(user_id, set()).discard(ws)
+            await conn.run()
+        except asyncio.CancelledError:
+            pass
+        except Exception:
+            self.disconnect(user_id, conn.ws)
+
+    def _evict(self, user_id: int, conn: _Conn):
+        self.evicted += 1
+        self.disconnect(user_id, conn.ws)
+        # 1013 "try again later": the client may reconnect and reload what it missed
+        asyncio.ensure_future(self._close(conn.ws, 1013))
+
+    @staticmethod
+    async def _close(ws: WebSocket, code: int):
+        try:
+            await ws.close(code=code)
         except Exception:
             pass
 
-    async def broadcast(self, user_id: int, payload: dict):
-        dead = []
-        for ws in list(self._conns.get(user_id, set())):
+    def publish_text(self, user_id: int, text: str):
+        """Enqueue an already-serialized frame on this process's sockets for the user."""
+        payload = None
+        for conn in list(self._conns.get(user_id, {}).values()):
+            item = text
+            if conn.codec is not None:
+                # Batched sockets re-encode; parse once for all of them
+                if payload is None:
+                    payload = json.loads(text)
+                item = payload
             try:
-                await ws.send_json(payload)
-            except Exception:
-                dead.append(ws)
-        for ws in dead:
-            self._conns.get(user_id, set()).discard(ws)
+                conn.queue.put_nowait(item)
+            except asyncio.QueueFull:
+                self._evict(user_id, conn)
+
+    async def broadcast(self, user_id: int, payload: dict):
+        """Queue `payload` for every socket of the user; never waits on the network."""
+        if self.broker.local_only and user_id not in self._conns:
+            return
+        self.broker.publish(user_id, self._encode(payload))
+
+    @staticmethod
+    def _encode(payload: dict) -> str:
+        return json.dumps(payload, ensure_ascii=False, separators=(",", ":"))
 
-ws_manager = WSManager()
+ws_manager = WSManager(queue_size=int(os.getenv(WS_SEND_QUEUE_ENV, "256")))
+metrics.callback("gauge", "ws_connections", "Open WebSockets in this process", lambda: sum(len(c) for c in ws_manager._conns.values()))
+metrics.callback("gauge", "ws_users", "Users with at least one open WebSocket in this process", lambda: len(ws_manager._conns))
+metrics.callback("counter", "ws_evicted_total", "Slow WebSockets dropped on send-queue overflow", lambda: ws_manager.evicted)
+metrics.callback("counter", "ws_bus_dropped_total", "Frames the pub/sub bus failed to hand to a peer process", lambda: ws_manager.broker.dropped)
+if metrics.per_user:
+    metrics.callback("gauge", "ws_user_connections", "Open WebSockets per user",
+                     lambda: {(str(uid),): len(c) for uid, c in ws_manager._conns.items()}, ("user_id",))
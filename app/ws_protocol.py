@@ -0,0 +1,157 @@
+"""Batched WebSocket framing, chosen by the client with `/ws?proto=batch`.
+
+Without `proto` a socket gets one JSON text frame per payload, as before. With
+it, the writer coalesces whatever is queued (up to `max_frames`, waiting at
+most `flush_interval` after the first) into one frame:
+
+    {"type": "batch",
+     "chats": {"<chat_id>": "<title>", ...},    # only chats this socket hasn't seen
+     "messages": [[id, chat_id, date, sender, text, media], ...],
+     "frames": [<any other payload>, ...]}
+
+`enc=binary` sends the same batch as a binary frame instead (see `encode_binary`).
+Compression is left to the transport: uvicorn negotiates permessage-deflate
+with browsers by default (`--ws-per-message-deflate`), and larger frames with
+repeated keys removed compress far better than single messages.
+"""
+import json
+import os
+from typing import Dict, List, Optional, Tuple, Union
+
+WS_BATCH_MS_ENV = "WS_BATCH_MS"
+WS_BATCH_MAX_ENV = "WS_BATCH_MAX"
+
+BATCH_FLUSH_INTERVAL = int(os.getenv(WS_BATCH_MS_ENV, "50")) / 1000
+BATCH_MAX_FRAMES = int(os.getenv(WS_BATCH_MAX_ENV, "200"))
+
+BINARY_VERSION = 1
+
+def _varint(out: bytearray, n: int):
+    while n >= 0x80:
+        out.append((n & 0x7F) | 0x80)
+        n >>= 7
+    out.append(n)
+
+def _zigzag(n: int) -> int:
+    return n * 2 if n >= 0 else -n * 2 - 1
+
+def _str(out: bytearray, s: str):
+    data = s.encode("utf-8")
+    _varint(out, len(data))
+    out += data
+
+class _Reader:
+    def __init__(self, data: bytes):
+        self.data = data
+        self.pos = 0
+
+    def varint(self) -> int:
+        n = shift = 0
+        while True:
+            b = self.data[self.pos]
+            self.pos += 1
+            n |= (b & 0x7F) << shift
+            if b < 0x80:
+                return n
+            shift += 7
+
+    def zigzag(self) -> int:
+        n = self.varint()
+        return n >> 1 if not n & 1 else -((n + 1) >> 1)
+
+    def str(self) -> str:
+        n = self.varint()
+        end = self.pos + n
+        s = self.data[self.pos:end].decode("utf-8")
+        self.pos = end
+        return s
+
+def decode_binary(data: bytes) -> Tuple[Dict[int, str], List[list], List[dict]]:
+    """Inverse of `BatchCodec.encode_binary` (what the feed's JavaScript does), as (chats, messages, frames)."""
+    if not data or data[0] != BINARY_VERSION:
+        raise ValueError("unsupported batch frame version")
+    r = _Reader(data)
+    r.pos = 1
+    chats = {}
+    for _ in range(r.varint()):
+        chat_id = r.varint()
+        chats[chat_id] = r.str()
+    messages = []
+    prev = 0
+    for _ in range(r.varint()):
+        prev += r.zigzag()
+        chat_id = r.varint()
+        date, sender, text, media = r.str(), r.str(), r.str(), r.str()
+        messages.append([prev, chat_id, date, sender, text, media or None])
+    frames = [json.loads(r.str()) for _ in range(r.varint())]
+    return chats, messages, frames
+
+class BatchCodec:
+    """Per-socket encoder: remembers which chat titles the socket already has."""
+
+    def __init__(self, binary: bool = False, flush_interval: float = BATCH_FLUSH_INTERVAL, max_frames: int = BATCH_MAX_FRAMES):
+        self.binary = binary
+        self.flush_interval = flush_interval
+        self.max_frames = max_frames
+        self._chats: Dict[int, str] = {}
+
+    @classmethod
+    def from_params(cls, params: Dict[str, str]) -> Optional["BatchCodec"]:
+        """The codec a `/ws` query asks for, or None for the plain one-frame-per-payload protocol."""
+        if params.get("proto") != "batch":
+            return None
+        return cls(binary=params.get("enc") == "binary")
+
+    def encode(self, payloads: List[dict]) -> Union[str, bytes]:
+        chats: Dict[int, str] = {}
+        messages: List[list] = []
+        frames: List[dict] = []
+        for p in payloads:
+            if p.get("type") != "message":
+                frames.append(p)
+                continue
+            chat_id = p["chat_id"] or 0
+            title = p.get("chat_title") or ""
+            if self._chats.get(chat_id) != title:
+                self._chats[chat_id] = title
+                chats[chat_id] = title
+            messages.append([p["id"], chat_id, p["date"], p["sender"], p["text"], p.get("media")])
+        if self.binary:
+            return self.encode_binary(chats, messages, frames)
+        return json.dumps(
+            {"type": "batch", "chats": {str(k): v for k, v in chats.items()}, "messages": messages, "frames": frames},
+            ensure_ascii=False, separators=(",", ":"),
+        )
+
+    @staticmethod
+    def encode_binary(chats: Dict[int, str], messages: List[list], frames: List[dict]) -> bytes:
+        """Layout (varint = unsigned LEB128, str = varint byte length + UTF-8):
+
+            u8 version
+            varint n, then n x (varint chat_id, str title)
+            varint n, then n x (zigzag varint id delta, varint chat_id, str date, str sender, str text, str media)
+            varint n, then n x (str JSON payload)
+
+        Message ids are deltas from the previous message in the frame (the first from 0);
+        zigzag maps a delta d to 2d, or -2d-1 when negative (a replay overlapping live frames).
+        An empty media kind means no media.
+        """
+        out = bytearray([BINARY_VERSION])
+        _varint(out, len(chats))
+        for chat_id, title in chats.items():
+            _varint(out, chat_id)
+            _str(out, title)
+        _varint(out, len(messages))
+        prev = 0
+        for mid, chat_id, date, sender, text, media in messages:
+            _varint(out, _zigzag(mid - prev))
+            prev = mid
+            _varint(out, chat_id)
+            _str(out, date)
+            _str(out, sender)
+            _str(out, text)
+            _str(out, media or "")
+        _varint(out, len(frames))
+        for f in frames:
+            _str(out, json.dumps(f, ensure_ascii=False, separators=(",", ":")))
+        return bytes(out)
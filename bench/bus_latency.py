@@ -0,0 +1,117 @@
+"""Cross-worker delivery latency of the WS pub/sub bus (app/pubsub.py).
+
+Spawns N "worker" processes on a UnixSocketBroker; each echoes frames for user 1
+back as user 2. The parent publishes timestamped frames and measures the round
+trip; one-way latency is reported as RTT / 2.
+
+    python bench/bus_latency.py --workers 4 --messages 5000
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing as mp
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from app.pubsub import UnixSocketBroker  # noqa: E402
+from common import save_results  # noqa: E402
+
+PING_USER = 1
+PONG_USER = 2
+
+def _echo_worker(directory: str, ready):
+    async def main():
+        broker = UnixSocketBroker(directory)
+
+        def deliver(user_id: int, text: str):
+            if user_id == PING_USER:
+                broker.publish(PONG_USER, text)
+
+        await broker.start(deliver)
+        ready.set()
+        await asyncio.Event().wait()
+    asyncio.run(main())
+
+def _pct(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+async def _run(directory: str, workers: int, messages: int, rate: float):
+    rtts = []
+    pending = {}
+    done = asyncio.Event()
+
+    def deliver(user_id: int, text: str):
+        if user_id != PONG_USER:
+            return
+        seq = json.loads(text)["seq"]
+        sent = pending.get(seq)
+        if sent is None:
+            return
+        pending[seq][1] -= 1
+        if pending[seq][1] == 0:
+            rtts.append(time.perf_counter() - sent[0])
+            del pending[seq]
+            if len(rtts) >= messages:
+                done.set()
+
+    broker = UnixSocketBroker(directory)
+    await broker.start(deliver)
+    interval = 1.0 / rate if rate else 0
+    start = time.perf_counter()
+    for seq in range(messages):
+        pending[seq] = [time.perf_counter(), workers]
+        broker.publish(PING_USER, json.dumps({"seq": seq, "text": "x" * 200}))
+        if interval:
+            await asyncio.sleep(interval)
+        elif seq % 100 == 0:
+            await asyncio.sleep(0)
+    try:
+        await asyncio.wait_for(done.wait(), 10)
+    except asyncio.TimeoutError:
+        pass
+    elapsed = time.perf_counter() - start
+    await broker.stop()
+    one_way_ms = [r / 2 * 1000 for r in rtts]
+    return {
+        "workers": workers,
+        "messages": messages,
+        "completed": len(rtts),
+        "dropped": broker.dropped,
+        "elapsed_s": round(elapsed, 3),
+        "p50_ms": round(statistics.median(one_way_ms), 4) if one_way_ms else None,
+        "p99_ms": round(_pct(one_way_ms, 0.99), 4) if one_way_ms else None,
+        "max_ms": round(max(one_way_ms), 4) if one_way_ms else None,
+    }
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--workers", type=int, default=3)
+    parser.add_argument("--messages", type=int, default=2000)
+    parser.add_argument("--rate", type=float, default=2000, help="messages/s, 0 = as fast as possible")
+    parser.add_argument("--out", help="result file (default bench/results/bus_latency-<time>.json)")
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory() as directory:
+        ctx = mp.get_context("spawn")
+        procs = []
+        for _ in range(args.workers):
+            ready = ctx.Event()
+            p = ctx.Process(target=_echo_worker, args=(directory, ready), daemon=True)
+            p.start()
+            ready.wait(10)
+            procs.append(p)
+        try:
+            result = asyncio.run(_run(directory, args.workers, args.messages, args.rate))
+        finally:
+            for p in procs:
+                p.terminate()
+    save_results("bus_latency", vars(args), result, args.out)
+
+if __name__ == "__main__":
+    main()
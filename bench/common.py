@@ -0,0 +1,89 @@
+"""Shared helpers for the benchmark scripts: app import setup, stats, result files."""
+import json
+import os
+import platform
+import resource
+import statistics
+import subprocess
+import sys
+import time
+from typing import Any, Dict, Iterable, List, Optional
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RESULTS_DIR = os.path.join(ROOT, "bench", "results")
+
+BENCH_DATABASE_URL_ENV = "BENCH_DATABASE_URL"
+
+def use_app(database_path: str, **env: str):
+    """Point the app at a scratch SQLite file (or at the empty database in
+    BENCH_DATABASE_URL, e.g. a throwaway Postgres); must run before anything imports `app`."""
+    if ROOT not in sys.path:
+        sys.path.insert(0, ROOT)
+    os.environ["DATABASE_URL"] = os.getenv(BENCH_DATABASE_URL_ENV) or f"sqlite+aiosqlite:///{database_path}"
+    # Background jobs would only add noise to the numbers
+    os.environ.setdefault("WARMSTART", "0")
+    os.environ.setdefault("BACKFILL", "0")
+    os.environ.setdefault("RETENTION_MAX_AGE_DAYS", "0")
+    os.environ.setdefault("TG_WORKERS", "0")
+    os.environ.setdefault("WS_BUS", "local")
+    os.environ.update(env)
+
+def pct(values: List[float], p: float) -> Optional[float]:
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+def summary_ms(seconds: Iterable[float]) -> Dict[str, Optional[float]]:
+    ms = [s * 1000 for s in seconds]
+    if not ms:
+        return {"n": 0, "p50_ms": None, "p99_ms": None, "max_ms": None}
+    return {
+        "n": len(ms),
+        "p50_ms": round(statistics.median(ms), 4),
+        "p99_ms": round(pct(ms, 0.99), 4),
+        "max_ms": round(max(ms), 4),
+    }
+
+def db_bytes(path: str) -> int:
+    """Main file plus WAL, i.e. what the data currently occupies on disk."""
+    total = 0
+    for suffix in ("", "-wal"):
+        try:
+            total += os.path.getsize(path + suffix)
+        except OSError:
+            pass
+    return total
+
+def peak_rss_bytes() -> int:
+    # ru_maxrss is KiB on Linux, bytes on macOS
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == "darwin" else rss * 1024
+
+def _git_rev() -> Optional[str]:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, stderr=subprocess.DEVNULL).decode().strip()
+    except Exception:
+        return None
+
+def save_results(name: str, params: Dict[str, Any], results: Dict[str, Any], out: Optional[str] = None) -> str:
+    """Write `{meta, params, results}` as JSON (default bench/results/<name>-<time>.json) and echo it."""
+    doc = {
+        "benchmark": name,
+        "meta": {
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "git": _git_rev(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+        },
+        "params": params,
+        "results": results,
+    }
+    if out is None:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        out = os.path.join(RESULTS_DIR, f"{name}-{time.strftime('%Y%m%d-%H%M%S')}.json")
+    with open(out, "w", encoding="utf-8") as f:
+        json.dump(doc, f, indent=2, ensure_ascii=False)
+    print(json.dumps(results, indent=2, ensure_ascii=False))
+    print(f"saved to {out}")
+    return out
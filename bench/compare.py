@@ -0,0 +1,41 @@
+"""Compare two saved benchmark results field by field.
+
+    python bench/compare.py bench/results/micro-A.json bench/results/micro-B.json
+"""
+import argparse
+import json
+from typing import Any, Dict, Iterator, Tuple
+
+def _flatten(d: Any, prefix: str = "") -> Iterator[Tuple[str, Any]]:
+    if isinstance(d, dict):
+        for k, v in d.items():
+            yield from _flatten(v, f"{prefix}.{k}" if prefix else str(k))
+    else:
+        yield prefix, d
+
+def compare(a: Dict[str, Any], b: Dict[str, Any]):
+    before = dict(_flatten(a["results"]))
+    after = dict(_flatten(b["results"]))
+    width = max((len(k) for k in after), default=0)
+    for key, new in after.items():
+        old = before.get(key)
+        if isinstance(new, (int, float)) and isinstance(old, (int, float)) and not isinstance(new, bool):
+            change = f"{(new - old) / old * 100:+.1f}%" if old else ""
+            print(f"{key:<{width}}  {old:>14}  {new:>14}  {change}")
+        elif old != new:
+            print(f"{key:<{width}}  {str(old):>14}  {str(new):>14}")
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("before")
+    parser.add_argument("after")
+    args = parser.parse_args()
+    with open(args.before, encoding="utf-8") as f:
+        a = json.load(f)
+    with open(args.after, encoding="utf-8") as f:
+        b = json.load(f)
+    print(f"{a['benchmark']}: {a['meta'].get('git')} -> {b['meta'].get('git')}")
+    compare(a, b)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+"""Stand-ins for Pyrogram's Client and for a browser WebSocket, for offline benchmarks.
+
+`FakeClient` has just the surface TelegramClientManager uses: it "connects" as an
+authorized account, records the on_message handler and idles. `deliver(msg)`
+runs that handler the way Pyrogram's dispatcher would. Messages are real
+`pyrogram.types.Message` objects, so raw_extract sees the usual attributes.
+"""
+import asyncio
+import json
+import time
+from datetime import datetime
+from types import SimpleNamespace
+from typing import Callable, Dict, List, Optional
+from pyrogram import enums, types
+
+class FakeClient:
+    def __init__(self, name: str = "", api_id: int = 0, api_hash: str = "", workdir: str = "", **kwargs):
+        self.name = name
+        self.me = None
+        self.disconnect_handler = None
+        self._handlers: List[Callable] = []
+        self._idle = asyncio.Event()
+
+    async def connect(self) -> bool:
+        return True
+
+    async def disconnect(self):
+        pass
+
+    async def invoke(self, query, *args, **kwargs):
+        return None
+
+    async def get_me(self):
+        return SimpleNamespace(id=0, first_name="bench")
+
+    async def initialize(self):
+        pass
+
+    def add_handler(self, handler, group: int = 0):
+        pass
+
+    def on_message(self, filters=None, group: int = 0):
+        def decorator(func):
+            self._handlers.append(func)
+            return func
+        return decorator
+
+    async def idle(self):
+        await self._idle.wait()
+
+    async def stop(self):
+        self._idle.set()
+
+    async def deliver(self, msg: types.Message):
+        for handler in self._handlers:
+            await handler(self, msg)
+
+    async def send_message(self, chat_id: int, text: str):
+        await asyncio.sleep(0)
+
+def make_message(message_id: int, chat_id: int, chat_title: str, sender_id: int, text: str) -> types.Message:
+    return types.Message(
+        id=message_id,
+        chat=types.Chat(id=chat_id, type=enums.ChatType.SUPERGROUP, title=chat_title),
+        from_user=types.User(id=sender_id, first_name=f"user{sender_id}", username=f"user{sender_id}"),
+        date=datetime.now(),
+        text=text,
+    )
+
+class FakeWebSocket:
+    """Accepts whatever WSManager sends and records when each message frame arrived.
+
+    `sent_at` maps a message text to the perf_counter time it was handed to the
+    handler; each delivery of that text adds one end-to-end latency sample.
+    """
+
+    def __init__(self, sent_at: Dict[str, float], latencies: List[float], on_frame: Optional[Callable[[], None]] = None):
+        self.sent_at = sent_at
+        self.latencies = latencies
+        self.on_frame = on_frame
+        self.frames = 0
+
+    async def accept(self):
+        pass
+
+    async def close(self, code: int = 1000):
+        pass
+
+    async def send_text(self, text: str):
+        now = time.perf_counter()
+        self.frames += 1
+        data = json.loads(text)
+        if data.get("type") == "message":
+            sent = self.sent_at.get(data.get("text"))
+            if sent is not None:
+                self.latencies.append(now - sent)
+        if self.on_frame is not None:
+            self.on_frame()
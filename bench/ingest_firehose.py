@@ -0,0 +1,154 @@
+"""End-to-end ingestion benchmark without Telegram.
+
+Runs the real TelegramClientManager with bench/fake_pyrogram.FakeClient in place
+of pyrogram.Client, attaches fake WebSocket consumers through ws_manager, and
+feeds synthetic messages to the handlers at a fixed rate. Everything after the
+handler (snapshot lookup, filter, ingest queue, batched insert, WS fan-out) is
+the production code path on a scratch SQLite database.
+
+Reports throughput, receive -> WS delivery latency, DB growth and peak RSS.
+
+    python bench/ingest_firehose.py --users 20 --chats 10 --rate 2000 --messages 20000
+"""
+import argparse
+import asyncio
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from common import db_bytes, peak_rss_bytes, save_results, summary_ms, use_app  # noqa: E402
+
+WORDS = ["привет", "встреча", "завтра", "отчёт", "дедлайн", "срочно", "мем", "обед", "код", "релиз", "баг", "ревью"]
+
+async def _run(args, db_path: str):
+    from sqlalchemy import insert
+    from app.db import engine, create_schema, AsyncSessionLocal
+    from app.models import User, Chat, FilterSetting
+    from app.ingest import ingest
+    from app.ws_manager import ws_manager
+    from app import telegram_client
+    from fake_pyrogram import FakeClient, FakeWebSocket, make_message
+
+    async with engine.begin() as conn:
+        await conn.run_sync(create_schema)
+
+    # Users, their selected chats and a filter that lets ~match_ratio of messages through
+    include = "срочно,дедлайн"
+    async with AsyncSessionLocal() as db:
+        await db.execute(insert(User), [{"id": u, "phone": f"+{u}", "session_path": f"bench_{u}"} for u in range(1, args.users + 1)])
+        await db.execute(insert(Chat), [
+            {"user_id": u, "chat_id": -1000 - c, "title": f"chat {c}", "chat_type": "ChatType.SUPERGROUP", "selected": True}
+            for u in range(1, args.users + 1) for c in range(args.chats)
+        ])
+        await db.execute(insert(FilterSetting), [{"user_id": u, "include_keywords": include, "exclude_keywords": ""} for u in range(1, args.users + 1)])
+        await db.commit()
+    size_before = db_bytes(db_path)
+
+    telegram_client.Client = FakeClient
+    manager = telegram_client.TelegramClientManager()
+    await ws_manager.start()
+    ingest.start()
+    clients = {}
+    for u in range(1, args.users + 1):
+        clients[u], _ = await manager.start_user(u, f"bench_{u}")
+    await asyncio.sleep(0)
+
+    sent_at = {}
+    latencies = []
+    expected = [0]
+    received = [0]
+    all_delivered = asyncio.Event()
+
+    def on_frame():
+        received[0] += 1
+        if received[0] >= expected[0] and sending_done.is_set():
+            all_delivered.set()
+
+    sending_done = asyncio.Event()
+    for u in range(1, args.users + 1):
+        for _ in range(args.sockets):
+            await ws_manager.connect(u, FakeWebSocket(sent_at, latencies, on_frame))
+
+    rng = random.Random(42)
+    interval = 1.0 / args.rate if args.rate else 0
+    start = time.perf_counter()
+    for seq in range(args.messages):
+        u = rng.randint(1, args.users)
+        c = rng.randrange(args.chats)
+        matching = rng.random() < args.match_ratio
+        words = rng.choices(WORDS[2:], k=args.words)
+        if matching:
+            words[rng.randrange(len(words))] = rng.choice(WORDS[4:6])
+        else:
+            words = [w for w in words if w not in ("срочно", "дедлайн")] or ["мем"]
+        # The sequence number makes texts unique, so a WS frame maps back to its send time
+        text = f"{' '.join(words)} #{seq}"
+        if matching:
+            expected[0] += args.sockets
+        sent_at[text] = time.perf_counter()
+        await clients[u].deliver(make_message(seq + 1, -1000 - c, f"chat {c}", 10_000 + seq % 97, text))
+        if interval:
+            delay = start + (seq + 1) * interval - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+        elif seq % 200 == 0:
+            await asyncio.sleep(0)
+    send_elapsed = time.perf_counter() - start
+    sending_done.set()
+    if received[0] >= expected[0]:
+        all_delivered.set()
+    try:
+        await asyncio.wait_for(all_delivered.wait(), args.drain_timeout)
+    except asyncio.TimeoutError:
+        pass
+    total_elapsed = time.perf_counter() - start
+
+    await ingest.stop()
+    await manager.stop()
+    await ws_manager.stop()
+    await engine.dispose()
+    stats = ingest.stats()
+    return {
+        "sent": args.messages,
+        "accepted": stats["enqueued"],
+        "written": stats["written"],
+        "dropped": stats["dropped"],
+        "ws_frames_expected": expected[0],
+        "ws_frames_delivered": len(latencies),
+        "send_elapsed_s": round(send_elapsed, 3),
+        "total_elapsed_s": round(total_elapsed, 3),
+        "handler_msgs_per_s": round(args.messages / send_elapsed, 1),
+        "written_msgs_per_s": round(stats["written"] / total_elapsed, 1),
+        "e2e_latency": summary_ms(latencies),
+        "flushes": stats["flushes"],
+        "max_queue_depth": stats["max_queue_depth"],
+        "db_bytes_before": size_before,
+        "db_bytes_after": db_bytes(db_path),
+        "db_bytes_per_written_msg": round((db_bytes(db_path) - size_before) / stats["written"], 1) if stats["written"] else None,
+        "peak_rss_bytes": peak_rss_bytes(),
+    }
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--users", type=int, default=10)
+    parser.add_argument("--chats", type=int, default=10, help="selected chats per user")
+    parser.add_argument("--sockets", type=int, default=1, help="WebSocket consumers per user")
+    parser.add_argument("--messages", type=int, default=10000)
+    parser.add_argument("--rate", type=float, default=1000, help="messages/s offered, 0 = as fast as possible")
+    parser.add_argument("--match-ratio", type=float, default=0.3, help="share of messages the filter accepts")
+    parser.add_argument("--words", type=int, default=12, help="words per message")
+    parser.add_argument("--drain-timeout", type=float, default=30)
+    parser.add_argument("--out", help="result file (default bench/results/ingest_firehose-<time>.json)")
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory() as directory:
+        db_path = os.path.join(directory, "bench.db")
+        use_app(db_path, SESSION_DIR=directory)
+        results = asyncio.run(_run(args, db_path))
+    save_results("ingest_firehose", vars(args), results, args.out)
+
+if __name__ == "__main__":
+    main()
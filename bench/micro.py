@@ -0,0 +1,134 @@
+"""Micro-benchmarks: keyword filter and the /feed page query.
+
+    python bench/micro.py                      # both
+    python bench/micro.py filters --keywords 5,50,500
+    python bench/micro.py feed --rows 200000
+"""
+import argparse
+import asyncio
+import os
+import random
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from common import db_bytes, save_results, summary_ms, use_app  # noqa: E402
+
+VOCAB = [f"слово{i}" for i in range(2000)] + ["дедлайн", "срочно", "встреча", "релиз", "баг"]
+
+def _texts(rng: random.Random, n: int, words: int):
+    return [" ".join(rng.choices(VOCAB, k=words)) for _ in range(n)]
+
+def bench_filters(args):
+    from app.filters import CompiledFilter, passes
+    rng = random.Random(1)
+    texts = _texts(rng, args.texts, args.words)
+    out = {}
+    for k in (int(x) for x in args.keywords.split(",")):
+        include = ",".join(rng.sample(VOCAB, k))
+        exclude = ",".join(rng.sample(VOCAB, max(1, k // 5)))
+        compiled = CompiledFilter(include, exclude)
+        row = {}
+        for label, fn in (
+            ("compiled", compiled.passes),
+            # Both strategies forced, to check where SMALL_SET should sit
+            ("automaton", CompiledFilter(include, exclude, automaton=True).passes),
+            ("in_scan", CompiledFilter(include, exclude, automaton=False).passes),
+            # The module-level helper: one lru_cache lookup per call on top of the compiled filter
+            ("passes()", lambda t: passes(t, include, exclude)),
+        ):
+            best = None
+            for _ in range(args.repeat):
+                t0 = time.perf_counter()
+                for t in texts:
+                    fn(t)
+                elapsed = time.perf_counter() - t0
+                best = elapsed if best is None else min(best, elapsed)
+            row[label] = {"texts_per_s": round(len(texts) / best), "us_per_text": round(best / len(texts) * 1e6, 3)}
+        out[f"{k}_keywords"] = row
+    return out
+
+async def _feed(args, db_path: str):
+    from sqlalchemy import insert, select, func
+    from app.db import engine, create_schema, AsyncSessionLocal, AsyncReadSessionLocal
+    from app.models import User, Chat, Message
+    from app.chat_routes import fetch_messages
+
+    async with engine.begin() as conn:
+        await conn.run_sync(create_schema)
+    rng = random.Random(2)
+    users = args.users
+    async with AsyncSessionLocal() as db:
+        await db.execute(insert(User), [{"id": u, "phone": f"+{u}"} for u in range(1, users + 1)])
+        await db.execute(insert(Chat), [
+            {"user_id": u, "chat_id": -1000 - c, "title": f"chat {c}", "selected": True}
+            for u in range(1, users + 1) for c in range(args.chats)
+        ])
+        await db.commit()
+        start = datetime.now() - timedelta(days=30)
+        t0 = time.perf_counter()
+        batch = []
+        for i in range(args.rows):
+            u = rng.randint(1, users)
+            c = rng.randrange(args.chats)
+            batch.append({
+                "user_id": u, "chat_id": (u - 1) * args.chats + c + 1, "tg_chat_id": -1000 - c, "tg_message_id": i,
+                "date": start + timedelta(seconds=i), "sender_name": "bench", "text": " ".join(rng.choices(VOCAB, k=12)),
+            })
+            if len(batch) == 5000:
+                await db.execute(insert(Message), batch)
+                batch = []
+        if batch:
+            await db.execute(insert(Message), batch)
+        await db.commit()
+        load_s = time.perf_counter() - t0
+
+    async with AsyncReadSessionLocal() as db:
+        res = await db.execute(select(func.max(Message.id)).where(Message.user_id == 1))
+        newest = res.scalar()
+        cases = {
+            "first_page": {},
+            "deep_page": {"before_id": newest // 2},
+            "one_chat": {"chat_id": 1},
+        }
+        out = {}
+        for name, kwargs in cases.items():
+            samples = []
+            for _ in range(args.repeat):
+                t0 = time.perf_counter()
+                await fetch_messages(db, 1, **kwargs)
+                samples.append(time.perf_counter() - t0)
+            out[name] = summary_ms(samples)
+    await engine.dispose()
+    out["rows"] = args.rows
+    out["load_rows_per_s"] = round(args.rows / load_s)
+    out["db_bytes"] = db_bytes(db_path)
+    return out
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("which", nargs="?", choices=["all", "filters", "feed"], default="all")
+    parser.add_argument("--keywords", default="5,50,100,200,500", help="include-list sizes to try")
+    parser.add_argument("--texts", type=int, default=20000)
+    parser.add_argument("--words", type=int, default=20, help="words per text")
+    parser.add_argument("--rows", type=int, default=100000, help="messages in the feed table")
+    parser.add_argument("--users", type=int, default=10)
+    parser.add_argument("--chats", type=int, default=20)
+    parser.add_argument("--repeat", type=int, default=50)
+    parser.add_argument("--out", help="result file (default bench/results/micro-<time>.json)")
+    args = parser.parse_args()
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        db_path = os.path.join(directory, "bench.db")
+        use_app(db_path)
+        if args.which in ("all", "filters"):
+            results["filters"] = bench_filters(args)
+        if args.which in ("all", "feed"):
+            results["feed"] = asyncio.run(_feed(args, db_path))
+    save_results("micro", vars(args), results, args.out)
+
+if __name__ == "__main__":
+    main()
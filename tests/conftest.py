@@ -0,0 +1,52 @@
+"""Shared setup: the app is pointed at a scratch SQLite database and directories
+before anything imports it, with the background jobs off (as in bench/common.py)."""
+import asyncio
+import os
+import sys
+import tempfile
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+_SCRATCH = tempfile.mkdtemp(prefix="tg-filter-tests-")
+os.environ["DATABASE_URL"] = f"sqlite+aiosqlite:///{_SCRATCH}/test.db"
+os.environ["SESSION_DIR"] = os.path.join(_SCRATCH, "sessions")
+os.environ["MEDIA_DIR"] = os.path.join(_SCRATCH, "media")
+os.environ["WS_BUS"] = "local"
+os.environ["TG_WORKERS"] = "0"
+os.environ["WARMSTART"] = "0"
+os.environ["BACKFILL"] = "0"
+os.environ["RETENTION_MAX_AGE_DAYS"] = "0"
+os.environ["STORE_ALL"] = "0"
+
+@pytest.fixture
+def run():
+    """Run a coroutine on a fresh event loop; pooled connections are bound to the loop
+    that opened them, so the engines are disposed before it closes."""
+    from app.db import engine, read_engine
+
+    def _run(coro):
+        async def main():
+            try:
+                return await coro
+            finally:
+                await engine.dispose()
+                await read_engine.dispose()
+        return asyncio.run(main())
+    return _run
+
+@pytest.fixture
+def db(run):
+    """An empty, migrated database for each test."""
+    from app.db import Base, engine, create_schema
+    import app.models  # noqa: F401  (registers the tables)
+
+    async def reset():
+        async with engine.begin() as conn:
+            await conn.run_sync(Base.metadata.drop_all)
+            await conn.exec_driver_sql("DROP TABLE IF EXISTS schema_version")
+            await conn.run_sync(create_schema)
+    run(reset())
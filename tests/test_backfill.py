@@ -0,0 +1,103 @@
+from datetime import datetime, timedelta
+
+from sqlalchemy import select
+
+from app.telegram_client import HistoryPage
+
+class FakeHistory:
+    """history_page over a fixed list of Telegram message ids; `service` ids come back
+    from Telegram but carry nothing to store, like joins and pins."""
+
+    def __init__(self, ids, service=()):
+        self.ids = sorted(ids)
+        self.service = set(service)
+        self.calls = []
+
+    async def history_page(self, user_id, chat_id, min_id=0, since=None, limit=100):
+        self.calls.append(min_id)
+        got = [i for i in self.ids if i > min_id][:limit]
+        messages = [
+            {"tg_message_id": i, "date": datetime.now() - timedelta(minutes=1), "sender_name": "s", "text": f"m{i}", "raw": {"id": i}}
+            for i in got if i not in self.service
+        ]
+        return HistoryPage(messages, len(got), max(got, default=min_id))
+
+async def _seed(stored_ids):
+    from app.db import AsyncSessionLocal
+    from app.ingest import PendingMessage, write_messages
+    from app.models import Chat, User
+    async with AsyncSessionLocal() as db:
+        db.add(User(id=1, phone="+1"))
+        db.add(Chat(id=1, user_id=1, chat_id=-1001, title="a", selected=True))
+        await db.commit()
+        await write_messages(db, [PendingMessage({
+            "user_id": 1, "chat_id": 1, "tg_chat_id": -1001, "tg_message_id": i,
+            "date": datetime.now(), "sender_name": "s", "text": "live", "passed": True,
+        }, "a", {"id": i}) for i in stored_ids])
+        await db.commit()
+
+async def _seed_live(tg_message_id):
+    from app.db import AsyncSessionLocal
+    from app.ingest import PendingMessage, write_messages
+    async with AsyncSessionLocal() as db:
+        await write_messages(db, [PendingMessage({
+            "user_id": 1, "chat_id": 1, "tg_chat_id": -1001, "tg_message_id": tg_message_id,
+            "date": datetime.now(), "sender_name": "s", "text": "live", "passed": True,
+        }, "a", {"id": tg_message_id})])
+        await db.commit()
+
+async def _state():
+    from app.db import AsyncSessionLocal
+    from app.models import Chat, Message
+    async with AsyncSessionLocal() as db:
+        checkpoint = (await db.execute(select(Chat.backfill_max_id).where(Chat.id == 1))).scalar()
+        ids = (await db.execute(select(Message.tg_message_id).order_by(Message.tg_message_id))).scalars().all()
+    return checkpoint, ids
+
+def _backfill(monkeypatch, history):
+    from app import backfill as module
+    from app.snapshots import snapshots
+    monkeypatch.setattr(module, "tg_clients", history)
+    snapshots.invalidate(1)
+    return module.Backfill(page_size=10, pause=0)
+
+def test_backfill_pages_from_seeded_checkpoint(db, run, monkeypatch):
+    # Stored before the restart: 1..5. Telegram has 1..40, with 12..24 all service messages
+    # (a page with nothing to store must still advance the checkpoint, not end the catch-up).
+    history = FakeHistory(range(1, 41), service=range(12, 25))
+    bf = _backfill(monkeypatch, history)
+
+    async def scenario():
+        await _seed(range(1, 6))
+        await bf.seed_checkpoints()
+        seeded = await _state()
+        # A live message past the gap arrives once the client is up
+        await _seed_live(41)
+        await bf.run_chat(1, 1, -1001, "a")
+        return seeded, await _state()
+
+    (seeded_checkpoint, _), (checkpoint, ids) = run(scenario())
+    assert seeded_checkpoint == 5
+    assert history.calls[0] == 5
+    assert ids == [*range(1, 12), *range(25, 42)]
+    assert checkpoint == 40
+
+def test_backfill_resumes_and_skips_stored(db, run, monkeypatch):
+    history = FakeHistory(range(1, 26))
+    bf = _backfill(monkeypatch, history)
+
+    async def scenario():
+        await _seed(range(1, 4))
+        await bf.seed_checkpoints()
+        await bf.run_chat(1, 1, -1001, "a")
+        first = await _state()
+        # Nothing new: one request, no writes, checkpoint unchanged
+        history.calls.clear()
+        await bf.run_chat(1, 1, -1001, "a")
+        return first, list(history.calls), await _state()
+
+    (checkpoint, ids), calls, again = run(scenario())
+    assert ids == list(range(1, 26)) and checkpoint == 25
+    assert calls == [25]
+    assert again == (25, ids)
+    assert bf.stored == 22
@@ -0,0 +1,68 @@
+import random
+
+import pytest
+
+from app.filters import CompiledFilter, FilterCache, SMALL_SET, compile_filter
+
+def baseline_passes(text, include_csv, exclude_csv):
+    """The filter as it was before compilation: plain `in` checks per keyword."""
+    t = (text or "").lower()
+    includes = [p.strip() for p in (include_csv or "").split(",") if p.strip()]
+    excludes = [p.strip() for p in (exclude_csv or "").split(",") if p.strip()]
+    if includes and not any(w.lower() in t for w in includes):
+        return False
+    if excludes and any(w.lower() in t for w in excludes):
+        return False
+    return True
+
+WORDS = ["кот", "котик", "Собака", "dog", "hot dog", "дедлайн", "ёлка", "елка", "he", "she", "hers", "his", "a", "ab", "abc", "bc"]
+
+def _csv(rng, n):
+    return ", ".join(rng.sample(WORDS, n)) + rng.choice(["", ",", " , ,"])
+
+def _text(rng):
+    return rng.choice([None, ""]) if rng.random() < 0.05 else " ".join(rng.choices(WORDS + ["x", "ushers", "ABC", "Кот"], k=rng.randint(1, 8)))
+
+@pytest.mark.parametrize("automaton", [True, False, None])
+def test_compiled_filter_matches_baseline(automaton):
+    rng = random.Random(1)
+    for _ in range(300):
+        include = _csv(rng, rng.randint(0, 5))
+        exclude = _csv(rng, rng.randint(0, 3))
+        cf = CompiledFilter(include, exclude, automaton=automaton)
+        texts = [_text(rng) for _ in range(20)]
+        expected = [baseline_passes(t, include, exclude) for t in texts]
+        assert cf.passes_many(texts) == expected, (include, exclude)
+
+def test_automaton_overlapping_keywords():
+    # Keywords that are suffixes/prefixes of each other exercise the failure links
+    cf = CompiledFilter("he, she, his, hers", "", automaton=True)
+    assert cf.passes("USHERS")
+    assert not cf.passes("hi s")
+    cf = CompiledFilter("abc", "bc", automaton=True)
+    assert not cf.passes("xabcx")
+    assert not cf.passes("bc")
+
+def test_small_sets_use_substring_checks():
+    words = ",".join(f"w{i}" for i in range(SMALL_SET))
+    assert CompiledFilter(words, "")._automaton is None
+    assert CompiledFilter(words + ",extra", "")._automaton is not None
+
+def test_empty_filter_passes_everything():
+    cf = compile_filter("", " , ")
+    assert cf.empty
+    assert cf.passes(None) and cf.passes("anything")
+
+class _Settings:
+    def __init__(self, include, exclude=""):
+        self.include_keywords = include
+        self.exclude_keywords = exclude
+
+def test_filter_cache_recompiles_for_changed_settings():
+    cache = FilterCache()
+    stale = cache.get(1, _Settings("cat"))
+    fresh = cache.get(1, _Settings("dog"))
+    assert stale.passes("cat") and not fresh.passes("cat") and fresh.passes("dog")
+    assert cache.get(1, _Settings("dog")) is fresh
+    cache.invalidate(1)
+    assert cache.get(1, None).empty
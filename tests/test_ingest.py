@@ -0,0 +1,59 @@
+from datetime import datetime
+
+from sqlalchemy import func, select
+
+def _pending(tg_message_id, text="hello", chat=1):
+    from app.ingest import PendingMessage
+    return PendingMessage({
+        "user_id": 1, "chat_id": chat, "tg_chat_id": -1000 - chat, "tg_message_id": tg_message_id,
+        "date": datetime(2024, 1, 1, 12, 0), "sender_name": "s", "text": text, "passed": True,
+    }, "chat", {"id": tg_message_id, "text": text})
+
+async def _seed():
+    from app.db import AsyncSessionLocal
+    from app.models import Chat, User
+    async with AsyncSessionLocal() as db:
+        db.add(User(id=1, phone="+1"))
+        db.add(Chat(id=1, user_id=1, chat_id=-1001, title="a", selected=True))
+        db.add(Chat(id=2, user_id=1, chat_id=-1002, title="b", selected=True))
+        await db.commit()
+
+async def _write(batch):
+    from app.db import AsyncSessionLocal
+    from app.ingest import write_messages
+    async with AsyncSessionLocal() as db:
+        ids = await write_messages(db, batch)
+        await db.commit()
+    return ids
+
+async def _counts():
+    from app.db import AsyncSessionLocal
+    from app.models import Message, MessageRaw
+    async with AsyncSessionLocal() as db:
+        messages = (await db.execute(select(func.count()).select_from(Message))).scalar()
+        raws = (await db.execute(select(func.count()).select_from(MessageRaw))).scalar()
+    return messages, raws
+
+def test_write_messages_skips_stored_messages(db, run):
+    async def scenario():
+        await _seed()
+        first = await _write([_pending(1), _pending(2)])
+        # Message 2 again (live ingestion and backfill both saw it), the same id in another chat, a new one
+        second = await _write([_pending(2, "again"), _pending(2, chat=2), _pending(3)])
+        return first, second, await _counts()
+
+    first, second, (messages, raws) = run(scenario())
+    assert all(first) and first == sorted(first)
+    assert second[0] is None
+    assert second[1] is not None and second[2] is not None
+    assert second[1] < second[2]
+    assert (messages, raws) == (4, 4)
+
+def test_write_messages_duplicates_within_one_batch(db, run):
+    async def scenario():
+        await _seed()
+        return await _write([_pending(5), _pending(5, "dup"), _pending(6)]), await _counts()
+
+    ids, counts = run(scenario())
+    assert ids[0] is not None and ids[1] is None and ids[2] is not None
+    assert counts == (2, 2)
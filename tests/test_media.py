@@ -0,0 +1,97 @@
+import asyncio
+import os
+
+from app.ingest import PendingMessage
+from app.media import MediaCache, downloadable
+
+def _fetch(size, calls=None, delay=0):
+    async def fetch(path):
+        if calls is not None:
+            calls.append(path)
+        await asyncio.sleep(delay)
+        with open(path, "wb") as f:
+            f.write(b"x" * size)
+        return path
+    return fetch
+
+def test_evicts_least_recently_used(tmp_path, run):
+    cache = MediaCache(str(tmp_path), max_bytes=250)
+
+    async def main():
+        for key in ("a", "b"):
+            await cache.get(key, _fetch(100))
+        # A hit makes "a" the most recently used, so "b" goes first
+        calls = []
+        assert await cache.get("a", _fetch(100, calls)) == str(tmp_path / "a")
+        assert not calls
+        await cache.get("c", _fetch(100))
+    run(main())
+    assert sorted(os.listdir(tmp_path)) == ["a", "c"]
+    assert cache.stats()["bytes"] == 200
+    assert (cache.hits, cache.downloads, cache.evicted) == (1, 3, 1)
+
+def test_keeps_the_file_just_downloaded(tmp_path, run):
+    cache = MediaCache(str(tmp_path), max_bytes=150)
+
+    async def main():
+        await cache.get("small", _fetch(100))
+        return await cache.get("big", _fetch(300))
+    assert run(main()) == str(tmp_path / "big")
+    assert os.listdir(tmp_path) == ["big"]
+    assert cache.evicted == 1
+
+def test_concurrent_requests_share_one_download(tmp_path, run):
+    cache = MediaCache(str(tmp_path))
+    calls = []
+
+    async def main():
+        fetch = _fetch(10, calls, delay=0.01)
+        return await asyncio.gather(*(cache.get("k", fetch) for _ in range(5)))
+    assert run(main()) == [str(tmp_path / "k")] * 5
+    assert len(calls) == 1
+    assert cache.deduplicated == 4
+
+def test_failed_download_leaves_nothing(tmp_path, run):
+    cache = MediaCache(str(tmp_path))
+
+    async def nothing(path):
+        return None
+
+    async def broken(path):
+        open(path, "wb").close()
+        raise RuntimeError("connection lost")
+
+    async def main():
+        assert await cache.get("none", nothing) is None
+        try:
+            await cache.get("broken", broken)
+        except RuntimeError:
+            pass
+        else:
+            raise AssertionError("fetch error swallowed")
+    run(main())
+    assert os.listdir(tmp_path) == []
+    assert cache.failed == 2
+
+def test_load_restores_recency_and_drops_partial_files(tmp_path, run):
+    for i, name in enumerate(("old", "new")):
+        (tmp_path / name).write_bytes(b"x" * 100)
+        os.utime(tmp_path / name, (1000 + i, 1000 + i))
+    (tmp_path / "interrupted.part").write_bytes(b"x" * 50)
+    cache = MediaCache(str(tmp_path), max_bytes=250)
+    run(cache.get("third", _fetch(100)))
+    assert sorted(os.listdir(tmp_path)) == ["new", "third"]
+
+def test_directory_is_absolute():
+    assert os.path.isabs(MediaCache("relative/media").directory)
+
+def test_downloadable_kinds():
+    assert downloadable({"kind": "photo", "file_id": "f"})
+    assert not downloadable({"kind": "photo"})
+    assert not downloadable({"kind": "web_page", "file_id": "f"})
+    assert not downloadable(None)
+    row = {"id": 1}
+    PendingMessage(row, "chat", {"media": {"kind": "poll"}})
+    assert "media" not in row
+    PendingMessage(row, "chat", {"media": {"kind": "voice", "file_id": "f"}})
+    assert row["media"] == "voice"
@@ -0,0 +1,45 @@
+import json
+
+from app.ws_protocol import BatchCodec, decode_binary
+
+def _message(mid, chat_id, title, text="привет", media=None):
+    return {"type": "message", "id": mid, "chat_id": chat_id, "chat_title": title, "date": "2024-01-01T12:00:00",
+            "sender": "Аня", "text": text, "media": media}
+
+def test_binary_batch_round_trip():
+    codec = BatchCodec(binary=True)
+    payloads = [
+        _message(1000, 1, "Чат 1"),
+        _message(1001, 2, "Чат 2", text="", media="photo"),
+        {"type": "refiltered", "count": 3},
+        # A replay overlapping live frames: ids go backwards (negative delta)
+        _message(998, 1, "Чат 1", text="😀 " + "x" * 300),
+        _message(2 ** 40, 300, "big ids"),
+    ]
+    chats, messages, frames = decode_binary(codec.encode(payloads))
+    assert chats == {1: "Чат 1", 2: "Чат 2", 300: "big ids"}
+    expected = [[p["id"], p["chat_id"], p["date"], p["sender"], p["text"], p["media"]] for p in payloads if p["type"] == "message"]
+    assert messages == expected
+    assert frames == [{"type": "refiltered", "count": 3}]
+
+def test_binary_and_json_batches_carry_the_same_data():
+    payloads = [_message(5, 1, "a"), _message(6, 1, "a", media="voice"), {"type": "notice"}]
+    chats, messages, frames = decode_binary(BatchCodec(binary=True).encode(payloads))
+    doc = json.loads(BatchCodec().encode(payloads))
+    assert {int(k): v for k, v in doc["chats"].items()} == chats
+    assert doc["messages"] == messages
+    assert doc["frames"] == frames
+
+def test_chat_titles_sent_once_per_socket():
+    codec = BatchCodec(binary=True)
+    first, _, _ = decode_binary(codec.encode([_message(1, 1, "a")]))
+    second, messages, _ = decode_binary(codec.encode([_message(2, 1, "a"), _message(3, 2, "b")]))
+    renamed, _, _ = decode_binary(codec.encode([_message(4, 1, "a2")]))
+    assert first == {1: "a"}
+    assert second == {2: "b"} and [m[0] for m in messages] == [2, 3]
+    assert renamed == {1: "a2"}
+
+def test_from_params():
+    assert BatchCodec.from_params({}) is None
+    assert BatchCodec.from_params({"proto": "batch"}).binary is False
+    assert BatchCodec.from_params({"proto": "batch", "enc": "binary"}).binary is True